@@ -0,0 +1,355 @@
+# Benchmark / load-test harness for the hosting control plane.
+#
+# Runs bot.py in a throwaway workspace against a local fake Telegram API and local bare
+# git repos, then measures handler latency, spawn-to-running time, registry lookup cost
+# and HTTP throughput. Results are printed (or written) as JSON; pass --compare with a
+# previous result file to see the relative change of every metric.
+#
+#   python bench.py --out before.json
+#   python bench.py --compare before.json
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:bench"
+ADMIN_ID = 1000
+
+def percentiles(samples):
+    if not samples: return {"n": 0}
+    s = sorted(samples)
+    pick = lambda q: round(s[min(len(s) - 1, int(q * (len(s) - 1)))] * 1000, 3)
+    return {"n": len(s), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": round(s[-1] * 1000, 3),
+            "mean_ms": round(sum(s) / len(s) * 1000, 3)}
+
+# --- FAKE TELEGRAM API ---
+class FakeTelegram:
+    def __init__(self, latency=0.0, script=b"import time\nprint('ready', flush=True)\nwhile True: time.sleep(1)\n"):
+        self.latency, self.script = latency, script
+        self.calls, self.lock, self.ids = {}, threading.Lock(), iter(range(10**6, 10**9))
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args): pass
+
+            def reply(self, body, ctype="application/json"):
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/file/"):
+                    with fake.lock: fake.calls["download"] = fake.calls.get("download", 0) + 1
+                    return self.reply(fake.script, "application/octet-stream")
+                self.do_POST()
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                method = self.path.rsplit("/", 1)[-1]
+                if "json" in (self.headers.get("Content-Type") or ""): params = json.loads(raw or b"{}")
+                else: params = {k: v[0] for k, v in urllib.parse.parse_qs(raw.decode()).items()}
+                if fake.latency: time.sleep(fake.latency)
+                with fake.lock: fake.calls[method] = fake.calls.get(method, 0) + 1
+                self.reply(json.dumps({"ok": True, "result": fake.result(method, params)}).encode())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat = int(params.get("chat_id") or 1)
+            return {"message_id": int(params.get("message_id") or next(self.ids)), "date": int(time.time()),
+                    "chat": {"id": chat, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                    "text": params.get("text", "")}
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": "u", "file_size": len(self.script), "file_path": "documents/app.py"}
+        return True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+# --- WORKSPACE ---
+def make_bare_repo(root, name, files=20):
+    src, bare = os.path.join(root, f"{name}-src"), os.path.join(root, f"{name}.git")
+    os.makedirs(os.path.join(src, "pkg"))
+    with open(os.path.join(src, "main.py"), "w") as f: f.write("import time\nprint('ready', flush=True)\nwhile True: time.sleep(1)\n")
+    for i in range(files):
+        with open(os.path.join(src, "pkg", f"mod{i}.py"), "w") as f: f.write(f"VALUE = {i}\n")
+    env = dict(os.environ, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@localhost",
+               GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@localhost")
+    for cmd in (["git", "init", "-q"], ["git", "add", "."], ["git", "commit", "-qm", "init"]):
+        subprocess.run(cmd, cwd=src, env=env, check=True)
+    subprocess.run(["git", "clone", "-q", "--bare", src, bare], check=True)
+    return "file://" + bare
+
+def load_bot(workdir, api_port, http_port):
+    # bot.py reads its configuration and relative paths at import time.
+    os.chdir(workdir)
+    api = f"http://127.0.0.1:{api_port}"
+    for key, value in {"TOKEN": TOKEN, "ADMIN_ID": str(ADMIN_ID), "PORT": str(http_port), "BOT_MODE": "polling",
+                       "TELEGRAM_API_URL": f"{api}/bot", "TELEGRAM_FILE_URL": f"{api}/file/bot",
+                       "RENDER_EXTERNAL_URL": "", "TG_GLOBAL_RATE": "10000", "TG_CHAT_RATE": "10000",
+                       "TG_CHAT_BURST": "10000", "RECOVERY_SETTLE": "0", "SAMPLE_INTERVAL": "3600"}.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, HERE)
+    import bot
+    bot.logging.getLogger().setLevel(bot.logging.WARNING)
+    return bot
+
+class Updates:
+    def __init__(self, bot, application):
+        self.Update, self.app, self.ids = bot.Update, application, iter(range(1, 10**9))
+
+    def _user(self):
+        return {"id": ADMIN_ID, "is_bot": False, "first_name": "bench"}
+
+    def message(self, chat, text=None, document=None):
+        uid = next(self.ids)
+        msg = {"message_id": uid, "date": int(time.time()), "chat": {"id": chat, "type": "private"}, "from": self._user()}
+        if text is not None: msg["text"] = text
+        if document: msg["document"] = {"file_id": f"f{uid}", "file_unique_id": f"u{uid}", "file_name": document}
+        return self.Update.de_json({"update_id": uid, "message": msg}, self.app.bot)
+
+    def callback(self, chat, data):
+        uid = next(self.ids)
+        msg = {"message_id": uid, "date": int(time.time()), "chat": {"id": chat, "type": "private"},
+               "from": {"id": 1, "is_bot": True, "first_name": "bench"}, "text": "menu"}
+        return self.Update.de_json({"update_id": uid, "callback_query": {"id": str(uid), "from": self._user(), "chat_instance": "1",
+                                                                        "data": data, "message": msg}}, self.app.bot)
+
+    async def timed(self, update):
+        t = time.perf_counter()
+        await self.app.process_update(update)
+        return time.perf_counter() - t
+
+# --- SCENARIOS ---
+async def bench_handlers(bot, application, repo_url, iterations):
+    u, results = Updates(bot, application), {}
+    chats = iter(range(10**6, 10**7))
+    samples = []
+    for _ in range(iterations):
+        chat = next(chats)
+        await application.process_update(u.message(chat, "📤 Upload File"))
+        samples.append(await u.timed(u.message(chat, document="app.py")))
+        await application.process_update(u.message(chat, "🔙 Cancel"))
+    results["receive_file"] = percentiles(samples)
+
+    repo_name = repo_url.rsplit("/", 1)[-1].replace(".git", "")
+    clone, update = [], []
+    for i in range(iterations):
+        fresh = i % 2 == 0
+        if fresh: shutil.rmtree(os.path.join(bot.UPLOAD_DIR, repo_name), ignore_errors=True)
+        chat = next(chats)
+        await application.process_update(u.message(chat, "🌐 Clone from Git"))
+        (clone if fresh else update).append(await u.timed(u.message(chat, repo_url)))
+        await application.process_update(u.message(chat, "🔙 Cancel"))
+    results["receive_git_url.clone"] = percentiles(clone)
+    results["receive_git_url.update"] = percentiles(update)
+
+    bot.save_ownership("app.py", ADMIN_ID, "file")
+    results["manage_callback"] = percentiles([await u.timed(u.callback(next(chats), "man_app.py")) for _ in range(iterations)])
+    results["list_hosted"] = percentiles([await u.timed(u.message(next(chats), "📂 My Hosted Apps")) for _ in range(iterations)])
+    return results
+
+async def bench_spawn(bot, apps):
+    tids = []
+    for i in range(apps):
+        tid = f"bench_{i}.py"
+        with open(os.path.join(bot.UPLOAD_DIR, tid), "w") as f: f.write("import time\nprint('ready', flush=True)\nwhile True: time.sleep(1)\n")
+        bot.save_ownership(tid, ADMIN_ID, "file")
+        tids.append(tid)
+    t0 = time.perf_counter()
+    running, first_output = {}, {}
+
+    async def one(tid):
+        await bot.supervisor.start(tid)
+        running[tid] = time.perf_counter() - t0
+        app = bot.supervisor.get(tid)
+        while app.last_output is None and time.perf_counter() - t0 < 30: await asyncio.sleep(0.005)
+        if app.last_output is not None: first_output[tid] = time.perf_counter() - t0
+
+    await asyncio.gather(*(one(t) for t in tids))
+    total = time.perf_counter() - t0
+    await asyncio.gather(*(bot.supervisor.remove(t) for t in tids))
+    return {"apps": apps, "wall_s": round(total, 3), "spawn_to_running": percentiles(list(running.values())),
+            "spawn_to_first_output": percentiles(list(first_output.values())), "no_output": apps - len(first_output)}
+
+def bench_registry(bot, sizes, lookups=20000):
+    results = {}
+    for size in sizes:
+        d = tempfile.mkdtemp(prefix="bench-reg-")
+        reg = bot.Registry(os.path.join(d, "own.json"), os.path.join(d, "users.json"))
+        owners = max(1, size // 20)
+        t = time.perf_counter()
+        for i in range(size): reg.set_owner(f"app{i}.py", 5000 + i % owners, "file")
+        insert = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in range(lookups): reg.owner(f"app{i % size}.py")
+        owner = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in range(lookups // 10): reg.targets_for(5000 + i % owners)
+        per_user = time.perf_counter() - t
+        t = time.perf_counter()
+        reg.flush()
+        flush = time.perf_counter() - t
+        results[str(size)] = {"insert_us": round(insert / size * 1e6, 3), "owner_us": round(owner / lookups * 1e6, 3),
+                              "targets_for_us": round(per_user / (lookups // 10) * 1e6, 3), "flush_ms": round(flush * 1000, 3)}
+        shutil.rmtree(d, ignore_errors=True)
+    return results
+
+def http_load(port, paths, seconds, clients, method="GET", body=None):
+    latencies, errors, lock = [], [0], threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(n):
+        conn, mine = http.client.HTTPConnection("127.0.0.1", port, timeout=10), []
+        i = n
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            t = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers={"Content-Type": "application/json"} if body else {})
+                resp = conn.getresponse()
+                data = resp.read()
+                # /save_code reports failures as 200 {"status": "error"}, so JSON bodies are checked too.
+                failed = resp.status >= 500
+                if not failed and resp.getheader("Content-Type", "").startswith("application/json"):
+                    try: failed = json.loads(data).get("status") == "error"
+                    except (ValueError, AttributeError): failed = True
+                if failed: errors[0] += 1
+                mine.append(time.perf_counter() - t)
+            except Exception:
+                errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.close()
+        with lock: latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - start
+    return {"requests": len(latencies), "errors": errors[0], "rps": round(len(latencies) / elapsed, 1), "latency": percentiles(latencies)}
+
+async def bench_http(bot, port, seconds, clients):
+    server = bot.http_server()
+    task = asyncio.get_running_loop().create_task(server.serve())
+    while not server.started: await asyncio.sleep(0.01)
+    with open(os.path.join(bot.UPLOAD_DIR, "web.py"), "w") as f: f.write("import time\nwhile True: time.sleep(1)\n")
+    bot.save_ownership("web.py", ADMIN_ID, "file")
+    await bot.supervisor.start("web.py")
+    run = lambda *a, **k: asyncio.to_thread(http_load, port, *a, **k)
+    auth = bot.signed_query(ADMIN_ID)  # the editor endpoints only accept signed links
+    results = {
+        "status": await run(["/status?script=web.py", "/status?script=missing.py"], seconds, clients),
+        "editor": await run([f"/editor?id=web.py&file=web.py&{auth}"], seconds, clients),
+        "editor_file": await run([f"/editor/file?id=web.py&file=web.py&{auth}"], seconds, clients),
+        # Every save triggers a reload, so this one runs with a single client.
+        "save_code": await run([f"/save_code?{auth}"], seconds, 1, method="POST",
+                               body=json.dumps({"target_id": "web.py", "filename": "web.py", "code": "import time\nwhile True: time.sleep(1)\n"})),
+    }
+    # Each save rebuilds and then restarts web.py; let the last of those land before removing it.
+    for _ in range(100):
+        app = bot.supervisor.get("web.py")
+        if not bot.build_queue.active and app and app.state == "running" and app.uptime() > 0.3: break
+        await asyncio.sleep(0.1)
+    await bot.supervisor.remove("web.py")
+    server.should_exit = True
+    await task
+    return results
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_rev():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fake = FakeTelegram(latency=args.api_latency / 1000).start()
+    http_port = free_port()
+    repo_url = make_bare_repo(tempfile.mkdtemp(prefix="bench-git-"), "benchrepo")
+    bot = load_bot(workdir, fake.port, http_port)
+    application = bot.build_application()
+    bot.build_queue.bind(asyncio.get_running_loop())
+    bot.supervisor.bind(asyncio.get_running_loop())
+    results = {"meta": {"rev": git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "time": int(time.time()), "args": vars(args)}}
+    try:
+        async with application:
+            t = time.perf_counter()
+            results["handlers"] = await bench_handlers(bot, application, repo_url, args.iterations)
+            results["spawn"] = await bench_spawn(bot, args.apps)
+            results["registry"] = bench_registry(bot, args.registry_sizes)
+            results["http"] = await bench_http(bot, http_port, args.http_seconds, args.http_clients)
+            results["meta"]["duration_s"] = round(time.perf_counter() - t, 2)
+            results["meta"]["api_calls"] = dict(fake.calls)
+    finally:
+        await bot.supervisor.shutdown()
+        bot.registry.flush()
+        fake.stop()
+        os.chdir(HERE)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict): out.update(flatten(v, key + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool): out[key] = v
+    return out
+
+def compare(old, new):
+    a, b = flatten({k: v for k, v in old.items() if k != "meta"}), flatten({k: v for k, v in new.items() if k != "meta"})
+    return {k: {"old": a[k], "new": b[k], "change_pct": round((b[k] - a[k]) / a[k] * 100, 1) if a[k] else None} for k in sorted(a.keys() & b.keys())}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hosting bot control plane.")
+    parser.add_argument("--iterations", type=int, default=30, help="samples per handler")
+    parser.add_argument("--apps", type=int, default=20, help="concurrent apps for the spawn benchmark")
+    parser.add_argument("--registry-sizes", type=lambda s: [int(x) for x in s.split(",")], default=[100, 1000, 10000])
+    parser.add_argument("--http-seconds", type=float, default=5)
+    parser.add_argument("--http-clients", type=int, default=16)
+    parser.add_argument("--api-latency", type=float, default=0, help="simulated Telegram API latency in ms")
+    parser.add_argument("--out", help="write results to this file instead of stdout")
+    parser.add_argument("--compare", help="previous results file to diff against")
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    if args.compare:
+        with open(args.compare) as f: results["compare"] = compare(json.load(f), results)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f: f.write(text)
+    else: print(text)
+
+if __name__ == "__main__":
+    main()
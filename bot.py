@@ -7,9 +7,35 @@ import sys
 import psutil
 import json
 import threading
+import queue
 import shutil
-from flask import Flask, request, render_template_string, jsonify
+import atexit
+import time
+import re
+import itertools
+import hashlib
+import math
+import resource
+import html
+import fnmatch
+import ast
+import functools
+import contextlib
+import concurrent.futures
+import hmac
+import gzip
+import zlib
+import tarfile
+import tempfile
+import urllib.request
+import urllib.error
+import urllib.parse
+from collections import deque
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from flask import Flask, Response, request, render_template_string, jsonify, stream_with_context
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, ContextTypes, CommandHandler, 
     MessageHandler, filters, ConversationHandler, CallbackQueryHandler
@@ -19,6 +45,20 @@ from telegram.ext import (
 TOKEN = os.environ.get("TOKEN") 
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0")) 
 BASE_URL = os.environ.get("RENDER_EXTERNAL_URL", "http://localhost:8080")
+PORT = int(os.environ.get("PORT", 8080))
+PUBLIC_URL = os.environ.get("RENDER_EXTERNAL_URL")
+BOT_MODE = os.environ.get("BOT_MODE", "auto")  # auto | webhook | polling
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32]
+LINK_SECRET = os.environ.get("LINK_SECRET") or hashlib.sha256(f"links:{TOKEN}".encode()).hexdigest()
+LINK_TTL = int(os.environ.get("LINK_TTL", "86400"))  # lifetime of the signed uid in bot-generated links
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.environ.get("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+HTTP_THREADS = int(os.environ.get("HTTP_THREADS", "32"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_KEEPALIVE = int(os.environ.get("HTTP_KEEPALIVE", "15"))
+HTTP_GRACEFUL_TIMEOUT = int(os.environ.get("HTTP_GRACEFUL_TIMEOUT", "10"))
 
 UPLOAD_DIR = "scripts"
 if not os.path.exists(UPLOAD_DIR):
@@ -26,8 +66,82 @@ if not os.path.exists(UPLOAD_DIR):
 
 USERS_FILE = "allowed_users.json"
 OWNERSHIP_FILE = "ownership.json"
+REGISTRY_FLUSH_INTERVAL = float(os.environ.get("REGISTRY_FLUSH_INTERVAL", "1.0"))
+BUILD_CONCURRENCY = int(os.environ.get("BUILD_CONCURRENCY", "2"))
+BUILD_TIMEOUT = float(os.environ.get("BUILD_TIMEOUT", "900"))
+DEPS_STORE = os.path.abspath(os.environ.get("DEPS_STORE", "deps_store"))
+DEPS_STORE_MAX_MB = int(os.environ.get("DEPS_STORE_MAX_MB", "4096"))
+ARTIFACT_DIR = os.path.abspath(os.environ.get("ARTIFACT_DIR", "artifacts"))
+PREPARE_TIMEOUT = int(os.environ.get("PREPARE_TIMEOUT", "60"))  # bound on the import timing run
+RESTART_POLICY = os.environ.get("RESTART_POLICY", "on-failure")  # always | on-failure | never
+RESTART_BACKOFF_BASE = float(os.environ.get("RESTART_BACKOFF_BASE", "1"))
+RESTART_BACKOFF_MAX = float(os.environ.get("RESTART_BACKOFF_MAX", "300"))
+RESTART_RESET_AFTER = float(os.environ.get("RESTART_RESET_AFTER", "60"))
+STOP_TIMEOUT = float(os.environ.get("STOP_TIMEOUT", "10"))
+CGROUP_PARENT = os.environ.get("CGROUP_PARENT", "/sys/fs/cgroup/bothost")
+DEFAULT_LIMITS = {
+    "mem_mb": int(os.environ.get("DEFAULT_MEM_MB", "0")) or None,
+    "cpu": int(os.environ.get("DEFAULT_CPU_WEIGHT", "100")),
+    "pids": int(os.environ.get("DEFAULT_MAX_PIDS", "0")) or None,
+    "nofile": int(os.environ.get("DEFAULT_NOFILE", "1024")) or None,
+}
+SAMPLE_INTERVAL = float(os.environ.get("SAMPLE_INTERVAL", "5"))
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", "3"))
+LOG_TAIL_LINES = int(os.environ.get("LOG_TAIL_LINES", "50"))
+LOG_FOLLOWERS_MAX = int(os.environ.get("LOG_FOLLOWERS_MAX", str(max(1, HTTP_THREADS // 4))))  # each follower holds an HTTP thread
+LOG_STORE_DIR = os.path.abspath(os.environ.get("LOG_STORE_DIR", "log_store"))
+LOG_STORE_MAX_MB = int(os.environ.get("LOG_STORE_MAX_MB", "512"))
+LOG_SEGMENT_MB = int(os.environ.get("LOG_SEGMENT_MB", "16"))
+LOG_BLOCK_BYTES = int(os.environ.get("LOG_BLOCK_BYTES", str(32 * 1024)))
+LOG_LINE_MAX = 2048  # longer lines are cut in the search store (the plain log keeps them)
+LOG_SEARCH_LIMIT = int(os.environ.get("LOG_SEARCH_LIMIT", "100"))
+LOG_STORE_QUEUE = int(os.environ.get("LOG_STORE_QUEUE", "10000"))  # chunks waiting for the indexer; more are dropped
+GIT_POLL_INTERVAL = float(os.environ.get("GIT_POLL_INTERVAL", "0"))
+USER_QUOTA_MB = int(os.environ.get("USER_QUOTA_MB", "0"))  # 0 = unlimited
+GLOBAL_QUOTA_MB = int(os.environ.get("GLOBAL_QUOTA_MB", "0"))
+DISK_USAGE_TTL = float(os.environ.get("DISK_USAGE_TTL", "60"))
+GC_INTERVAL = float(os.environ.get("GC_INTERVAL", "3600"))  # 0 disables the background GC
+GC_MIN_AGE = float(os.environ.get("GC_MIN_AGE", "86400"))
+STATE_FILE = os.environ.get("STATE_FILE", "supervisor_state.json")
+RECOVERY_CONCURRENCY = int(os.environ.get("RECOVERY_CONCURRENCY", "4"))
+RECOVERY_STAGGER = float(os.environ.get("RECOVERY_STAGGER", "0.5"))
+RECOVERY_SETTLE = float(os.environ.get("RECOVERY_SETTLE", "5"))
+RECOVERY_TIMEOUT = float(os.environ.get("RECOVERY_TIMEOUT", "300"))
+SCAN_PAGE_SIZE = int(os.environ.get("SCAN_PAGE_SIZE", "10"))
+RELOAD_READY_SECS = float(os.environ.get("RELOAD_READY_SECS", "3"))
+RELOAD_READY_TIMEOUT = float(os.environ.get("RELOAD_READY_TIMEOUT", "30"))
+RELOAD_GRACE = float(os.environ.get("RELOAD_GRACE", "30"))
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "30"))
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", "5"))
+HEALTH_THRESHOLD = int(os.environ.get("HEALTH_THRESHOLD", "3"))
+HEALTH_GRACE = float(os.environ.get("HEALTH_GRACE", "30"))
+HEALTH_CONCURRENCY = int(os.environ.get("HEALTH_CONCURRENCY", "16"))
+IDLE_CHECK_INTERVAL = float(os.environ.get("IDLE_CHECK_INTERVAL", "30"))
+IDLE_CPU_PCT = float(os.environ.get("IDLE_CPU_PCT", "1.0"))
+IDLE_IO_BPS = float(os.environ.get("IDLE_IO_BPS", "2048"))
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "5"))
+API_TOKEN = os.environ.get("API_TOKEN")
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "8"))
+BULK_ROLLING_TIMEOUT = float(os.environ.get("BULK_ROLLING_TIMEOUT", "120"))  # per batch, to become healthy
+NODE_ROLE = os.environ.get("NODE_ROLE", "controller")  # controller | agent
+AGENT_TOKEN = os.environ.get("AGENT_TOKEN")
+CONTROLLER_URL = os.environ.get("CONTROLLER_URL", "")
+AGENT_NAME = os.environ.get("AGENT_NAME") or os.uname().nodename
+AGENT_URL = os.environ.get("AGENT_URL") or f"http://127.0.0.1:{PORT}"
+AGENT_LABELS = [l.strip() for l in os.environ.get("AGENT_LABELS", "").split(",") if l.strip()]
+AGENT_HEARTBEAT = float(os.environ.get("AGENT_HEARTBEAT", "5"))
+AGENT_TIMEOUT = float(os.environ.get("AGENT_TIMEOUT", "20"))
+DEPLOY_POLL = float(os.environ.get("DEPLOY_POLL", "1"))  # controller's poll interval for an agent-side install
+LOCAL_APPS = os.environ.get("LOCAL_APPS", "1") == "1"  # controller also hosts apps itself
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.01"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+EDITOR_MAX_BYTES = int(os.environ.get("EDITOR_MAX_BYTES", str(512 * 1024)))  # larger files open read-only
+EDITOR_CHUNK = 64 * 1024
 
-running_processes = {} 
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -56,19 +170,35 @@ EDITOR_HTML = """
         .header h3 { margin: 0; font-size: 14px; color: #8be9fd; }
         .btn { background: #50fa7b; color: #282a36; border: none; padding: 8px 15px; border-radius: 5px; font-weight: bold; cursor: pointer; }
         .CodeMirror { flex-grow: 1; font-size: 13px; }
+        #view { flex-grow: 1; margin: 0; padding: 10px; overflow: auto; font-size: 13px; white-space: pre; }
     </style>
 </head>
 <body>
     <div class="header">
         <h3>📄 {{ filename }}</h3>
-        <button class="btn" onclick="saveCode()">💾 Save & Restart</button>
+        {% if readonly %}<span>🔒 Read-only ({{ size_kb }} KB)</span>{% else %}<button class="btn" onclick="saveCode()">💾 Save & Restart</button>{% endif %}
     </div>
-    <textarea id="code_area">{{ code }}</textarea>
+    {% if readonly %}<pre id="view"></pre>{% else %}<textarea id="code_area"></textarea>{% endif %}
     <script>
         var tg = window.Telegram.WebApp;
         tg.expand(); 
-        
-        var fname = "{{ filename }}".toLowerCase();
+        var fileUrl = {{ file_url|tojson }};
+        {% if readonly %}
+        // Too big for the editor: stream it into a plain view chunk by chunk.
+        var view = document.getElementById("view"), dec = new TextDecoder();
+        fetch(fileUrl).then(r => {
+            var reader = r.body.getReader();
+            function pump() {
+                return reader.read().then(res => {
+                    if(res.done) return;
+                    view.appendChild(document.createTextNode(dec.decode(res.value, {stream: true})));
+                    return pump();
+                });
+            }
+            return pump();
+        });
+        {% else %}
+        var fname = {{ filename|tojson }}.toLowerCase();
         var mode = "python";
         if(fname.endsWith(".js") || fname.endsWith(".json")) mode = "javascript";
         if(fname.endsWith(".sh")) mode = "shell";
@@ -78,27 +208,46 @@ EDITOR_HTML = """
         var editor = CodeMirror.fromTextArea(document.getElementById("code_area"), {
             mode: mode, theme: "dracula", lineNumbers: true
         });
+        var base = null, original = "";
+        fetch(fileUrl).then(r => {
+            base = (r.headers.get("ETag") || "").replace(/^W\//, "").replace(/"/g, "");
+            return r.text();
+        }).then(text => { original = text; editor.setValue(text); editor.clearHistory(); });
+
+        // Only the changed span goes over the wire: [start, end, replacement] against `base`.
+        function makePatch(a, b) {
+            var s = 0, e = 0;
+            while(s < a.length && s < b.length && a[s] === b[s]) s++;
+            while(e < a.length - s && e < b.length - s && a[a.length - 1 - e] === b[b.length - 1 - e]) e++;
+            return [[s, a.length - e, b.slice(s, b.length - e)]];
+        }
 
         function saveCode() {
-            fetch('/save_code', {
+            var code = editor.getValue();
+            fetch('/save_code?' + {{ auth|tojson }}, {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({ 
-                    target_id: "{{ target_id }}", 
-                    filename: "{{ filename }}",
-                    code: editor.getValue()
+                    target_id: {{ target_id|tojson }}, 
+                    filename: {{ filename|tojson }},
+                    base: base,
+                    patch: makePatch(original, code)
                 })
             })
             .then(r => r.json())
             .then(data => {
                 if(data.status === 'success') {
+                    base = data.version; original = code;
                     tg.showAlert("✅ Saved & Restarting...");
                     tg.close();
+                } else if(data.status === 'conflict') {
+                    tg.showAlert("⚠️ The file was changed elsewhere since you opened it. Reopen the editor to get the latest version.");
                 } else {
                     tg.showAlert("❌ Error: " + data.message);
                 }
             });
         }
+        {% endif %}
     </script>
 </body>
 </html>
@@ -110,69 +259,364 @@ def home(): return "🤖 Bot Host is Alive!", 200
 @app.route('/status')
 def script_status():
     script_name = request.args.get('script')
-    if not script_name: return "Specify script", 400
-    if script_name in running_processes and running_processes[script_name]['process'].poll() is None:
-        return f"✅ {script_name} is running.", 200
-    return f"❌ {script_name} is stopped.", 404
+    if not script_name: return jsonify({"error": "Specify script"}), 400
+    proc = supervisor.get(script_name)
+    if not proc and not registry.get(script_name): return jsonify({"error": "unknown app", "target": script_name}), 404
+    woke = None
+    if isinstance(proc, RemoteApp):
+        try: proc.refresh(agent_request(cluster.agents[proc.node]["url"], f"/agent/status?wake=1&target={urllib.parse.quote(script_name)}", timeout=30))
+        except (RuntimeError, KeyError) as e: logger.warning(f"Live status of {script_name} from {proc.node} failed: {e}")
+    elif proc and proc.state in ("frozen", "idle"):
+        # A hit on the status URL is a wake trigger for scaled-to-zero apps.
+        try: woke = asyncio.run_coroutine_threadsafe(supervisor.wake(script_name, "http"), supervisor.loop).result(RECOVERY_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return jsonify(dict(proc.to_dict(), running=False, healthy=False, error="wake timed out")), 503
+    data = proc.to_dict() if proc else {"target": script_name, "state": "stopped", "pid": None, "uptime": 0, "restarts": 0,
+                                        "exit_code": None, "policy": restart_policy(script_name), "health": None}
+    data["running"] = proc is not None and proc.state == "running"
+    if woke is not None: data["woke_ms"] = round(woke * 1000, 1)
+    data["healthy"] = is_healthy(script_name) if data["running"] and health_config(script_name) else data["running"]
+    if not data["running"]: return jsonify(data), 404
+    return jsonify(data), 503 if data["health"] and data["health"]["status"] == "unhealthy" else 200
+
+def api_token_ok():
+    if not API_TOKEN: return True
+    auth = request.headers.get("Authorization", "")
+    return auth == f"Bearer {API_TOKEN}" or request.args.get("token") == API_TOKEN
+
+def link_sig(uid, exp):
+    return hmac.new(LINK_SECRET.encode(), f"{uid}:{exp}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def signed_query(uid):
+    # uid/exp/sig for links the bot hands to a user; request_uid() verifies them.
+    exp = int(time.time()) + LINK_TTL
+    return urllib.parse.urlencode({"uid": uid, "exp": exp, "sig": link_sig(uid, exp)})
+
+def request_uid():
+    # The uid of a signed bot link, or None. A bare ?uid= proves nothing about the caller.
+    try: uid, exp = int(request.args["uid"]), int(request.args["exp"])
+    except (KeyError, ValueError): return None
+    if exp < time.time() or not hmac.compare_digest(request.args.get("sig", ""), link_sig(uid, exp)): return None
+    return uid
+
+def can_read(target_id):
+    # The API_TOKEN holder, or the app's owner / the admin through a signed link.
+    if API_TOKEN and api_token_ok(): return True
+    uid = request_uid()
+    return uid is not None and (uid == ADMIN_ID or uid == get_owner(target_id))
+
+log_followers = threading.BoundedSemaphore(LOG_FOLLOWERS_MAX)
+
+def follow_response(open_stream):
+    # A follower holds an HTTP thread until the client leaves, so they are capped; the slot
+    # is released when the server closes the response.
+    if not log_followers.acquire(blocking=False): return "Too many log followers, try again later", 503
+    try: resp = Response(stream_with_context(open_stream()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    except BaseException:
+        log_followers.release()
+        raise
+    resp.call_on_close(log_followers.release)
+    return resp
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    if not webhook_state["active"]: return "Webhook disabled", 404
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET: return "Forbidden", 403
+    app_bot = webhook_state["app"]
+    update = Update.de_json(request.get_json(force=True), app_bot.bot)
+    asyncio.run_coroutine_threadsafe(app_bot.update_queue.put(update), webhook_state["loop"]).result(5)
+    return "", 200
+
+@app.route('/builds')
+def builds_status():
+    if not api_token_ok(): return jsonify({"error": "unauthorized"}), 401
+    return jsonify(build_queue.stats())
+
+@app.route('/logs')
+def logs_route():
+    target_id = request.args.get('id') or request.args.get('script')
+    if not target_id: return "Specify id", 400
+    if not can_read(target_id): return "⛔ Access Denied", 403
+    path = log_path_for(target_id)
+    try: lines = min(int(request.args.get('lines', LOG_TAIL_LINES)), 5000)
+    except ValueError: return "lines must be an integer", 400
+    follow = request.args.get('follow')
+    node = cluster.node_of(target_id)
+    if node:
+        agent = cluster.alive().get(node)
+        if not agent: return f"Node {node} is offline", 503
+        q = urllib.parse.urlencode({"target": target_id, "lines": lines, "follow": follow or ''})
+        if follow:
+            def relay():
+                resp = agent_request(agent["url"], f"/agent/logs?{q}", timeout=None, stream=True)
+                def chunks():
+                    with resp:
+                        for chunk in iter(lambda: resp.read1(4096), b""): yield chunk
+                return chunks()
+            return follow_response(relay)
+        return Response(agent_request(agent["url"], f"/agent/logs?{q}", timeout=30), mimetype="text/plain")
+    if follow: return follow_response(lambda: follow_log(path, lines))
+    if not os.path.exists(path): return "No logs", 404
+    return Response("\n".join(tail_lines(path, lines)) + "\n", mimetype="text/plain")
+
+@app.route('/api/bulk', methods=['POST'])
+def bulk_route():
+    # {"action": "restart", "crashed": true, "glob": "*.py", "concurrency": 4, "rolling": false, "batch": 1, "dry_run": false}
+    # Unlike the read-only endpoints this one is refused outright when no API_TOKEN is set.
+    if not API_TOKEN or not api_token_ok(): return jsonify({"error": "unauthorized"}), 403
+    body = request.get_json(silent=True) or {}
+    if body.get("action") not in BULK_ACTIONS: return jsonify({"error": f"action must be one of {', '.join(BULK_ACTIONS)}"}), 400
+    try:
+        targets = select_targets(owner=body.get("owner"), repo=body.get("repo"), glob=body.get("glob"), crashed=bool(body.get("crashed")),
+                                 every=bool(body.get("all")), targets=body.get("targets"))
+        concurrency, batch = int(body.get("concurrency", BULK_CONCURRENCY)), int(body.get("batch", 1))
+    except (ValueError, TypeError) as e: return jsonify({"error": str(e)}), 400
+    if body.get("dry_run"): return jsonify({"action": body["action"], "selected": len(targets), "targets": targets})
+    if not supervisor.loop: return jsonify({"error": "supervisor not ready"}), 503
+    job = start_bulk_job(body["action"], targets, concurrency, bool(body.get("rolling")), batch)
+    return jsonify(dict(job, status_url=f"/api/bulk/{job['id']}")), 202
+
+@app.route('/api/bulk/<int:job_id>')
+def bulk_status_route(job_id):
+    if not API_TOKEN or not api_token_ok(): return jsonify({"error": "unauthorized"}), 403
+    job = bulk_jobs.get(job_id)
+    if not job: return jsonify({"error": "unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/logs/search')
+def logs_search_route():
+    # ?q=ERROR&since=10m[&until=1m&app=bot*.py&limit=100]; q=/regex/ for a regular expression.
+    # The API_TOKEN holder searches every app; a signed link (see signed_query) only its uid's apps.
+    token = API_TOKEN and api_token_ok()
+    uid = None if token else request_uid()
+    if not token and uid is None: return jsonify({"error": "unauthorized"}), 403
+    try: params = search_params(request.args.get('q', ''), *(request.args.get(k) for k in ("since", "until", "app", "limit")))
+    except (ValueError, re.error) as e: return jsonify({"error": str(e)}), 400
+    return jsonify(dict(search_logs(uid, **params), query=params["query"], regex=params["regex"]))
+
+@app.route('/stats')
+def stats_route():
+    if not api_token_ok(): return jsonify({"error": "unauthorized"}), 401
+    script_name = request.args.get('script')
+    if script_name:
+        if script_name not in sampler.apps: return jsonify({"error": "no samples"}), 404
+        return jsonify(sampler.app_summary(script_name))
+    return jsonify(dict(sampler.summary(), recovery=supervisor.recovery, outbox=outbox.stats(), idle=idle_report(), log_store=log_store.stats()))
+
+@app.route('/agent/register', methods=['POST'])
+def agent_register_route():
+    if NODE_ROLE != "controller" or not agent_token_ok(): return jsonify({"error": "forbidden"}), 403
+    return jsonify({"ok": True, "drop": cluster.register(request.get_json(force=True))})
+
+@app.route('/agent/<action>', methods=['GET', 'POST'])
+def agent_route(action):
+    # Agent side of the controller's calls; all run on this node's supervisor loop.
+    if NODE_ROLE != "agent" or not agent_token_ok(): return jsonify({"error": "forbidden"}), 403
+    body = request.get_json(silent=True) or {}
+    target_id = body.get("target") or request.args.get("target")
+    run = lambda coro, timeout=60: asyncio.run_coroutine_threadsafe(coro, supervisor.loop).result(timeout)
+    if action == "deploy":
+        # Body: the workspace .tar.gz. The install runs on the loop; the controller polls deploy_status.
+        meta, archive = json.loads(request.args.get("meta") or "{}"), receive_archive(request.stream)
+        deploys[target_id] = {"target": target_id, "state": "installing", "started": time.time(), "error": None, "app": None}
+        supervisor.submit(run_deploy(target_id, meta, archive))
+        return jsonify(deploys[target_id]), 202
+    if action == "deploy_status": return jsonify(deploys.get(target_id) or {"target": target_id, "state": "failed", "error": "no deploy"})
+    if action == "stop":
+        app_proc = run(supervisor.stop(target_id))
+        return jsonify(app_proc.to_dict() if app_proc else {"target": target_id, "state": "stopped"})
+    if action == "remove":
+        run(agent_remove(target_id))
+        return jsonify({"target": target_id, "state": "removed"})
+    if action == "status":
+        app_proc, woke = supervisor.get(target_id), None
+        if app_proc and request.args.get("wake") and app_proc.state in ("frozen", "idle"):
+            try: woke = run(supervisor.wake(target_id, "http"), RECOVERY_TIMEOUT)
+            except concurrent.futures.TimeoutError: return jsonify(dict(app_proc.to_dict(), error="wake timed out")), 503
+        data = app_proc.to_dict() if app_proc else {"target": target_id, "state": "stopped"}
+        if woke is not None: data["woke_ms"] = round(woke * 1000, 1)
+        return jsonify(data)
+    if action == "idle":
+        registry.update(target_id, idle=body.get("idle"))
+        if not body.get("idle"): run(supervisor.wake(target_id, "manual"))
+        return jsonify({"target": target_id, "idle": idle_config(target_id)})
+    if action == "usage": return jsonify(app_usage(target_id))
+    if action == "search":
+        targets = set(body["targets"]) if body.get("targets") is not None else None
+        return jsonify(log_store.search(body["query"], targets, body.get("since"), body.get("until"), body.get("limit", LOG_SEARCH_LIMIT), body.get("regex")))
+    if action == "logs":
+        path = log_path_for(target_id)
+        try: lines = min(int(request.args.get('lines', LOG_TAIL_LINES)), 5000)
+        except ValueError: return jsonify({"error": "lines must be an integer"}), 400
+        if request.args.get('follow'):
+            return Response(stream_with_context(follow_log(path, lines)), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+        if not os.path.exists(path): return Response("", mimetype="text/plain")
+        if request.args.get('full') == "1":
+            with open(path, 'rb') as f: return Response(f.read(), mimetype="text/plain")
+        return Response("\n".join(tail_lines(path, lines)), mimetype="text/plain")
+    return jsonify({"error": "unknown action"}), 404
+
+@app.route('/disk')
+def disk_route():
+    if not api_token_ok(): return jsonify({"error": "unauthorized"}), 401
+    uid = request.args.get('uid')
+    return jsonify(disk_report(registry.targets_for(int(uid)) if uid else None))
+
+@app.route('/metrics')
+def metrics_route():
+    if not api_token_ok(): return "unauthorized", 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def profile_route():
+    if not api_token_ok(): return jsonify({"error": "unauthorized"}), 401
+    action = request.args.get('action')
+    if action == "start":
+        try: seconds, interval = float(request.args.get('seconds', 60)), float(request.args.get('interval', PROFILE_INTERVAL))
+        except ValueError: return jsonify({"error": "seconds and interval must be numbers"}), 400
+        if not (seconds > 0 and interval > 0): return jsonify({"error": "seconds and interval must be positive"}), 400
+        return jsonify(dict(profiler.status(), started=profiler.start(seconds, interval)))
+    if action == "stop": profiler.stop()
+    if action or request.args.get('format') == "json": return jsonify(dict(profiler.status(), top=profiler.top()))
+    return Response(profiler.folded(), mimetype="text/plain")
+
+# Editor files are served separately from the page: ETag = content hash, so reopening an
+# unchanged file is a 304, and saves are patches checked against that same hash.
+version_cache = {}  # path -> ((mtime_ns, size), version)
+editor_lock = threading.Lock()
+
+def content_version(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+def file_version(path):
+    try: st = os.stat(path)
+    except FileNotFoundError: return content_version(b"")
+    key = (st.st_mtime_ns, st.st_size)
+    cached = version_cache.get(path)
+    if cached and cached[0] == key: return cached[1]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(EDITOR_CHUNK), b""): h.update(chunk)
+    version_cache[path] = (key, h.hexdigest()[:20])
+    return version_cache[path][1]
+
+def editor_path(target_id, filename):
+    # The caller is checked with can_read: editor links carry the signed uid (see signed_query).
+    if not target_id or not filename or not can_read(target_id): raise PermissionError("⛔ Access Denied")
+    work_dir, _, _, _, _ = resolve_paths(target_id)
+    file_path = os.path.join(work_dir, filename)
+    if not os.path.abspath(file_path).startswith(os.path.abspath(work_dir)): raise PermissionError("⛔ Security Block.")
+    return work_dir, file_path
+
+def stream_file(path, compress):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: gzip framing
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(EDITOR_CHUNK), b""):
+            if not z: yield chunk
+            elif (out := z.compress(chunk)): yield out
+    if z: yield z.flush()
+
+def apply_patch(text, patch):
+    # Hunks are [start, end, replacement] in UTF-16 code units, which is how JS indexes strings.
+    buf, limit = text.encode("utf-16-le", "surrogatepass"), None
+    for start, end, repl in sorted(patch, key=lambda h: h[0], reverse=True):
+        if not 0 <= start <= end <= len(buf) // 2 or (limit is not None and end > limit): raise ValueError("Patch does not apply")
+        buf, limit = buf[:start * 2] + repl.encode("utf-16-le", "surrogatepass") + buf[end * 2:], start
+    return buf.decode("utf-16-le", "surrogatepass")
 
 @app.route('/editor')
 def editor_page():
     target_id = request.args.get('id')
     filename = request.args.get('file')
-    uid = int(request.args.get('uid', 0))
-    
-    owner = get_owner(target_id)
-    if uid != ADMIN_ID and uid != owner: return "⛔ Access Denied"
-    
-    work_dir, _, _, _, _ = resolve_paths(target_id)
-    file_path = os.path.join(work_dir, filename)
-    
-    if not os.path.abspath(file_path).startswith(os.path.abspath(work_dir)):
-        return "⛔ Security Block."
+    try: _, file_path = editor_path(target_id, filename)
+    except PermissionError as e: return str(e), 403
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    auth = urllib.parse.urlencode({k: request.args[k] for k in ("uid", "exp", "sig") if k in request.args})
+    file_url = "/editor/file?" + urllib.parse.urlencode({"id": target_id, "file": filename}) + "&" + auth
+    return render_template_string(EDITOR_HTML, target_id=target_id, filename=filename, auth=auth, file_url=file_url,
+                                  readonly=size > EDITOR_MAX_BYTES, size_kb=size // 1024)
 
-    content = ""
-    if os.path.exists(file_path):
-        with open(file_path, 'r') as f: content = f.read()
-    
-    return render_template_string(EDITOR_HTML, code=content, target_id=target_id, filename=filename)
+@app.route('/editor/file')
+def editor_file():
+    try: _, file_path = editor_path(request.args.get('id'), request.args.get('file'))
+    except PermissionError as e: return str(e), 403
+    compress = "gzip" in request.headers.get("Accept-Encoding", "")
+    headers = {"Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if not os.path.exists(file_path) or os.path.getsize(file_path) <= EDITOR_MAX_BYTES:
+        data = b""
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as f: data = f.read()
+        headers["ETag"] = f'"{content_version(data)}"'
+        if request.if_none_match.contains_weak(content_version(data)): return Response(status=304, headers=headers)
+        if compress and len(data) > 1024: data, headers["Content-Encoding"] = gzip.compress(data, 6), "gzip"
+        return Response(data, mimetype="text/plain", headers=headers)
+    version = file_version(file_path)
+    headers["ETag"] = f'"{version}"'
+    if request.if_none_match.contains_weak(version): return Response(status=304, headers=headers)
+    if compress: headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(stream_file(file_path, compress)), mimetype="text/plain", headers=headers)
 
 @app.route('/save_code', methods=['POST'])
 def save_code_route():
     data = request.json
     target_id = data.get('target_id')
     filename = data.get('filename')
-    code = data.get('code')
-    
-    work_dir, _, _, _, _ = resolve_paths(target_id)
-    file_path = os.path.join(work_dir, filename)
 
     try:
-        with open(file_path, 'w') as f: f.write(code)
+        work_dir, file_path = editor_path(target_id, filename)
+        with editor_lock:
+            old = b""
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as f: old = f.read()
+            # `base` is the version the client started from; a mismatch means someone else saved meanwhile.
+            if data.get('base') and data['base'] != content_version(old):
+                return jsonify({"status": "conflict", "version": content_version(old)}), 409
+            # The browser's .text() drops a UTF-8 BOM, so patch offsets and whole-body saves come
+            # without it; they apply to the text after the BOM and the file keeps its BOM.
+            bom = b"\xef\xbb\xbf" if old.startswith(b"\xef\xbb\xbf") else b""
+            code = apply_patch(old[len(bom):].decode(), data['patch']) if 'patch' in data else data.get('code').removeprefix("\ufeff")
+            new = bom + code.encode()
+            check_quota(get_owner(target_id), max(0, len(new) - len(old)))
+            restore = file_restorer(file_path)
+            with open(file_path, 'wb') as f: f.write(new)
+        invalidate_usage(file_path, work_dir)
+        version = content_version(new)
         
         # --- FIX: Smart Install for Edited Files ---
-        # Checks for .txt (reqs) or package.json AND runs install
+        # Checks for .txt (reqs) or package.json AND queues the install before restarting
+        owner = get_owner(target_id)
+        async def reload():
+            # The response has gone out before the build finishes, so the result goes to the owner.
+            try: ok, detail = await supervisor.reload(target_id, restore)
+            except Exception as e: ok, detail = False, f"reload failed: {e}"
+            if supervisor.bot and owner:
+                try: await outbox.send(supervisor.bot, owner, f"{'♻️' if ok else '⚠️'} {target_id} ({filename} saved): {detail}")
+                except Exception as e: logger.warning(f"Reload report not sent: {e}")
+        restart = lambda: supervisor.submit(reload())
+        async def rebuild(install=None):
+            if install: await install
+            await prepare_app(target_id)
         if filename.endswith(".txt") or filename == "requirements.txt":
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", file_path])
+            build_queue.submit_threadsafe(rebuild, ensure_python_deps(file_path, work_dir), then=restart)
+            return jsonify({"status": "success", "version": version, "queued": build_queue.depth() + 1})
         elif filename == "package.json":
-            subprocess.check_call(["npm", "install"], cwd=work_dir)
-        
-        restart_process_background(target_id)
-        return jsonify({"status": "success"})
+            build_queue.submit_threadsafe(rebuild, ensure_node_deps(work_dir), then=restart)
+            return jsonify({"status": "success", "version": version, "queued": build_queue.depth() + 1})
+        build_queue.submit_threadsafe(rebuild, then=restart)
+        return jsonify({"status": "success", "version": version})
+    except PermissionError as e:
+        return jsonify({"status": "error", "message": str(e)}), 403
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)})
 
-def resolve_run_command(script_path):
+def resolve_run_command(script_path, python="python"):
     ext = script_path.split('.')[-1].lower()
     if ext == 'js': return ["node", script_path]
     if ext == 'sh': return ["bash", script_path]
-    return ["python", "-u", script_path] 
+    return [python, "-u", script_path] 
 
-def restart_process_background(target_id):
+def build_launch_spec(target_id):
     work_dir, script_path, env_path, _, _ = resolve_paths(target_id)
-    if target_id in running_processes:
-        try: os.killpg(os.getpgid(running_processes[target_id]['process'].pid), signal.SIGTERM)
-        except: pass
-    
     custom_env = os.environ.copy()
     if os.path.exists(env_path):
         with open(env_path) as f:
@@ -181,65 +625,2814 @@ def restart_process_background(target_id):
                     k,v = l.strip().split('=', 1)
                     custom_env[k.strip()] = v.strip().strip('"').strip("'")
     
-    log_path = os.path.join(UPLOAD_DIR, f"{target_id.replace('|','_')}.log")
-    log_file = open(log_path, "w")
+    venv = python_env_for(target_id)
+    if venv:
+        custom_env["VIRTUAL_ENV"] = venv
+        custom_env["PATH"] = os.path.join(venv, "bin") + os.pathsep + custom_env.get("PATH", "")
     
-    cmd = resolve_run_command(script_path)
+    log_path = log_path_for(target_id)
+    cmd = resolve_run_command(script_path, os.path.join(venv, "bin", "python") if venv else "python")
+    return cmd, work_dir, custom_env, log_path
+
+def restart_process_background(target_id):
+    # Sync entry point (Flask thread, build callbacks); the supervisor does the work on the bot loop.
+    return supervisor.submit(supervisor.start(target_id))
+
+def http_server():
+    # Flask runs behind uvicorn on the bot's event loop; WSGI calls are dispatched to a
+    # pool of HTTP_THREADS threads, so HTTP and Telegram handlers never block each other.
+    config = uvicorn.Config(WSGIMiddleware(app, workers=HTTP_THREADS), host="0.0.0.0", port=PORT, lifespan="off", log_level="warning",
+                            limit_concurrency=HTTP_MAX_CONNECTIONS, timeout_keep_alive=HTTP_KEEPALIVE,
+                            timeout_graceful_shutdown=HTTP_GRACEFUL_TIMEOUT)
+    return uvicorn.Server(config)
+
+webhook_state = {"active": False, "app": None, "loop": None}
+
+def use_webhook():
+    if BOT_MODE == "polling": return False
+    if not PUBLIC_URL:
+        if BOT_MODE == "webhook": logger.warning("BOT_MODE=webhook but RENDER_EXTERNAL_URL is not set; falling back to polling")
+        return False
+    return True
+
+async def serve(app_bot):
+    # Webhook updates arrive on the HTTP server and go straight into the Application's
+    # update queue; without a public URL the bot long-polls instead.
+    server = http_server()
+    # uvicorn re-raises the signal it caught once serve() returns; route it to should_exit
+    # instead so the bot and the supervised apps get their graceful shutdown below.
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, lambda *_: setattr(server, "should_exit", True))
+    async with app_bot:
+        await on_startup(app_bot)
+        await app_bot.start()
+        if use_webhook():
+            webhook_state.update(app=app_bot, loop=asyncio.get_running_loop(), active=True)
+            await app_bot.bot.set_webhook(f"{PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                          max_connections=UPDATE_CONCURRENCY, allowed_updates=Update.ALL_TYPES)
+            print(f"Bot is up and running! (webhook {WEBHOOK_PATH})")
+        else:
+            await app_bot.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            print("Bot is up and running! (polling)")
+        try: await server.serve()
+        finally:
+            webhook_state["active"] = False
+            if app_bot.updater.running: await app_bot.updater.stop()
+            await app_bot.stop()
+            await on_shutdown(app_bot)
+            print("Bot stopped.")
+
+# --- REGISTRY ---
+def atomic_write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_json(path, default):
+    if not os.path.exists(path): return default
+    try:
+        with open(path, 'r') as f: return json.load(f)
+    except: return default
+
+class Registry:
+    # Loaded once, served from memory, flushed to disk in batches (temp file + rename).
+    def __init__(self, ownership_file, users_file, flush_interval=REGISTRY_FLUSH_INTERVAL):
+        self.ownership_file, self.users_file = ownership_file, users_file
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.io_lock = threading.Lock()
+        self.ownership = read_json(ownership_file, {})
+        self.users = set(read_json(users_file, []))
+        self.by_owner = {}
+        for tid, meta in self.ownership.items(): self.by_owner.setdefault(meta.get("owner"), set()).add(tid)
+        self.dirty = set()
+        self.wake = threading.Event()
+        threading.Thread(target=self._flusher, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _mark(self, name):
+        self.dirty.add(name)
+        self.wake.set()
+
+    def _flusher(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.flush_interval)
+            self.wake.clear()
+            try: self.flush()
+            except Exception as e: logger.error(f"Registry flush failed: {e}")
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+                ownership = dict(self.ownership) if "ownership" in dirty else None
+                users = sorted(self.users) if "users" in dirty else None
+            if ownership is not None: atomic_write_json(self.ownership_file, ownership)
+            if users is not None: atomic_write_json(self.users_file, users)
+
+    # Users
+    def is_allowed(self, uid):
+        return uid in self.users
+
+    def add_user(self, uid):
+        with self.lock:
+            if uid in self.users: return False
+            self.users.add(uid)
+            self._mark("users")
+            return True
+
+    def remove_user(self, uid):
+        with self.lock:
+            if uid not in self.users: return False
+            self.users.discard(uid)
+            self._mark("users")
+            return True
+
+    # Ownership
+    def get(self, target_id):
+        return self.ownership.get(target_id)
+
+    def owner(self, target_id):
+        return self.ownership.get(target_id, {}).get("owner")
+
+    def targets_for(self, uid):
+        with self.lock:
+            if uid == ADMIN_ID: return sorted(self.ownership)
+            return sorted(self.by_owner.get(uid, ()))
+
+    def set_owner(self, target_id, user_id, type_):
+        with self.lock:
+            meta = dict(self.ownership.get(target_id, {}))
+            prev = meta.get("owner")
+            if prev is not None and prev != user_id: self.by_owner.get(prev, set()).discard(target_id)
+            meta.update({"owner": user_id, "type": type_})
+            self.ownership[target_id] = meta
+            self.by_owner.setdefault(user_id, set()).add(target_id)
+            self._mark("ownership")
+
+    def update(self, target_id, **fields):
+        with self.lock:
+            if target_id not in self.ownership: return False
+            meta = dict(self.ownership[target_id])
+            meta.update(fields)
+            self.ownership[target_id] = meta
+            self._mark("ownership")
+            return True
+
+    def delete(self, target_id):
+        with self.lock:
+            meta = self.ownership.pop(target_id, None)
+            if meta is None: return
+            self.by_owner.get(meta.get("owner"), set()).discard(target_id)
+            self._mark("ownership")
+
+registry = Registry(OWNERSHIP_FILE, USERS_FILE)
+
+# --- METRICS ---
+# Counters and histograms are updated on the hot paths; gauges are read at scrape time.
+# Everything is rendered in the Prometheus text exposition format at /metrics.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+METRIC_HELP = {
+    "bothost_handler_seconds": ("histogram", "Telegram handler duration."),
+    "bothost_handler_errors_total": ("counter", "Telegram handlers that raised."),
+    "bothost_build_seconds": ("histogram", "Build queue job duration (clone, fetch, install)."),
+    "bothost_install_seconds": ("histogram", "install_dependencies duration."),
+    "bothost_spawn_seconds": ("histogram", "Time to launch an app process."),
+    "bothost_restarts_total": ("counter", "Automatic and manual app restarts."),
+    "bothost_crashes_total": ("counter", "App exits with a non-zero status."),
+    "bothost_health_failures_total": ("counter", "Failed health probes."),
+    "bothost_wake_seconds": ("histogram", "Time to resume a suspended app."),
+    "bothost_first_log_seconds": ("histogram", "Time from launching an app to its first line of output."),
+    "bothost_log_search_seconds": ("histogram", "Log store query duration."),
+    "bothost_bulk_actions_total": ("counter", "Per-app results of bulk actions."),
+    "bothost_telegram_requests_total": ("counter", "Outbound Telegram requests by outcome."),
+    "bothost_apps": ("gauge", "Supervised apps by state."),
+    "bothost_app_rss_bytes": ("gauge", "Resident memory of an app's process tree."),
+    "bothost_app_cpu_percent": ("gauge", "CPU usage of an app's process tree."),
+    "bothost_build_queue_depth": ("gauge", "Build jobs waiting for a slot."),
+    "bothost_outbox_queued": ("gauge", "Outbound Telegram messages waiting to be sent."),
+    "bothost_process_rss_bytes": ("gauge", "Resident memory of the host process."),
+}
+
+def fmt_metric_labels(labels):
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None: h = self.histograms[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound: h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - start, **labels)
+
+    def collector(self, fn):
+        # fn() -> [(name, {labels}, value)], evaluated on every scrape.
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        series = {}
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn(): series.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e: logger.error(f"Metrics collector {fn.__name__} failed: {e}")
+        with self.lock:
+            for (name, labels), value in self.counters.items(): series.setdefault(name, []).append((labels, value))
+            hists = {k: list(v) for k, v in self.histograms.items()}
+        for (name, labels), h in hists.items(): series.setdefault(name, []).append((labels, h))
+        lines = []
+        for name in sorted(series):
+            kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in series[name]:
+                if kind != "histogram":
+                    lines.append(f"{name}{fmt_metric_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(METRIC_BUCKETS, value):
+                    lines.append(f"{name}_bucket{fmt_metric_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{fmt_metric_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{fmt_metric_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{fmt_metric_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@metrics.collector
+def runtime_gauges():
+    out = [("bothost_apps", {"state": k}, v) for k, v in supervisor.states().items()]
+    for tid, buf in list(sampler.apps.items()):
+        if not buf: continue
+        current = buf[-1][1]
+        out.append(("bothost_app_rss_bytes", {"target": tid}, int(current["rss_mb"] * 2**20)))
+        out.append(("bothost_app_cpu_percent", {"target": tid}, current["cpu"]))
+    out.append(("bothost_build_queue_depth", {}, build_queue.depth()))
+    o = outbox.stats()
+    out.append(("bothost_outbox_queued", {}, o["queued"]))
+    out += [("bothost_telegram_requests_total", {"outcome": k}, o[k]) for k in ("sent", "coalesced", "retries", "flood_waits", "failed")]
+    out.append(("bothost_process_rss_bytes", {}, psutil.Process().memory_info().rss))
+    return out
+
+def timed_handler(func):
+    if getattr(func, "instrumented", False): return func
+    @functools.wraps(func)
+    async def wrapped(update, context):
+        start = time.perf_counter()
+        try: return await func(update, context)
+        except Exception:
+            metrics.inc("bothost_handler_errors_total", handler=func.__name__)
+            raise
+        finally: metrics.observe("bothost_handler_seconds", time.perf_counter() - start, handler=func.__name__)
+    wrapped.instrumented = True
+    return wrapped
+
+def instrument_handlers(handlers):
+    for h in handlers:
+        if isinstance(h, ConversationHandler):
+            instrument_handlers(h.entry_points)
+            instrument_handlers(h.fallbacks)
+            for state_handlers in h.states.values(): instrument_handlers(state_handlers)
+        else: h.callback = timed_handler(h.callback)
+
+# --- PROFILER ---
+# Optional sampling profiler for the host process: a thread snapshots every other
+# thread's stack each PROFILE_INTERVAL and counts folded stacks (flamegraph input).
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.started_at = self.stopped_at = None
+        self.run_id = 0  # a sampler thread exits once a newer run has started
+
+    def start(self, seconds=60, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.running: return False
+            self.stacks, self.samples, self.running = {}, 0, True
+            self.started_at, self.stopped_at = time.time(), None
+            self.run_id += 1
+            deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            threading.Thread(target=self._run, args=(interval, deadline, self.run_id), daemon=True, name="profiler").start()
+        return True
+
+    def stop(self):
+        with self.lock:
+            was, self.running = self.running, False
+        return was
+
+    def _run(self, interval, deadline, run_id):
+        me = threading.get_ident()
+        names = {}
+        while self.running and self.run_id == run_id and time.monotonic() < deadline:
+            if len(names) != threading.active_count(): names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+                with self.lock: self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(interval)
+        with self.lock:
+            if self.run_id == run_id: self.running, self.stopped_at = False, time.time()
+
+    def folded(self):
+        with self.lock: items = sorted(self.stacks.items(), key=lambda kv: -kv[1])
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def top(self, n=10):
+        # Leaf frames by sample count (threads idling in select/sleep show up here too).
+        leaves = {}
+        with self.lock:
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+        return sorted(leaves.items(), key=lambda kv: -kv[1])[:n]
+
+    def status(self):
+        return {"running": self.running, "samples": self.samples, "stacks": len(self.stacks),
+                "started_at": self.started_at, "stopped_at": self.stopped_at}
+
+profiler = Profiler()
+
+# --- OUTBOX ---
+# Deploy progress and notifications go through one queue paced by a global and a per-chat
+# token bucket. Pending edits of the same message are coalesced so only the latest text is
+# sent, each chat is served in order, and flood-waits (429) are honoured and retried.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = burst, time.monotonic()
+
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def penalize(self, seconds):
+        self.wait_time()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class OutJob:
+    def __init__(self, chat_id, call, key):
+        self.chat_id, self.call, self.key = chat_id, call, key
+        self.futures = []
+        self.enqueued = time.monotonic()
+
+class Outbox:
+    def __init__(self):
+        self.pending = deque()
+        self.by_key = {}
+        self.inflight = set()
+        self.chats = {}
+        self.bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.wake = self.worker = None
+        self.latency = deque(maxlen=500)
+        self.counters = {"sent": 0, "coalesced": 0, "retries": 0, "flood_waits": 0, "failed": 0}
+
+    def submit(self, chat_id, call, key=None):
+        # call: zero-arg coroutine function doing the API request. Returns a future with its result.
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        job = self.by_key.get(key) if key else None
+        if job:
+            job.call = call
+            self.counters["coalesced"] += 1
+        else:
+            job = OutJob(chat_id, call, key)
+            self.pending.append(job)
+            if key: self.by_key[key] = job
+        job.futures.append(fut)
+        if not self.worker:
+            self.wake = asyncio.Event()
+            self.worker = loop.create_task(self._run())
+        self.wake.set()
+        return fut
+
+    async def reply(self, message, text, **kwargs):
+        return await self.submit(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+    def edit(self, message, text, **kwargs):
+        return self.submit(message.chat_id, lambda: message.edit_text(text, **kwargs), key=(message.chat_id, message.message_id))
+
+    def send(self, bot, chat_id, text, **kwargs):
+        return self.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs))
+
+    def _chat(self, chat_id):
+        b = self.chats.get(chat_id)
+        if b is None: b = self.chats[chat_id] = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+        return b
+
+    def _next(self):
+        delay = self.bucket.wait_time()
+        if delay: return None, delay
+        seen, delay = set(), 1.0
+        for job in self.pending:
+            if job.chat_id in seen or job.chat_id in self.inflight: continue
+            seen.add(job.chat_id)
+            d = self._chat(job.chat_id).wait_time()
+            if d == 0: return job, 0
+            delay = min(delay, d)
+        return None, delay
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+            job, delay = self._next()
+            if not job:
+                self.wake.clear()
+                try: await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+                continue
+            self.pending.remove(job)
+            if job.key and self.by_key.get(job.key) is job: del self.by_key[job.key]
+            self.bucket.take()
+            self._chat(job.chat_id).take()
+            self.inflight.add(job.chat_id)
+            self.latency.append(time.monotonic() - job.enqueued)
+            asyncio.get_running_loop().create_task(self._execute(job))
+
+    async def _execute(self, job):
+        result, error = None, None
+        try:
+            for attempt in range(TG_MAX_RETRIES + 1):
+                try:
+                    result, error = await job.call(), None
+                    self.counters["sent"] += 1
+                    break
+                except RetryAfter as e:
+                    wait = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                    self.counters["flood_waits"] += 1
+                    self._chat(job.chat_id).penalize(wait)
+                    error = e
+                    await asyncio.sleep(wait)
+                except BadRequest as e:
+                    # Edits that would not change the text are harmless.
+                    if "not modified" not in str(e).lower(): error = e
+                    break
+                except NetworkError as e:
+                    self.counters["retries"] += 1
+                    error = e
+                    await asyncio.sleep(min(30, 2 ** attempt))
+        except Exception as e: error = e
+        finally:
+            self.inflight.discard(job.chat_id)
+            if self.wake: self.wake.set()
+        if error:
+            self.counters["failed"] += 1
+            logger.warning(f"Outbound message to {job.chat_id} failed: {error}")
+        for fut in job.futures:
+            if fut.done(): continue
+            # Edits are fire-and-forget progress updates; only plain sends surface errors.
+            if error and not job.key: fut.set_exception(error)
+            else: fut.set_result(result)
+
+    def stats(self):
+        lat = sorted(self.latency)
+        pct = lambda q: round(lat[min(len(lat) - 1, int(q * (len(lat) - 1)))] * 1000, 1) if lat else None
+        return dict(self.counters, queued=len(self.pending), inflight=len(self.inflight), latency_ms={"p50": pct(0.5), "p95": pct(0.95)})
+
+outbox = Outbox()
+
+# --- BUILD QUEUE ---
+class BuildJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, target):
+        self.id = next(self._ids)
+        self.kind, self.target = kind, target
+        self.state = "queued"
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = self.finished_at = None
+
+    def to_dict(self):
+        wait = (self.started_at or time.time()) - self.queued_at
+        run = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return {"id": self.id, "kind": self.kind, "target": self.target, "state": self.state,
+                "wait_s": round(wait, 2), "run_s": round(run, 2), "error": self.error}
+
+class BuildQueue:
+    # Clones and installs run here so at most BUILD_CONCURRENCY of them hit the box at once.
+    def __init__(self, concurrency=BUILD_CONCURRENCY, timeout=BUILD_TIMEOUT):
+        self.concurrency, self.timeout = concurrency, timeout
+        self.loop = self.sem = None
+        self.active = {}
+        self.history = deque(maxlen=100)
+
+    def bind(self, loop):
+        self.loop = loop
+        self.sem = asyncio.Semaphore(self.concurrency)
+
+    def depth(self):
+        return sum(1 for j in self.active.values() if j.state == "queued")
+
+    def stats(self):
+        return {"concurrency": self.concurrency, "queued": self.depth(),
+                "running": sum(1 for j in self.active.values() if j.state == "running"),
+                "active": [j.to_dict() for j in self.active.values()],
+                "recent": [j.to_dict() for j in reversed(self.history)]}
+
+    async def run(self, kind, target, steps, progress=None, job=None):
+        # steps: [(label, argv, cwd)]; raises RuntimeError on the first failing step.
+        job = job or BuildJob(kind, target)
+        self.active[job.id] = job
+        try:
+            if progress and self.sem.locked(): await progress(f"⏳ Queued ({self.depth()} waiting)...")
+            async with self.sem:
+                job.state, job.started_at = "running", time.time()
+                for label, argv, cwd in steps:
+                    if progress: await progress(f"⏳ {label}...")
+                    await self._exec(label, argv, cwd, progress)
+                job.state = "done"
+            return job
+        except Exception as e:
+            job.state, job.error = "failed", str(e)
+            raise
+        finally:
+            job.finished_at = time.time()
+            if job.started_at: metrics.observe("bothost_build_seconds", job.finished_at - job.started_at, kind=kind, result=job.state)
+            self.active.pop(job.id, None)
+            self.history.append(job)
+            logger.info(f"Build #{job.id} {kind} {target}: {job.state} {job.to_dict()}")
+
+    def submit_threadsafe(self, fn, *args, then=None):
+        # For callers outside the bot loop (Flask): schedules fn(*args) there, then() on success.
+        if not self.loop: raise RuntimeError("Bot loop not ready")
+        async def runner():
+            try: await fn(*args)
+            except Exception as e: return logger.error(f"Build {fn.__name__}{args} failed: {e}")
+            if then: then()
+        return asyncio.run_coroutine_threadsafe(runner(), self.loop)
+
+    async def _exec(self, label, argv, cwd, progress):
+        proc = await asyncio.create_subprocess_exec(*argv, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        tail = deque(maxlen=20)
+        async def pump():
+            buf, last = b"", 0
+            while True:
+                chunk = await proc.stdout.read(4096)
+                if not chunk: break
+                *lines, buf = re.split(rb"[\r\n]", buf + chunk)
+                lines = [l.decode(errors="replace").strip() for l in lines if l.strip()]
+                tail.extend(lines)
+                if progress and lines and time.time() - last > 3:
+                    last = time.time()
+                    await progress(f"⏳ {label}...\n`{lines[-1][:200]}`")
+            if buf.strip(): tail.append(buf.decode(errors="replace").strip())
+        try:
+            await asyncio.wait_for(asyncio.gather(pump(), proc.wait()), self.timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise RuntimeError(f"{label} timed out after {int(self.timeout)}s")
+        if proc.returncode != 0:
+            raise RuntimeError(f"{label} failed ({proc.returncode}): " + "\n".join(list(tail)[-5:]))
+
+build_queue = BuildQueue()
+
+def message_progress(msg):
+    async def progress(text):
+        outbox.edit(msg, text, parse_mode="Markdown")
+    return progress
+
+def git_clone_step(url, repo_path):
+    return ("Cloning", ["git", "clone", "--progress", "--depth", "1", "--single-branch", url, repo_path], None)
+
+# --- BUILD ARTIFACTS ---
+# Post-install stage for Python apps. A repo workspace is compiled to bytecode with
+# checked-hash invalidation, so the .pyc files stay valid when a checkout or shipped tarball
+# changes mtimes (venvs need nothing: pip compiles what it installs). The entry script's
+# library imports are timed once with -X importtime. The app's sources are hashed and an
+# unchanged app is skipped; timings are cached in ARTIFACT_DIR per (interpreter, import list)
+# and shared between apps. (A single-file app runs as __main__, which Python never caches.)
+COMPILE_WORKSPACE = ("import compileall, py_compile, re, sys; compileall.compile_dir(sys.argv[1], quiet=2, workers=0, rx=re.compile(sys.argv[2]),"
+                     " invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)")
+prepare_locks = {}
+
+def python_sources(target_id):
+    work_dir, _, _, _, full_script_path = resolve_paths(target_id)
+    if "|" not in target_id: return [full_script_path]
+    found = []
+    for root, dirs, files in os.walk(work_dir):
+        dirs[:] = sorted(d for d in dirs if d not in PRUNE_DIRS)
+        found += [os.path.join(root, f) for f in sorted(files) if f.endswith(".py")]
+    return found
+
+def sources_hash(target_id, venv):
+    h = hashlib.sha256(f"{sys.version}\n{venv}\n".encode())
+    for path in python_sources(target_id):
+        with open(path, "rb") as f: h.update(path.encode() + b"\0" + hashlib.sha256(f.read()).digest())
+    return h.hexdigest()[:16]
+
+def startup_imports(script_path, search_dirs):
+    # Top-level library imports of the entry script. Local modules are skipped: importing
+    # them outside the app could run its side effects (like starting the bot).
+    try:
+        with open(script_path, "rb") as f: tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError): return []
+    names, stack = set(), list(tree.body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Import): names.update(a.name.split(".")[0] for a in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if not node.level and node.module: names.add(node.module.split(".")[0])
+        elif not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)): stack.extend(ast.iter_child_nodes(node))
+    local = lambda n: any(os.path.exists(os.path.join(d, n + ".py")) or os.path.isdir(os.path.join(d, n)) for d in search_dirs)
+    return sorted(n for n in names if n != "__future__" and not local(n))
+
+def importtime_script(names, out):
+    # stderr is pointed at `out` first so only the app's imports are recorded.
+    lines = ["import os, signal", f"os.dup2(os.open({out!r}, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644), 2)",
+             f"signal.alarm({PREPARE_TIMEOUT})"]
+    return "\n".join(lines + [f"try: import {n}\nexcept BaseException: pass" for n in names])
+
+def parse_importtime(path):
+    rows = []
+    with open(path, errors="replace") as f:
+        for line in f:
+            if not line.startswith("import time:") or line.count("|") != 2: continue
+            _, cumulative, name = line[12:].split("|")
+            if cumulative.strip().isdigit(): rows.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative)))
+    top = min((r[0] for r in rows), default=0)
+    roots = sorted(((n, us) for depth, n, us in rows if depth == top), key=lambda r: -r[1])
+    return {"total_ms": round(sum(us for _, us in roots) / 1000, 1), "slowest": [[n, round(us / 1000, 1)] for n, us in roots[:5]]}
+
+async def prepare_app(target_id, progress=None):
+    # Never raises: a failed preparation only costs the cold-start speedup.
+    work_dir, _, _, _, full_script_path = resolve_paths(target_id)
+    if not full_script_path.endswith(".py") or not os.path.exists(full_script_path): return None
+    async with prepare_locks.setdefault(target_id, asyncio.Lock()):
+        venv = python_env_for(target_id)
+        python = os.path.join(venv, "bin", "python") if venv else sys.executable
+        key = await asyncio.to_thread(sources_hash, target_id, venv)
+        build = (registry.get(target_id) or {}).get("build") or {}
+        if build.get("key") == key and not build.get("error"): return "cached"
+        names = startup_imports(full_script_path, {work_dir, os.path.dirname(full_script_path)})
+        imports_key = "imports-" + hashlib.sha256(f"{python}\n{sys.version}\n{names}".encode()).hexdigest()[:16]
+        cache = os.path.join(ARTIFACT_DIR, imports_key + ".json")
+        out = os.path.join(ARTIFACT_DIR, f"{imports_key}.{re.sub(r'[^A-Za-z0-9_.-]', '_', target_id)}.{os.getpid()}.log")
+        steps = []
+        if "|" in target_id:
+            prune = "/(" + "|".join(re.escape(d) for d in sorted(PRUNE_DIRS)) + ")/"
+            steps.append(("Compiling bytecode", [python, "-c", COMPILE_WORKSPACE, work_dir, prune], None))
+        if names and not os.path.exists(cache): steps.append(("Timing imports", [python, "-X", "importtime", "-c", importtime_script(names, out)], work_dir))
+        record, t0 = {"key": key, "prepared_at": time.time(), "import_ms": None, "slowest": [], "error": None}, time.perf_counter()
+        try:
+            os.makedirs(ARTIFACT_DIR, exist_ok=True)
+            if steps: await build_queue.run("prepare", target_id, steps, progress=progress)
+            if names and not os.path.exists(cache): atomic_write_json(cache, dict(parse_importtime(out), modules=names))
+            if names:
+                timing = read_json(cache, {})
+                record.update(import_ms=timing.get("total_ms"), slowest=timing.get("slowest", []))
+        except Exception as e:
+            record["error"] = str(e)[-300:]
+            logger.warning(f"Preparing {target_id} failed: {e}")
+        finally:
+            with contextlib.suppress(OSError): os.remove(out)
+        record["seconds"] = round(time.perf_counter() - t0, 2)
+        registry.update(target_id, build=record)
+        return "failed" if record["error"] else "built"
+
+def fmt_build(build):
+    if build.get("error"): return f"build failed: {build['error'][:80]}"
+    text = f"prepared in {build.get('seconds', 0)}s"
+    if build.get("import_ms") is not None: text += f", imports {build['import_ms']:.0f} ms"
+    if build.get("slowest"): text += " (" + ", ".join(f"{n} {ms:.0f}" for n, ms in build["slowest"][:3]) + ")"
+    return text
+
+# --- DEPENDENCY STORE ---
+# Venvs and node_modules are built once per normalized manifest hash under DEPS_STORE
+# and shared by every workspace with the same dependencies.
+REQ_NAME_RE = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?\s*(.*)$")
+LOCAL_REF_RE = re.compile(r"^(-e\s|\.|/)|file:")
+dep_locks = {}
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try: total += os.lstat(os.path.join(root, f)).st_size
+            except OSError: pass
+    return total
+
+def normalize_requirements(path, seen=None):
+    seen = seen or set()
+    if path in seen or not os.path.exists(path): return []
+    seen.add(path)
+    lines = []
+    with open(path) as f:
+        for l in f:
+            l = l.split(" #")[0].strip()
+            if not l or l.startswith("#"): continue
+            if l.startswith(("-r ", "-c ")):
+                lines += normalize_requirements(os.path.join(os.path.dirname(path), l[3:].strip()), seen)
+                continue
+            m = REQ_NAME_RE.match(l)
+            if m and not LOCAL_REF_RE.search(l):
+                l = re.sub(r"[-_.]+", "-", m.group(1)).lower() + (m.group(2) or "").lower() + m.group(3).replace(" ", "")
+            lines.append(l)
+    return sorted(set(lines))
+
+def python_deps_key(req_path, work_dir):
+    lines = normalize_requirements(req_path)
+    h = hashlib.sha256(f"{sys.version_info[:2]}\n".encode() + "\n".join(lines).encode())
+    # Local references (-e ., file:) resolve against the workspace, so they can't be shared.
+    if any(LOCAL_REF_RE.search(l) for l in lines): h.update(os.path.abspath(work_dir).encode())
+    return "py-" + h.hexdigest()[:16]
+
+def node_deps_key(work_dir):
+    h = hashlib.sha256()
+    for name in ("package.json", "package-lock.json"):
+        p = os.path.join(work_dir, name)
+        if os.path.exists(p):
+            with open(p, "rb") as f: h.update(name.encode() + b"\0" + f.read())
+    return "node-" + h.hexdigest()[:16]
+
+def deps_ready(key):
+    return os.path.exists(os.path.join(DEPS_STORE, key, ".ready"))
+
+def touch_deps(key):
+    try: os.utime(os.path.join(DEPS_STORE, key, ".ready"))
+    except OSError: pass
+
+def mark_deps_ready(key):
+    path = os.path.join(DEPS_STORE, key)
+    with open(os.path.join(path, ".ready"), "w") as f: json.dump({"size": dir_size(path), "built": time.time()}, f)
+
+def python_env_for(target_id):
+    _, _, _, req_path, _ = resolve_paths(target_id)
+    if not os.path.exists(req_path): return None
+    key = python_deps_key(req_path, os.path.dirname(req_path))
+    if not deps_ready(key): return None
+    touch_deps(key)
+    return os.path.join(DEPS_STORE, key)
+
+def referenced_deps_keys():
+    keys = set()
+    for tid in list(registry.ownership):
+        work_dir, _, _, req_path, _ = resolve_paths(tid)
+        if os.path.exists(req_path): keys.add(python_deps_key(req_path, work_dir))
+        if os.path.exists(os.path.join(work_dir, "package.json")): keys.add(node_deps_key(work_dir))
+    return keys
+
+def evict_deps(max_bytes=DEPS_STORE_MAX_MB * 1024 * 1024, keep=()):
+    # LRU by .ready mtime; entries referenced by a registered workspace (or just built) are kept.
+    entries = []
+    for key in os.listdir(DEPS_STORE) if os.path.isdir(DEPS_STORE) else []:
+        marker = os.path.join(DEPS_STORE, key, ".ready")
+        if not os.path.exists(marker): continue
+        try:
+            with open(marker) as f: size = json.load(f).get("size", 0)
+        except Exception: size = 0
+        entries.append((os.path.getmtime(marker), key, size))
+    total = sum(e[2] for e in entries)
+    if total <= max_bytes: return []
+    keep, evicted = referenced_deps_keys() | set(keep), []
+    for _, key, size in sorted(entries):
+        if total <= max_bytes: break
+        if key in keep: continue
+        shutil.rmtree(os.path.join(DEPS_STORE, key), ignore_errors=True)
+        total -= size
+        evicted.append(key)
+    if evicted: logger.info(f"Evicted deps: {evicted}")
+    return evicted
+
+async def ensure_python_deps(req_path, work_dir, progress=None):
+    key = python_deps_key(req_path, work_dir)
+    async with dep_locks.setdefault(key, asyncio.Lock()):
+        if deps_ready(key):
+            touch_deps(key)
+            return "cached"
+        path = os.path.join(DEPS_STORE, key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(DEPS_STORE, exist_ok=True)
+        python = os.path.join(path, "bin", "python")
+        await build_queue.run("install", key, [
+            ("Creating venv", [sys.executable, "-m", "venv", path], None),
+            ("Installing Python Deps", [python, "-m", "pip", "install", "-r", os.path.abspath(req_path)], work_dir),
+        ], progress=progress)
+        mark_deps_ready(key)
+    await asyncio.to_thread(evict_deps, keep=[key])
+    return "built"
+
+async def ensure_node_deps(work_dir, progress=None):
+    with open(os.path.join(work_dir, "package.json")) as f: local = "file:" in f.read()
+    if local:
+        await build_queue.run("install", work_dir, [("Installing Node Deps", ["npm", "install"], work_dir)], progress=progress)
+        return "built"
+    key, status = node_deps_key(work_dir), "cached"
+    path = os.path.join(DEPS_STORE, key)
+    async with dep_locks.setdefault(key, asyncio.Lock()):
+        if deps_ready(key): touch_deps(key)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            for name in ("package.json", "package-lock.json"):
+                if os.path.exists(os.path.join(work_dir, name)): shutil.copy(os.path.join(work_dir, name), path)
+            await build_queue.run("install", key, [("Installing Node Deps", ["npm", "install"], path)], progress=progress)
+            mark_deps_ready(key)
+            status = "built"
+    link = os.path.join(work_dir, "node_modules")
+    if os.path.islink(link): os.remove(link)
+    elif os.path.isdir(link): shutil.rmtree(link)
+    os.symlink(os.path.join(path, "node_modules"), link)
+    if status == "built": await asyncio.to_thread(evict_deps, keep=[key])
+    return status
+
+# --- LOGS ---
+def log_path_for(target_id):
+    return os.path.join(UPLOAD_DIR, f"{target_id.replace('|','_')}.log")
+
+class RotatingLog:
+    # Append-only, so output survives restarts; rotates to .log.1 ... .log.N at max_bytes.
+    # open() hands out one shared handle per path: during a swap the old and new process
+    # write the same log, and two handles would each rotate it on their own.
+    handles = {}
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path, self.max_bytes, self.backups = path, max_bytes, backups
+        self.f = open(path, "ab")
+        self.size = self.f.tell()
+        self.refs = 0
+
+    @classmethod
+    def open(cls, path):
+        log = cls.handles.get(path)
+        if not log: log = cls.handles[path] = cls(path)
+        log.refs += 1
+        return log
+
+    def write(self, data):
+        if self.size + len(data) > self.max_bytes and self.size: self.rotate()
+        self.f.write(data)
+        self.f.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"): os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups: os.replace(self.path, f"{self.path}.1")
+        self.f = open(self.path, "wb")
+        self.size = 0
+
+    def close(self):
+        self.refs -= 1
+        if self.refs > 0: return
+        self.f.close()
+        if RotatingLog.handles.get(self.path) is self: del RotatingLog.handles[self.path]
+
+def tail_lines(path, n=LOG_TAIL_LINES, block=8192):
+    # Reads backwards from the end; falls back to the previous rotation if the file is short.
+    lines = []
+    for p in (path, f"{path}.1"):
+        if not os.path.exists(p): continue
+        with open(p, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos, data = f.tell(), b""
+            while pos > 0 and data.count(b"\n") <= n - len(lines):
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        chunk = data.decode(errors="replace").splitlines()
+        lines = chunk[-(n - len(lines)):] + lines if n > len(lines) else lines
+        if len(lines) >= n: break
+    return lines[-n:]
+
+def follow_log(path, n=LOG_TAIL_LINES, poll=0.5, heartbeat=15):
+    # Server-sent events: the last n lines, then new lines as they are written (rotation-aware).
+    for line in tail_lines(path, n): yield f"data: {line}\n\n"
+    f = open(path, "rb") if os.path.exists(path) else None
+    if f: f.seek(0, os.SEEK_END)
+    buf, idle = b"", 0
+    try:
+        while True:
+            data = f.read() if f else b""
+            if data:
+                idle = 0
+                *lines, buf = (buf + data).split(b"\n")
+                for line in lines: yield f"data: {line.decode(errors='replace')}\n\n"
+                continue
+            try: st = os.stat(path)
+            except OSError: st = None
+            if st and (not f or os.fstat(f.fileno()).st_ino != st.st_ino or st.st_size < f.tell()):
+                if f: f.close()
+                f, buf = open(path, "rb"), b""
+                continue
+            time.sleep(poll)
+            idle += poll
+            if idle >= heartbeat:
+                idle = 0
+                yield ": keep-alive\n\n"
+    finally:
+        if f: f.close()
+
+# --- LOG STORE ---
+# Every app's output lines also go to one shared, append-only store for search. Records are
+# "<ts>\t<target>\t<line>" in LOG_STORE_DIR/seg-<n>.log; each segment is cut into blocks of
+# ~LOG_BLOCK_BYTES with their time range, plus per-segment trigram -> blocks and
+# target -> blocks bitmaps (Python ints). A query only reads blocks that can match and
+# verifies lines there. Sealed segments keep their index in seg-<n>.idx; the oldest
+# segments are dropped past LOG_STORE_MAX_MB.
+def line_trigrams(text):
+    s = text.lower()
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+def parse_age(value):
+    # "90", "30s", "10m", "2h", "1d" -> seconds
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd]?)", str(value).strip().lower())
+    if not m: raise ValueError(f"Bad duration `{value}` (use e.g. 30s, 10m, 2h, 1d)")
+    return float(m.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+class LogSegment:
+    def __init__(self, seg_id, root):
+        self.id = seg_id
+        self.path = os.path.join(root, f"seg-{seg_id:06d}.log")
+        self.blocks = []  # [start, end, t_min, t_max]
+        self.postings, self.targets = {}, {}
+        self.open = None  # block being written: its trigrams/targets are folded in when it closes
+        self.size = self.lines = 0
+        self.f = None
+
+    def span(self):
+        times = [b[2] for b in self.blocks[:1]] + [b[3] for b in self.blocks[-1:]]
+        if self.open: times += [self.open["t0"], self.open["t1"]]
+        return (min(times), max(times)) if times else None
+
+    def add(self, ts, target_id, text, nbytes):
+        if not self.open: self.open = {"start": self.size, "t0": ts, "t1": ts, "tris": set(), "targets": set()}
+        o = self.open
+        o["t1"] = ts
+        o["tris"] |= line_trigrams(text)
+        o["targets"].add(target_id)
+        self.size += nbytes
+        self.lines += 1
+        if self.size - o["start"] >= LOG_BLOCK_BYTES: self.close_block()
+
+    def close_block(self):
+        o, self.open = self.open, None
+        if not o: return
+        bit = 1 << len(self.blocks)
+        self.blocks.append([o["start"], self.size, o["t0"], o["t1"]])
+        for tri in o["tris"]: self.postings[tri] = self.postings.get(tri, 0) | bit
+        for tid in o["targets"]: self.targets[tid] = self.targets.get(tid, 0) | bit
+
+    def seal(self):
+        self.close_block()
+        if self.f: self.f.close()
+        self.f = None
+        atomic_write_json(self.path[:-4] + ".idx", {"size": self.size, "lines": self.lines, "blocks": self.blocks,
+                                                    "postings": self.postings, "targets": self.targets})
+
+    def load(self):
+        idx = read_json(self.path[:-4] + ".idx", None)
+        if idx and idx.get("size") == os.path.getsize(self.path):
+            self.size, self.lines, self.blocks = idx["size"], idx["lines"], idx["blocks"]
+            self.postings, self.targets = idx["postings"], idx["targets"]
+            return
+        # No index (the host stopped mid-segment): rebuild it from the records.
+        with open(self.path, "rb") as f:
+            for raw in f:
+                parts = raw.rstrip(b"\n").decode(errors="replace").split("\t", 2)
+                if len(parts) == 3: self.add(float(parts[0]), parts[1], parts[2], len(raw))
+                else: self.size += len(raw)
+        self.seal()
+
+class LogStore:
+    def __init__(self, root=LOG_STORE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.segments = []  # oldest first; the last one is being appended to
+        self.partial = {}
+        self.tombstones = {}  # target -> time of deletion; older lines of it are hidden
+        self.failed = False
+        self.queue = self.writer = None
+        self.dropped = 0  # chunks not indexed because the writer fell behind (the plain logs keep them)
+
+    def feed(self, target_id, chunk, stream=None, final=False):
+        # Non-blocking entry point for the event loop; a writer thread does the indexing.
+        if not self.writer:
+            self.queue = queue.Queue(LOG_STORE_QUEUE)
+            self.writer = threading.Thread(target=self._drain, name="log-store", daemon=True)
+            self.writer.start()
+        try: self.queue.put_nowait((time.time(), target_id, chunk, stream, final))
+        except queue.Full:
+            if not self.dropped: logger.warning("Log store is behind; dropping chunks from the search index")
+            self.dropped += 1
+
+    def _drain(self):
+        while True:
+            ts, target_id, chunk, stream, final = self.queue.get()
+            self.append(target_id, chunk, stream, final, ts)
+
+    def _ensure(self):
+        if self.segments: return
+        os.makedirs(self.root, exist_ok=True)
+        self.tombstones = read_json(os.path.join(self.root, "tombstones.json"), {})
+        ids = sorted(int(n[4:10]) for n in os.listdir(self.root) if re.fullmatch(r"seg-\d{6}\.log", n))
+        for seg_id in ids:
+            seg = LogSegment(seg_id, self.root)
+            try: seg.load()
+            except (OSError, ValueError) as e:
+                logger.error(f"Log segment {seg.path} unreadable, skipped: {e}")
+                continue
+            self.segments.append(seg)
+        self._roll(ids[-1] + 1 if ids else 1)
+
+    def _roll(self, seg_id):
+        seg = LogSegment(seg_id, self.root)
+        seg.f = open(seg.path, "ab")
+        self.segments.append(seg)
+        while sum(s.size for s in self.segments) > LOG_STORE_MAX_MB * 2**20 and len(self.segments) > 1:
+            old = self.segments.pop(0)
+            for p in (old.path, old.path[:-4] + ".idx"):
+                with contextlib.suppress(OSError): os.remove(p)
+
+    def append(self, target_id, chunk, stream=None, final=False, ts=None):
+        # Called from the log pump with raw output; partial lines wait for their newline
+        # until the stream ends (final=True).
+        key = (target_id, stream)
+        with self.lock:
+            try:
+                self._ensure()
+                *lines, rest = (self.partial.pop(key, b"") + chunk).split(b"\n")
+                if rest and (final or len(rest) > LOG_LINE_MAX): lines.append(rest)
+                elif rest: self.partial[key] = rest
+                self._write(ts or time.time(), target_id, lines)
+                self.failed = False
+            except OSError as e:
+                if not self.failed: logger.error(f"Log store write failed: {e}")
+                self.failed = True
+
+    def _write(self, ts, target_id, lines):
+        seg = self.segments[-1]
+        for raw in lines:
+            text = raw.rstrip(b"\r").decode(errors="replace")[:LOG_LINE_MAX].replace("\r", " ")
+            rec = f"{ts:.3f}\t{target_id}\t{text}\n".encode()
+            seg.f.write(rec)
+            seg.add(ts, target_id, text, len(rec))
+            if seg.size >= LOG_SEGMENT_MB * 2**20:
+                seg.seal()
+                self._roll(seg.id + 1)
+                seg = self.segments[-1]
+
+    def forget(self, target_id):
+        with self.lock:
+            self._ensure()
+            self.tombstones[target_id] = time.time()
+            atomic_write_json(os.path.join(self.root, "tombstones.json"), self.tombstones)
+
+    def _plan(self, tris, targets, since, until):
+        # (path, start, end) byte ranges worth reading, newest first, and the block counts.
+        plan, total = [], 0
+        for seg in reversed(self.segments):
+            total += len(seg.blocks) + (1 if seg.open else 0)
+            span = seg.span()
+            if not span or (until is not None and span[0] > until): continue
+            if since is not None and span[1] < since: break
+            o = seg.open
+            if o and not (tris - o["tris"]) and (targets is None or targets & o["targets"]) \
+                    and (since is None or o["t1"] >= since) and (until is None or o["t0"] <= until):
+                plan.append((seg.path, o["start"], seg.size))
+            mask = (1 << len(seg.blocks)) - 1
+            for tri in tris:
+                mask &= seg.postings.get(tri, 0)
+                if not mask: break
+            if mask and targets is not None:
+                mask &= functools.reduce(lambda a, b: a | b, (seg.targets.get(t, 0) for t in targets), 0)
+            for i in range(len(seg.blocks) - 1, -1, -1):
+                if not mask >> i & 1: continue
+                start, end, t0, t1 = seg.blocks[i]
+                if (since is not None and t1 < since) or (until is not None and t0 > until): continue
+                plan.append((seg.path, start, end))
+        return plan, total
+
+    def search(self, query, targets=None, since=None, until=None, limit=LOG_SEARCH_LIMIT, regex=False):
+        # targets: set of target ids the caller may see (None = all). Newest hits first; lines
+        # fed in the last few milliseconds may still be in the writer queue.
+        t0 = time.perf_counter()
+        if regex: match = re.compile(query, re.IGNORECASE).search
+        else:
+            needle = query.lower()
+            match = lambda text: needle in text.lower()
+        tris = set() if regex else line_trigrams(query)
+        with self.lock:
+            self._ensure()
+            self.segments[-1].f.flush()
+            plan, total = self._plan(tris, targets, since, until)
+            tombstones = dict(self.tombstones)
+        hits, scanned = [], 0
+        for path, start, end in plan:
+            try:
+                with open(path, "rb") as f:
+                    f.seek(start)
+                    data = f.read(end - start)
+            except OSError: continue  # dropped by retention meanwhile
+            scanned += 1
+            for raw in reversed(data.split(b"\n")):
+                parts = raw.decode(errors="replace").split("\t", 2)
+                if len(parts) != 3: continue
+                ts, tid, text = float(parts[0]), parts[1], parts[2]
+                if (targets is not None and tid not in targets) or (since is not None and ts < since) or (until is not None and ts > until): continue
+                if ts <= tombstones.get(tid, 0) or not match(text): continue
+                hits.append({"ts": ts, "target": tid, "line": text})
+                if len(hits) >= limit: break
+            if len(hits) >= limit: break
+        took = time.perf_counter() - t0
+        metrics.observe("bothost_log_search_seconds", took)
+        return {"hits": hits, "truncated": len(hits) >= limit, "blocks_scanned": scanned, "blocks_total": total, "took_ms": round(took * 1000, 2)}
+
+    def stats(self):
+        with self.lock:
+            self._ensure()
+            return {"segments": len(self.segments), "size_mb": round(sum(s.size for s in self.segments) / 2**20, 1),
+                    "lines": sum(s.lines for s in self.segments), "blocks": sum(len(s.blocks) for s in self.segments),
+                    "queued": self.queue.qsize() if self.queue else 0, "dropped": self.dropped}
+
+log_store = LogStore()
+
+def parse_search(args):
+    # "/search ERROR since 10m app=bot*.py limit=20"; /regex/ for a regular expression.
+    opts, words, args = {}, [], list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.lower() in ("since", "until") and args: opts[arg.lower()] = args.pop(0)
+        elif "=" in arg and arg.split("=", 1)[0].lower() in ("since", "until", "app", "limit"): opts[arg.split("=", 1)[0].lower()] = arg.split("=", 1)[1]
+        else: words.append(arg)
+    return search_params(" ".join(words), **opts)
+
+def search_params(query, since=None, until=None, app=None, limit=None):
+    if not query: raise ValueError("Nothing to search for")
+    regex = len(query) > 2 and query.startswith("/") and query.endswith("/")
+    if regex:
+        query = query[1:-1]
+        re.compile(query)
+    now = time.time()
+    return {"query": query, "regex": regex, "app": app or None,
+            "since": now - parse_age(since) if since else None,
+            "until": now - parse_age(until) if until else None,
+            "limit": max(1, min(int(limit or LOG_SEARCH_LIMIT), 1000))}
+
+def search_logs(uid, query, regex=False, app=None, since=None, until=None, limit=LOG_SEARCH_LIMIT):
+    # uid None = every app (API token holders); otherwise only the apps the registry says uid owns.
+    targets = None
+    if app or (uid is not None and uid != ADMIN_ID):
+        targets = {t for t in (registry.targets_for(uid) if uid is not None else list(registry.ownership)) if not app or fnmatch.fnmatchcase(t, app)}
+    result = log_store.search(query, targets, since, until, limit, regex)
+    if cluster.enabled():
+        result["errors"] = {}
+        payload = {"query": query, "regex": regex, "since": since, "until": until, "limit": limit,
+                   "targets": sorted(targets) if targets is not None else None}
+        for name, agent in cluster.alive().items():
+            try: remote = agent_request(agent["url"], "/agent/search", payload, 10)
+            except RuntimeError as e:
+                result["errors"][name] = str(e)
+                continue
+            result["hits"] += [dict(h, node=name) for h in remote["hits"]]
+            for k in ("blocks_scanned", "blocks_total"): result[k] += remote[k]
+            result["truncated"] = result["truncated"] or remote["truncated"]
+        result["hits"] = sorted(result["hits"], key=lambda h: -h["ts"])[:limit]
+    return result
+
+# --- DISK QUOTAS & GC ---
+# Usage is attributed per app (a repo checkout counts once per owner) and cached for
+# DISK_USAGE_TTL. Quotas are checked before downloads/clones; the GC removes repo checkouts,
+# logs, per-app env/requirements files and dependency caches that no registered app references.
+SHARED_UPLOAD_FILES = {"package.json", "package-lock.json", "node_modules"}
+usage_cache = {}
+gc_state = {"last_run": None, "removed": [], "freed": 0}
+
+class QuotaExceeded(Exception):
+    pass
+
+def path_size(path, fresh=False):
+    cached = usage_cache.get(path)
+    if cached and not fresh and time.time() - cached[0] < DISK_USAGE_TTL: return cached[1]
+    if os.path.isdir(path) and not os.path.islink(path): size = dir_size(path)
+    else:
+        try: size = os.lstat(path).st_size
+        except OSError: size = 0
+    usage_cache[path] = (time.time(), size)
+    return size
+
+def invalidate_usage(*paths):
+    for p in paths: usage_cache.pop(p, None)
+
+def target_files(target_id):
+    # Every path that belongs to one app; repo checkouts are shared by the repo's targets.
+    work_dir, _, env_path, req_path, full_script_path = resolve_paths(target_id)
+    log = log_path_for(target_id)
+    logs = [log] + [f"{log}.{i}" for i in range(1, LOG_BACKUPS + 1)]
+    if "|" in target_id: return [work_dir] + logs
+    return [full_script_path, env_path, req_path] + logs
+
+def app_disk_usage(target_id):
+    return sum(path_size(p) for p in target_files(target_id) if os.path.lexists(p))
+
+def user_paths(uid):
+    with registry.lock: targets = list(registry.by_owner.get(uid, ()))
+    return {p for tid in targets for p in target_files(tid) if os.path.lexists(p)}
+
+def user_disk_usage(uid, extra=()):
+    return sum(path_size(p) for p in user_paths(uid) | set(extra))
+
+def total_disk_usage():
+    return sum(path_size(os.path.join(UPLOAD_DIR, n)) for n in os.listdir(UPLOAD_DIR))
+
+def check_quota(uid, incoming=0, pending=()):
+    # Raises QuotaExceeded when `incoming` more bytes would cross the user's or the global quota.
+    # pending: paths already written (e.g. a fresh clone) that are about to become the user's.
+    mb = lambda b: f"{b / 2**20:.1f} MB"
+    if GLOBAL_QUOTA_MB:
+        used = total_disk_usage()
+        if used + incoming > GLOBAL_QUOTA_MB * 2**20: raise QuotaExceeded(f"Host storage is full ({mb(used)} of {GLOBAL_QUOTA_MB} MB used).")
+    if USER_QUOTA_MB and uid != ADMIN_ID:
+        used = user_disk_usage(uid, pending)
+        if used + incoming > USER_QUOTA_MB * 2**20: raise QuotaExceeded(f"Disk quota exceeded ({mb(used)} of {USER_QUOTA_MB} MB used).")
+
+def purge_target_files(target_id):
+    # A repo checkout is only removed once no other registered target uses it.
+    for path in target_files(target_id):
+        if "|" in target_id and path == resolve_paths(target_id)[0]:
+            repo = target_id.split("|")[0]
+            if any(t.split("|")[0] == repo for t in list(registry.ownership) if "|" in t and t != target_id): continue
+            shutil.rmtree(path, ignore_errors=True)
+            scan_cache.pop(path, None)
+        else:
+            try: os.remove(path)
+            except OSError: pass
+        invalidate_usage(path)
+    log_store.forget(target_id)
+
+def referenced_upload_paths():
+    keep = {os.path.join(UPLOAD_DIR, n) for n in SHARED_UPLOAD_FILES}
+    for tid in set(registry.ownership) | set(supervisor.apps): keep.update(target_files(tid))
+    return keep
+
+def host_artifact(path):
+    # Single-file apps run with cwd=UPLOAD_DIR, so their own data (sqlite, sessions, config)
+    # lives next to ours. Only paths the host writes are candidates: app logs and their
+    # rotations, per-app .env/_req.txt files, and git checkouts.
+    if os.path.isdir(path) and not os.path.islink(path): return os.path.isdir(os.path.join(path, ".git"))
+    name = os.path.basename(path)
+    return bool(re.fullmatch(r".+(?:%s)(?:\.log(?:\.\d+)?|\.env|_req\.txt)" % "|".join(map(re.escape, RUNNABLE_EXTS)), name))
+
+def collect_garbage(dry_run=False, min_age=GC_MIN_AGE):
+    # Anything younger than min_age is left alone so in-progress uploads/clones survive.
+    now, removed = time.time(), []
+    keep = referenced_upload_paths()
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        try: age = now - os.lstat(path).st_mtime
+        except OSError: continue
+        if path in keep or age < min_age or not host_artifact(path): continue
+        removed.append((path, path_size(path, fresh=True)))
+    keys = referenced_deps_keys()
+    for key in os.listdir(DEPS_STORE) if os.path.isdir(DEPS_STORE) else []:
+        path = os.path.join(DEPS_STORE, key)
+        marker = os.path.join(path, ".ready")
+        try: age = now - os.path.getmtime(marker if os.path.exists(marker) else path)
+        except OSError: continue
+        if key in keys or age < min_age: continue
+        removed.append((path, path_size(path, fresh=True)))
+    if not dry_run:
+        for path, _ in removed:
+            if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path, ignore_errors=True)
+            else:
+                try: os.remove(path)
+                except OSError: pass
+            invalidate_usage(path)
+        gc_state.update(last_run=now, removed=[p for p, _ in removed][:50], freed=sum(b for _, b in removed))
+        if removed: logger.info(f"GC removed {len(removed)} orphaned paths ({gc_state['freed'] / 2**20:.1f} MB)")
+    return removed
+
+async def gc_loop():
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try: await asyncio.to_thread(collect_garbage)
+        except Exception as e: logger.error(f"GC failed: {e}")
+
+def disk_report(targets=None):
+    targets = sorted(registry.ownership) if targets is None else targets
+    apps = {t: app_disk_usage(t) for t in targets}
+    owners = {}
+    for uid in {registry.owner(t) for t in targets}: owners[str(uid)] = user_disk_usage(uid)
+    return {"apps": apps, "users": owners, "total": total_disk_usage(), "user_quota_mb": USER_QUOTA_MB,
+            "global_quota_mb": GLOBAL_QUOTA_MB, "gc": gc_state}
+
+# --- SUPERVISOR ---
+def fmt_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+class AppProc:
+    def __init__(self, target_id):
+        self.target_id = target_id
+        self.state = "stopped"  # starting | running | stopping | stopped | exited | crashed | backoff | frozen | idle
+        self.proc = None
+        self.desired = False
+        self.started_at = self.exited_at = None
+        self.exit_code = None
+        self.restarts = 0
+        self.failures = 0
+        self.retry = None
+        self.history = deque(maxlen=20)
+        self.cpu_base = self.cpu_last = 0.0
+        self.last_output = None
+        self.spec = None
+        self.rollback = None
+        self.ready_watch = None
+        self.health = None
+        self.log_match = None
+        self.health_regex = None
+        self.activity = None
+        self.suspension = None
+        self.wakes = {"count": 0, "last_ms": None, "last_trigger": None}
+        self.first_log = None  # seconds from launch to the first output of the latest start
+        self.killed_unhealthy = False
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def uptime(self):
+        return time.time() - self.started_at if self.state == "running" else 0
+
+    def to_dict(self):
+        return {"target": self.target_id, "state": self.state, "pid": self.pid, "uptime": round(self.uptime(), 1),
+                "restarts": self.restarts, "exit_code": self.exit_code, "policy": restart_policy(self.target_id),
+                "health": dict(self.health) if self.health and health_config(self.target_id) else None,
+                "suspension": self.suspension, "wakes": self.wakes, "first_log_s": self.first_log, "desired": self.desired}
+
+def reload_mode(target_id):
+    return (registry.get(target_id) or {}).get("reload", "cold")
+
+def file_restorer(path):
+    # Snapshot of a file before an edit; calling the result puts it back.
+    old = None
+    if os.path.exists(path):
+        with open(path, "rb") as f: old = f.read()
+    def restore():
+        if old is None:
+            try: os.remove(path)
+            except OSError: pass
+        else:
+            with open(path, "wb") as f: f.write(old)
+        logger.info(f"Restored previous version of {path}")
+    return restore
+
+def restart_policy(target_id):
+    return (registry.get(target_id) or {}).get("restart_policy", RESTART_POLICY)
+
+def is_healthy(target_id):
+    app = supervisor.get(target_id)
+    if not (app and app.state == "running" and app.uptime() >= RECOVERY_SETTLE): return False
+    return not health_config(target_id) or app.health["status"] == "healthy"
+
+class Supervisor:
+    # Owns every hosted process. Exits are observed by a waiter task per child (asyncio's
+    # child watcher reaps immediately), so state reads are O(1) dict/set lookups.
+    # Desired state is persisted to STATE_FILE so apps come back after a host restart.
+    def __init__(self, state_file=STATE_FILE):
+        self.loop = self.bot = None
+        self.apps = {}
+        self.locks = {}
+        self.running = set()
+        self.state_file = state_file
+        self.persist_handle = None
+        self.closing = False
+        self.recovery = None
+
+    def bind(self, loop, bot=None):
+        self.loop, self.bot = loop, bot
+
+    def submit(self, coro):
+        if not self.loop:
+            coro.close()
+            raise RuntimeError("Bot loop not ready")
+        try:
+            if asyncio.get_running_loop() is self.loop: return self.loop.create_task(coro)
+        except RuntimeError: pass
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def get(self, target_id):
+        return self.apps.get(target_id) or cluster.get(target_id)
+
+    def is_running(self, target_id):
+        return target_id in self.running or cluster.is_running(target_id)
+
+    def count(self):
+        return len(self.running)
+
+    def states(self):
+        counts = {}
+        for a in list(self.apps.values()): counts[a.state] = counts.get(a.state, 0) + 1
+        return counts
+
+    def lock(self, target_id):
+        # Serialises start/stop/reload/suspend/wake per app; the _-prefixed bodies assume it is held.
+        return self.locks.setdefault(target_id, asyncio.Lock())
+
+    def _set(self, app, state):
+        app.state = state
+        app.history.append((time.time(), state))
+        if state == "running": self.running.add(app.target_id)
+        else: self.running.discard(app.target_id)
+        logger.info(f"[{app.target_id}] -> {state}")
+
+    async def start(self, target_id, reason="manual"):
+        async with self.lock(target_id): return await self._start(target_id, reason)
+
+    async def _start(self, target_id, reason="manual"):
+        if cluster.enabled():
+            remote = await self._place(target_id)
+            if remote: return remote
+        app = self.apps.setdefault(target_id, AppProc(target_id))
+        app.rollback = None
+        if app.retry: app.retry.cancel()
+        if app.proc:
+            metrics.inc("bothost_restarts_total", target=target_id, reason=reason)
+            await self._terminate(app)
+        app.desired = True
+        app.failures = 0
+        self.persist()
+        await self._spawn(app)
+        return app
+
+    async def _place(self, target_id):
+        # Returns the RemoteApp when the target lands on an agent, None to run it here.
+        prev, node = cluster.node_of(target_id), cluster.place(target_id)
+        if prev and prev != node: await cluster.stop_remote(target_id, remove=True)
+        if node == "local":
+            if prev: registry.update(target_id, node="local")
+            return None
+        if target_id in self.apps: await self._remove(target_id)
+        try: return await cluster.start_remote(node, target_id)
+        except RuntimeError as e:
+            # The agent may still bring its copy up (or recover it later); make sure it drops it.
+            cluster.mark_drop(target_id, node)
+            if not LOCAL_APPS: raise
+            logger.error(f"[{target_id}] placement on {node} failed ({e}); running locally")
+            registry.update(target_id, node="local")
+            return None
+
+    async def stop(self, target_id):
+        async with self.lock(target_id): return await self._stop(target_id)
+
+    async def _stop(self, target_id):
+        if cluster.node_of(target_id): return await cluster.stop_remote(target_id)
+        app = self.apps.get(target_id)
+        if not app: return None
+        app.desired = False
+        app.suspension = None
+        self.persist()
+        if app.retry: app.retry.cancel()
+        await self._terminate(app)
+        if app.state != "stopped": self._set(app, "stopped")
+        return app
+
+    async def remove(self, target_id):
+        async with self.lock(target_id): return await self._remove(target_id)
+
+    async def _remove(self, target_id):
+        if cluster.node_of(target_id): return await cluster.stop_remote(target_id, remove=True)
+        await self._stop(target_id)
+        self.apps.pop(target_id, None)
+        self.persist()
+        remove_cgroup(target_id)
+
+    async def shutdown(self):
+        # Stop the processes but keep their desired state on disk for the next start.
+        self.flush_state()
+        self.closing = True
+        async def halt(app):
+            if app.retry: app.retry.cancel()
+            app.desired = False
+            await self._terminate(app)
+        await asyncio.gather(*(halt(a) for a in list(self.apps.values())), return_exceptions=True)
+
+    # Persistence & recovery
+    def persist(self):
+        if self.closing or not self.loop or self.persist_handle: return
+        self.persist_handle = self.loop.call_later(0.5, self.flush_state)
+
+    def flush_state(self):
+        self.persist_handle = None
+        state = {tid: {"desired": "running" if a.desired else "stopped", "spec": a.spec, "pgid": a.pid, "started_at": a.started_at,
+                       "suspension": a.suspension} for tid, a in self.apps.items()}
+        try: atomic_write_json(self.state_file, state)
+        except OSError as e: logger.error(f"Saving supervisor state failed: {e}")
+
+    @staticmethod
+    def process_groups():
+        # One pass over the process table: pgid -> [psutil.Process] (with cmdline cached).
+        groups = {}
+        for p in psutil.process_iter(["cmdline"]):
+            try:
+                if p.pid != os.getpid(): groups.setdefault(os.getpgid(p.pid), []).append(p)
+            except (ProcessLookupError, psutil.Error): pass
+        return groups
+
+    async def _reap_orphan(self, target_id, entry, groups):
+        # A previous host instance's process group: the stdout pipe is gone, so it can't be
+        # re-adopted; terminate it so the fresh start doesn't run twice.
+        pgid, spec = entry.get("pgid"), entry.get("spec") or {}
+        if not pgid: return False
+        members = groups.get(pgid, [])
+        if not members or (spec.get("cmd") and not any(p.info["cmdline"] == spec["cmd"] for p in members)): return False
+        logger.info(f"Cleaning up orphaned process group {pgid} of {target_id}")
+        try: os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError: return True
+        deadline = time.time() + STOP_TIMEOUT
+        while time.time() < deadline and any(p.is_running() and p.status() != psutil.STATUS_ZOMBIE for p in members):
+            await asyncio.sleep(0.2)
+        try: os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError: pass
+        return True
+
+    async def recover(self, application=None):
+        state = read_json(self.state_file, {})
+        t0 = time.time()
+        groups = await asyncio.to_thread(self.process_groups) if any(e.get("pgid") for e in state.values()) else {}
+        orphans = await asyncio.gather(*(self._reap_orphan(tid, e, groups) for tid, e in state.items()), return_exceptions=True)
+        wanted = [tid for tid, e in state.items() if e.get("desired") == "running" and registry.get(tid)]
+        idled = [tid for tid in wanted if state[tid].get("suspension")]
+        for tid in idled: self._restore_idle(tid, state[tid])
+        wanted = [tid for tid in wanted if tid not in idled]
+        self.recovery = {"apps": len(wanted), "orphans_cleaned": sum(1 for o in orphans if o is True), "started_at": t0,
+                         "healthy_after": None, "unhealthy": [], "idle": len(idled)}
+        sem = asyncio.Semaphore(RECOVERY_CONCURRENCY)
+        async def bring_up(tid):
+            async with sem:
+                try: await self.start(tid)
+                except Exception as e: logger.error(f"Recovery of {tid} failed: {e}")
+                await asyncio.sleep(RECOVERY_STAGGER)
+        await asyncio.gather(*(bring_up(tid) for tid in wanted))
+        while time.time() - t0 < RECOVERY_TIMEOUT and not all(is_healthy(tid) for tid in wanted):
+            await asyncio.sleep(0.5)
+        self.recovery["unhealthy"] = [tid for tid in wanted if not is_healthy(tid)]
+        self.recovery["healthy_after"] = round(time.time() - t0, 2)
+        text = (f"♻️ Recovered {len(wanted) - len(self.recovery['unhealthy'])}/{len(wanted)} apps in {self.recovery['healthy_after']}s"
+                f" (orphans cleaned: {self.recovery['orphans_cleaned']}, left idle: {len(idled)})")
+        if self.recovery["unhealthy"]: text += "\n⚠️ Not healthy: " + ", ".join(self.recovery["unhealthy"])
+        logger.info(text)
+        if application and ADMIN_ID and wanted:
+            try: await outbox.send(application.bot, ADMIN_ID, text)
+            except Exception as e: logger.warning(f"Recovery report not sent: {e}")
+
+    def _restore_idle(self, target_id, entry):
+        # Suspended when the host went down: it comes back idle without a process (a frozen
+        # one was reaped with the other orphans) and is relaunched on its next wake.
+        app = self.apps.setdefault(target_id, AppProc(target_id))
+        app.desired, app.spec = True, entry.get("spec")
+        app.suspension = dict(entry["suspension"], mode="stop", rss_mb=0.0)
+        self._set(app, "idle")
+
+    async def _launch(self, app, mem_headroom=1):
+        # mem_headroom scales the cgroup's memory.max, which a swap's two processes share.
+        cmd, cwd, env, log_path = build_launch_spec(app.target_id)
+        limits = app_limits(app.target_id)
+        cgroup = apply_cgroup_limits(app.target_id, dict(limits, mem_mb=limits["mem_mb"] and limits["mem_mb"] * mem_headroom))
+        if limits["mem_mb"] and cmd[0] == "node": env["NODE_OPTIONS"] = f"{env.get('NODE_OPTIONS', '')} --max-old-space-size={int(limits['mem_mb'] * 0.75)}".strip()
+        if cmd[0] == "node": env.setdefault("NODE_COMPILE_CACHE", os.path.join(ARTIFACT_DIR, "node"))  # Node 22+ code cache
+        log = RotatingLog.open(log_path)
+        log.write(f"\n=== Started {time.strftime('%Y-%m-%d %H:%M:%S')}: {' '.join(cmd)} ===\n".encode())
+        launched = time.perf_counter()
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, env=env, stdout=asyncio.subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, start_new_session=True,
+                                                        preexec_fn=limits_preexec(limits, cgroup, rlimit_as=cmd[0] != "node"))
+        except Exception:
+            log.close()
+            raise
+        self.loop.create_task(self._pump(app, proc, log, launched))
+        return proc, {"cmd": cmd, "cwd": cwd, "limits": limits}
+
+    async def _spawn(self, app):
+        self._set(app, "starting")
+        start = time.perf_counter()
+        try: proc, spec = await self._launch(app)
+        except Exception as e:
+            logger.error(f"Failed to start {app.target_id}: {e}")
+            app.exit_code = None
+            return self._after_exit(app, failed=True)
+        metrics.observe("bothost_spawn_seconds", time.perf_counter() - start)
+        self._adopt(app, proc, spec)
+
+    def _adopt(self, app, proc, spec):
+        app.proc, app.started_at, app.exit_code = proc, time.time(), None
+        app.cpu_base, app.cpu_last = app.cpu_base + app.cpu_last, 0.0
+        app.spec = spec
+        last = app.health and app.health.get("last_failure")
+        app.health = {"status": "starting", "failures": 0, "last_check": None, "last_ok": None, "last_error": None,
+                      "last_failure": last, "next_due": app.started_at + (health_config(app.target_id) or {}).get("grace", HEALTH_GRACE)}
+        app.log_match = None
+        app.activity = app.suspension = None
+        self._set(app, "running")
+        self.persist()
+        self.loop.create_task(self._wait(app, proc))
+
+    async def _pump(self, app, proc, log, launched):
+        # The child's stdout/stderr pipe is drained here into the size-capped rotating log.
+        try:
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk: break
+                if launched:
+                    app.first_log = round(time.perf_counter() - launched, 3)
+                    metrics.observe("bothost_first_log_seconds", app.first_log)
+                    launched = None
+                log.write(chunk)
+                log_store.feed(app.target_id, chunk, proc.pid)
+                app.last_output = time.time()
+                watch = app.ready_watch
+                if watch and watch[0] is proc and watch[1].search(chunk.decode(errors="replace")): watch[2].set()
+                regex = health_log_regex(app)
+                if regex and app.proc is proc and regex.search(chunk.decode(errors="replace")): app.log_match = app.last_output
+        except Exception as e:
+            logger.error(f"Log pump for {app.target_id} failed: {e}")
+        finally:
+            log.close()
+            log_store.feed(app.target_id, b"", proc.pid, final=True)
+
+    # Hot reload
+    async def reload(self, target_id, restore=None):
+        # Cold mode restarts in place; swap mode keeps the old process serving until the new
+        # one is ready. Either way a crash within RELOAD_GRACE restores the previous files.
+        async with self.lock(target_id): return await self._reload(target_id, restore)
+
+    async def _reload(self, target_id, restore):
+        app = self.apps.get(target_id)
+        if reload_mode(target_id) == "swap" and app and app.proc and app.state == "running":
+            ok, detail = await self.swap(app, restore)
+            if not ok: return ok, detail
+        else:
+            app = await self._start(target_id)
+            detail = "restarted"
+        if restore: app.rollback = (time.time() + RELOAD_GRACE, restore)
+        return True, detail
+
+    async def swap(self, app, restore=None):
+        try: return await self._swap(app, restore)
+        finally: apply_cgroup_limits(app.target_id, app_limits(app.target_id))
+
+    async def _swap(self, app, restore):
+        try: proc, spec = await self._launch(app, mem_headroom=2)
+        except Exception as e:
+            if restore: restore()
+            return False, f"new version failed to start: {e}"
+        pattern = (registry.get(app.target_id) or {}).get("ready_pattern")
+        ready = asyncio.Event()
+        if pattern: app.ready_watch = (proc, re.compile(pattern), ready)
+        exited = self.loop.create_task(proc.wait())
+        try:
+            waiter = self.loop.create_task(ready.wait()) if pattern else self.loop.create_task(asyncio.sleep(RELOAD_READY_SECS))
+            await asyncio.wait([exited, waiter], timeout=RELOAD_READY_TIMEOUT if pattern else None, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+        finally:
+            app.ready_watch = None
+        if exited.done() or (pattern and not ready.is_set()):
+            if not exited.done(): await self._kill(proc)
+            if restore: restore()
+            reason = f"exited with {proc.returncode}" if exited.done() else "not ready in time"
+            logger.warning(f"[{app.target_id}] swap aborted: new version {reason}; old version kept")
+            return False, f"new version {reason}, kept the running version"
+        old = app.proc
+        self._adopt(app, proc, spec)
+        app.restarts += 1
+        await self._kill(old)
+        return True, "swapped with zero downtime"
+
+    async def _kill(self, proc, timeout=STOP_TIMEOUT):
+        if not proc or proc.returncode is not None: return
+        try: os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError: pass
+        try: await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            try: os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError: pass
+            await proc.wait()
+
+    # Scale to zero
+    async def suspend(self, target_id, mode="freeze"):
+        # freeze: SIGSTOP / cgroup freezer, memory stays mapped (reclaimed to swap when the
+        # cgroup allows it). stop: the process exits; desired state and spec are kept.
+        async with self.lock(target_id): return await self._suspend(target_id, mode)
+
+    async def _suspend(self, target_id, mode):
+        app = self.apps.get(target_id)
+        if not app or app.state != "running": return None
+        app.suspension = {"mode": mode, "since": time.time(), "rss_before_mb": round(app_rss(app) / 2**20, 1), "rss_mb": 0.0}
+        if mode == "stop": await self._terminate(app)
+        else:
+            how = freeze_group(app)
+            self._set(app, "frozen")
+            if how == "cgroup": reclaim_memory(app)
+            await asyncio.sleep(0.2)
+            app.suspension["rss_mb"] = round(app_rss(app) / 2**20, 1)
+        logger.info(f"[{target_id}] idle, suspended ({mode}); RSS {app.suspension['rss_before_mb']} -> {app.suspension['rss_mb']} MB")
+        self.persist()
+        return app.suspension
+
+    async def wake(self, target_id, trigger="manual"):
+        # Returns the wake latency in seconds, or None when the app was not suspended.
+        if target_id not in self.apps and cluster.node_of(target_id): return await cluster.wake(target_id, trigger)
+        async with self.lock(target_id): return await self._wake(target_id, trigger)
+
+    async def _wake(self, target_id, trigger):
+        app = self.apps.get(target_id)
+        if not app or app.state not in ("frozen", "idle"): return None
+        mode, t0 = app.state, time.perf_counter()
+        if mode == "frozen":
+            freeze_group(app, False)
+            app.suspension = app.activity = None
+            if app.health: app.health["next_due"] = time.time() + (health_config(target_id) or {}).get("grace", HEALTH_GRACE)
+            app.log_match = time.time()
+            self._set(app, "running")
+        else: await self._spawn(app)
+        latency = time.perf_counter() - t0
+        app.wakes = {"count": app.wakes["count"] + 1, "last_ms": round(latency * 1000, 1), "last_trigger": trigger}
+        metrics.observe("bothost_wake_seconds", latency, mode=mode)
+        logger.info(f"[{target_id}] woke from {mode} in {latency * 1000:.0f} ms ({trigger})")
+        return latency
+
+    async def fail(self, target_id, reason):
+        # Kills without marking the app as stopping: _wait sees a crash and the restart policy applies.
+        # Apps that exit 0 on SIGTERM would otherwise count as a clean exit under on-failure.
+        app = self.apps.get(target_id)
+        if not app or not app.proc: return
+        logger.warning(f"[{target_id}] {reason}; killing")
+        app.killed_unhealthy = True
+        await self._kill(app.proc)
+
+    async def _wait(self, app, proc):
+        rc = await proc.wait()
+        if app.proc is not proc: return
+        app.proc, app.exit_code, app.exited_at = None, rc, time.time()
+        failed, app.killed_unhealthy = rc != 0 or app.killed_unhealthy, False
+        if app.state == "stopping" or not app.desired:
+            return self._set(app, "idle" if app.suspension and app.desired else "stopped")
+        rollback, app.rollback = app.rollback, None
+        if rollback and failed and time.time() < rollback[0]:
+            logger.warning(f"[{app.target_id}] crashed within the reload grace period; rolling back")
+            rollback[1]()
+            app.restarts += 1
+            metrics.inc("bothost_crashes_total", target=app.target_id)
+            metrics.inc("bothost_restarts_total", target=app.target_id, reason="rollback")
+            return await self._spawn(app)
+        self._after_exit(app, failed=failed)
+
+    def _after_exit(self, app, failed):
+        self._set(app, "crashed" if failed else "exited")
+        if failed: metrics.inc("bothost_crashes_total", target=app.target_id)
+        policy = restart_policy(app.target_id)
+        if policy == "never" or (policy == "on-failure" and not failed): return
+        if app.started_at and time.time() - app.started_at > RESTART_RESET_AFTER: app.failures = 0
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** app.failures)
+        app.failures += 1
+        self._set(app, "backoff")
+        app.retry = self.loop.create_task(self._retry(app, delay))
+
+    async def _retry(self, app, delay):
+        await asyncio.sleep(delay)
+        app.retry = None
+        if not app.desired: return
+        app.restarts += 1
+        metrics.inc("bothost_restarts_total", target=app.target_id, reason="policy")
+        await self._spawn(app)
+
+    async def _terminate(self, app, timeout=STOP_TIMEOUT):
+        proc = app.proc
+        if not proc or proc.returncode is not None: return
+        if app.state == "frozen": freeze_group(app, False)
+        self._set(app, "stopping")
+        await self._kill(proc, timeout)
+
+supervisor = Supervisor()
+
+# --- HEALTH CHECKS ---
+# Optional per-app probes (registry meta "health"): http (GET on a local port), log (a line
+# matching a regex within N seconds) or heartbeat (a file the app touches). One scheduler
+# task runs the due probes with timeouts; after `threshold` consecutive failures the app is
+# killed and handled like a crash, so the restart policy and backoff decide what happens.
+HEALTH_REQUIRED = {"http": "port", "log": "pattern", "heartbeat": "file"}
+
+def health_config(target_id):
+    cfg = (registry.get(target_id) or {}).get("health")
+    if not cfg: return None
+    return dict({"interval": HEALTH_INTERVAL, "timeout": HEALTH_TIMEOUT, "threshold": HEALTH_THRESHOLD, "grace": HEALTH_GRACE}, **cfg)
+
+def parse_health(args):
+    kind = args[0].lower()
+    if kind not in HEALTH_REQUIRED: raise ValueError(f"Unknown check `{args[0]}` (http, log, heartbeat)")
+    cfg = {"type": kind}
+    for arg in args[1:]:
+        if "=" not in arg: raise ValueError(f"Bad option `{arg}`")
+        k, v = arg.split("=", 1)
+        k = k.lower()
+        if k in ("port", "threshold"): cfg[k] = int(v)
+        elif k in ("interval", "timeout", "grace", "within", "rss"): cfg[k] = float(v)
+        elif k in ("path", "pattern", "file"): cfg[k] = v
+        else: raise ValueError(f"Unknown option `{arg}`")
+    if HEALTH_REQUIRED[kind] not in cfg: raise ValueError(f"`{kind}` needs {HEALTH_REQUIRED[kind]}=...")
+    if kind == "log": re.compile(cfg["pattern"])
+    return cfg
+
+def fmt_health(cfg):
+    target = {"http": lambda: f"GET :{cfg['port']}{cfg.get('path', '/')}", "log": lambda: f"log /{cfg['pattern']}/",
+              "heartbeat": lambda: f"heartbeat {cfg['file']}"}[cfg["type"]]()
+    return f"{target} every {cfg['interval']:g}s, timeout {cfg['timeout']:g}s, {cfg['threshold']} strikes" + (f", RSS ≤ {cfg['rss']:g} MB" if cfg.get("rss") else "")
+
+def health_log_regex(app):
+    cfg = (registry.get(app.target_id) or {}).get("health")
+    if not cfg or cfg.get("type") != "log": return None
+    if not app.health_regex or app.health_regex[0] != cfg["pattern"]: app.health_regex = (cfg["pattern"], re.compile(cfg["pattern"]))
+    return app.health_regex[1]
+
+async def http_probe(port, path="/"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
     try:
-        proc = subprocess.Popen(cmd, env=custom_env, stdout=log_file, stderr=subprocess.STDOUT, cwd=work_dir, preexec_fn=os.setsid)
-        running_processes[target_id] = {"process": proc, "log": log_path}
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: 127.0.0.1\r\nUser-Agent: bothost-health\r\n\r\n".encode())
+        await writer.drain()
+        parts = (await reader.readline()).decode(errors="replace").split()
+    finally: writer.close()
+    if len(parts) < 2 or not parts[1].isdigit(): raise RuntimeError("no HTTP response")
+    if int(parts[1]) >= 400: raise RuntimeError(f"HTTP {parts[1]}")
+
+async def run_probe(app, cfg):
+    now, within = time.time(), cfg.get("within", cfg["interval"] * 2)
+    if cfg["type"] == "http": await http_probe(cfg["port"], cfg.get("path", "/"))
+    elif cfg["type"] == "log":
+        age = now - (app.log_match or app.started_at)
+        if age > within: raise RuntimeError(f"no line matching /{cfg['pattern']}/ for {age:.0f}s")
+    elif cfg["type"] == "heartbeat":
+        work_dir = os.path.abspath(resolve_paths(app.target_id)[0])
+        path = os.path.abspath(os.path.join(work_dir, cfg["file"]))
+        if not path.startswith(work_dir + os.sep): raise RuntimeError("heartbeat file outside the workspace")
+        try: age = now - os.path.getmtime(path)
+        except OSError: age = now - app.started_at
+        if age > within: raise RuntimeError(f"heartbeat {cfg['file']} is {age:.0f}s old")
+    buf = sampler.apps.get(app.target_id)
+    if cfg.get("rss") and buf and buf[-1][1]["rss_mb"] > cfg["rss"]: raise RuntimeError(f"RSS {buf[-1][1]['rss_mb']} MB over {cfg['rss']:g} MB")
+
+class HealthChecker:
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.inflight = set()
+        self.sem = None
+
+    def start(self, loop):
+        self.sem = asyncio.Semaphore(HEALTH_CONCURRENCY)
+        loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.time()
+            for tid, app in list(supervisor.apps.items()):
+                if app.state != "running" or not app.health or tid in self.inflight or now < app.health["next_due"]: continue
+                cfg = health_config(tid)
+                if not cfg: continue
+                self.inflight.add(tid)
+                asyncio.get_running_loop().create_task(self._check(app, app.proc, cfg))
+
+    async def _check(self, app, proc, cfg):
+        try:
+            async with self.sem:
+                try:
+                    await asyncio.wait_for(run_probe(app, cfg), cfg["timeout"])
+                    error = None
+                except asyncio.TimeoutError: error = f"timed out after {cfg['timeout']:g}s"
+                except Exception as e: error = str(e) or type(e).__name__
+        finally: self.inflight.discard(app.target_id)
+        if app.proc is not proc: return
+        h, now = app.health, time.time()
+        h.update(last_check=now, next_due=now + cfg["interval"])
+        if error is None: return h.update(status="healthy", failures=0, last_ok=now, last_error=None)
+        h["failures"] += 1
+        h["last_error"] = error
+        metrics.inc("bothost_health_failures_total", target=app.target_id)
+        if h["failures"] < cfg["threshold"]:
+            h["status"] = "failing"
+            return
+        h.update(status="unhealthy", last_failure={"at": now, "error": error})
+        await supervisor.fail(app.target_id, f"health check failed {h['failures']}x: {error}")
+
+health_checker = HealthChecker()
+
+# --- CLUSTER ---
+# NODE_ROLE=agent runs the same code without Telegram: it hosts apps with its own
+# supervisor and reports load to CONTROLLER_URL every AGENT_HEARTBEAT. The controller
+# places each target on the least-loaded live node (sticky, with optional affinity to a
+# node name or label), ships the workspace as a tarball and proxies status and logs.
+def agent_request(base_url, path, payload=None, timeout=30, stream=False, upload=None):
+    # upload: path of a file sent as the raw request body, read in chunks rather than loaded.
+    headers = {"X-Agent-Token": AGENT_TOKEN or "", "Content-Type": "application/json"}
+    with contextlib.ExitStack() as stack:
+        if upload:
+            data = stack.enter_context(open(upload, "rb"))
+            headers.update({"Content-Type": "application/gzip", "Content-Length": str(os.path.getsize(upload))})
+        else: data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(base_url.rstrip("/") + path, data=data, method="POST" if data is not None else "GET", headers=headers)
+        try: resp = urllib.request.urlopen(req, timeout=timeout)
+        except urllib.error.HTTPError as e: raise RuntimeError(f"{path}: HTTP {e.code} {e.read()[:200].decode(errors='replace')}")
+        except OSError as e: raise RuntimeError(f"{path}: {e}")
+    if stream: return resp
+    with resp: body = resp.read()
+    return json.loads(body) if resp.headers.get_content_type() == "application/json" else body.decode(errors="replace")
+
+def agent_token_ok():
+    return bool(AGENT_TOKEN) and hmac.compare_digest(request.headers.get("X-Agent-Token", ""), AGENT_TOKEN)
+
+def pack_workspace(target_id):
+    # Returns the path of a temporary .tar.gz; the caller removes it.
+    work_dir, _, env_path, req_path, full_script_path = resolve_paths(target_id)
+    skip = lambda ti: None if {".git", "node_modules"} & set(ti.name.split("/")) else ti
+    fd, archive = tempfile.mkstemp(suffix=".tar.gz")
+    with os.fdopen(fd, "wb") as f, tarfile.open(fileobj=f, mode="w:gz") as tar:
+        if "|" in target_id: tar.add(work_dir, arcname=os.path.basename(work_dir), filter=skip)
+        else:
+            for path in (full_script_path, env_path, req_path, os.path.join(UPLOAD_DIR, "package.json"), os.path.join(UPLOAD_DIR, "package-lock.json")):
+                if os.path.exists(path): tar.add(path, arcname=os.path.basename(path))
+    return archive
+
+def receive_archive(stream, chunk=65536):
+    fd, archive = tempfile.mkstemp(suffix=".tar.gz")
+    with os.fdopen(fd, "wb") as f: shutil.copyfileobj(stream, f, chunk)
+    return archive
+
+def unpack_workspace(target_id, archive):
+    if "|" in target_id: shutil.rmtree(resolve_paths(target_id)[0], ignore_errors=True)
+    with tarfile.open(archive, mode="r:gz") as tar: tar.extractall(UPLOAD_DIR, filter="data")
+
+class RemoteApp:
+    # Controller-side view of an app hosted by an agent; refreshed from the agent's reports.
+    def __init__(self, node, data):
+        self.node, self.proc, self.rollback = node, None, None
+        self.refresh(data)
+
+    def refresh(self, data):
+        self.data, self.updated = data, time.time()
+        self.target_id, self.state = data["target"], data["state"]
+        self.pid, self.restarts, self.exit_code, self.health = data.get("pid"), data.get("restarts", 0), data.get("exit_code"), data.get("health")
+        self.suspension, self.first_log = data.get("suspension"), data.get("first_log_s")
+        self.wakes = data.get("wakes") or {"count": 0, "last_ms": None, "last_trigger": None}
+        self.desired = data.get("desired", self.state != "stopped")
+
+    def uptime(self):
+        return self.data.get("uptime", 0) + time.time() - self.updated if self.state == "running" else 0
+
+    def to_dict(self):
+        return dict(self.data, node=self.node, uptime=round(self.uptime(), 1))
+
+class Cluster:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.agents = {}
+        self.remote = {}
+
+    def enabled(self):
+        return NODE_ROLE == "controller" and bool(AGENT_TOKEN) and bool(self.agents)
+
+    def register(self, report):
+        # Returns the targets the agent must drop: copies it still runs after they moved away
+        # while it was unreachable (see mark_drop).
+        name, apps, drop = report["name"], report.get("apps", {}), []
+        for tid in list(registry.ownership):
+            nodes = (registry.get(tid) or {}).get("drop_on") or []
+            if name not in nodes: continue
+            if tid in apps: drop.append(tid)
+            # Only once its recovery is over can the agent's report prove the copy is gone.
+            elif report.get("recovered"): registry.update(tid, drop_on=[n for n in nodes if n != name] or None)
+        with self.lock:
+            self.agents[name] = dict(report, last_seen=time.time())
+            for tid, data in apps.items():
+                if self.node_of(tid) != name: continue
+                if tid in self.remote and self.remote[tid].node == name: self.remote[tid].refresh(data)
+                else: self.remote[tid] = RemoteApp(name, data)
+            for tid, r in list(self.remote.items()):
+                if r.node == name and tid not in apps and r.updated < report.get("ts", 0): del self.remote[tid]
+        return drop
+
+    def mark_drop(self, target_id, node):
+        # The target leaves `node` without the agent confirming; it drops its copy on re-register.
+        nodes = (registry.get(target_id) or {}).get("drop_on") or []
+        if node not in nodes: registry.update(target_id, drop_on=nodes + [node])
+
+    def alive(self):
+        now = time.time()
+        return {n: a for n, a in list(self.agents.items()) if now - a["last_seen"] < AGENT_TIMEOUT}
+
+    def node_of(self, target_id):
+        node = (registry.get(target_id) or {}).get("node")
+        return node if node and node != "local" else None
+
+    def get(self, target_id):
+        r = self.remote.get(target_id)
+        return r if r and r.node == self.node_of(target_id) else None
+
+    def is_running(self, target_id):
+        r = self.get(target_id)
+        return bool(r and r.state == "running" and r.node in self.alive())
+
+    def loads(self):
+        # App counts come from the controller's own view so back-to-back placements spread out
+        # before the next heartbeat arrives.
+        placed = {}
+        for r in list(self.remote.values()):
+            if r.state in ("running", "starting"): placed[r.node] = placed.get(r.node, 0) + 1
+        nodes = {n: {"cpu": a["cpu"], "mem_pct": a["mem_pct"], "apps": placed.get(n, 0), "labels": a.get("labels", [])}
+                 for n, a in self.alive().items()}
+        if LOCAL_APPS:
+            host = sampler.host[-1][1] if sampler.host else {"cpu": psutil.cpu_percent(), "mem_pct": psutil.virtual_memory().percent}
+            nodes["local"] = {"cpu": host["cpu"], "mem_pct": host["mem_pct"], "apps": len(supervisor.running), "labels": []}
+        return nodes
+
+    def place(self, target_id):
+        meta = registry.get(target_id) or {}
+        nodes = self.loads()
+        affinity = meta.get("affinity")
+        if affinity:
+            preferred = {n: l for n, l in nodes.items() if n == affinity or affinity in l["labels"]}
+            if preferred: nodes = preferred
+            else: logger.warning(f"[{target_id}] no live node matches affinity {affinity}; placing anywhere")
+        if meta.get("node") in nodes: return meta["node"]
+        if not nodes: raise RuntimeError("No live node can host apps")
+        return min(nodes, key=lambda n: nodes[n]["cpu"] + nodes[n]["mem_pct"] + 5 * nodes[n]["apps"])
+
+    async def call(self, target_id, path, payload=None, timeout=30, upload=None):
+        node = self.node_of(target_id)
+        agent = self.alive().get(node)
+        if not agent: raise RuntimeError(f"Node {node} is offline")
+        return await asyncio.to_thread(agent_request, agent["url"], path, payload, timeout, upload=upload)
+
+    async def start_remote(self, node, target_id):
+        # The archive is streamed from a temp file; the agent installs in the background and
+        # is polled, so no HTTP thread on either side waits out the install.
+        meta = {k: v for k, v in (registry.get(target_id) or {}).items() if k not in ("node", "affinity", "build", "drop_on")}
+        registry.update(target_id, node=node)
+        archive = await asyncio.to_thread(pack_workspace, target_id)
+        q = urllib.parse.urlencode({"target": target_id, "meta": json.dumps(meta)})
+        try: await self.call(target_id, f"/agent/deploy?{q}", timeout=120, upload=archive)
+        finally: os.remove(archive)
+        deadline, status = time.time() + BUILD_TIMEOUT + 60, f"/agent/deploy_status?{urllib.parse.urlencode({'target': target_id})}"
+        while True:
+            await asyncio.sleep(DEPLOY_POLL)
+            job = await self.call(target_id, status, timeout=10)
+            if job["state"] == "done": break
+            if job["state"] == "failed": raise RuntimeError(f"deploy on {node} failed: {job['error']}")
+            if time.time() > deadline: raise RuntimeError(f"deploy on {node} timed out")
+        with self.lock: r = self.remote[target_id] = RemoteApp(node, job["app"])
+        logger.info(f"[{target_id}] placed on {node}")
+        return r
+
+    async def stop_remote(self, target_id, remove=False):
+        try: data = await self.call(target_id, "/agent/remove" if remove else "/agent/stop", {"target": target_id})
+        except RuntimeError as e:
+            logger.warning(f"[{target_id}] remote stop failed: {e}")
+            if remove: self.mark_drop(target_id, self.node_of(target_id))
+            data = None
+        with self.lock:
+            if remove or not data: r = self.remote.pop(target_id, None)
+            else:
+                r = self.remote.get(target_id)
+                if r: r.refresh(data)
+        if remove: registry.update(target_id, node=None)
+        return r
+
+    async def wake(self, target_id, trigger="manual"):
+        # Same contract as Supervisor.wake, with the latency measured on the agent.
+        data = await self.call(target_id, f"/agent/status?{urllib.parse.urlencode({'target': target_id, 'wake': 1})}", timeout=RECOVERY_TIMEOUT)
+        woke = data.pop("woke_ms", None)
+        with self.lock:
+            r = self.remote.get(target_id)
+            if r: r.refresh(data)
+        return woke / 1000 if woke is not None else None
+
+    async def usage(self, target_id):
+        return await self.call(target_id, f"/agent/usage?{urllib.parse.urlencode({'target': target_id})}", timeout=30)
+
+    async def tail(self, target_id, lines=LOG_TAIL_LINES, full=False):
+        q = urllib.parse.urlencode({"target": target_id, "lines": lines, "full": int(full)})
+        return await self.call(target_id, f"/agent/logs?{q}", timeout=60)
+
+cluster = Cluster()
+deploys = {}  # agent side: target -> latest deploy job, read by /agent/deploy_status
+
+async def read_log(target_id, lines=LOG_TAIL_LINES, full=False):
+    # Log text for the Telegram views, wherever the app runs; None when there is none.
+    if cluster.node_of(target_id): return await cluster.tail(target_id, lines, full) or None
+    path = log_path_for(target_id)
+    if not os.path.exists(path): return None
+    if full:
+        with open(path, 'rb') as f: return f.read().decode(errors="replace")
+    return "\n".join(tail_lines(path, lines))
+
+def agent_report():
+    host = sampler.host[-1][1] if sampler.host else {"cpu": psutil.cpu_percent(), "mem_pct": psutil.virtual_memory().percent}
+    apps = {}
+    for tid, a in list(supervisor.apps.items()):
+        apps[tid] = a.to_dict()
+        buf = sampler.apps.get(tid)
+        if buf: apps[tid]["usage"] = buf[-1][1]
+    return {"name": AGENT_NAME, "url": AGENT_URL, "labels": AGENT_LABELS, "ts": time.time(), "cpus": os.cpu_count(),
+            "cpu": host["cpu"], "mem_pct": host["mem_pct"], "apps": apps,
+            "recovered": bool(supervisor.recovery and supervisor.recovery["healthy_after"] is not None)}
+
+async def agent_heartbeat_loop():
+    failing = False
+    while True:
+        try:
+            reply = await asyncio.to_thread(agent_request, CONTROLLER_URL, "/agent/register", agent_report(), 10)
+            if failing: logger.info(f"Reconnected to controller {CONTROLLER_URL}")
+            failing = False
+            for tid in reply.get("drop", []):
+                logger.info(f"[{tid}] moved to another node while we were away; dropping it")
+                await agent_remove(tid)
+        except RuntimeError as e:
+            if not failing: logger.warning(f"Controller unreachable: {e}")
+            failing = True
+        await asyncio.sleep(AGENT_HEARTBEAT)
+
+async def agent_remove(target_id):
+    await supervisor.remove(target_id)
+    await asyncio.to_thread(purge_target_files, target_id)
+    registry.delete(target_id)
+
+async def agent_deploy(target_id, meta, archive):
+    registry.set_owner(target_id, meta.get("owner"), meta.get("type"))
+    registry.update(target_id, **{k: v for k, v in meta.items() if k not in ("owner", "type")})
+    try: await asyncio.to_thread(unpack_workspace, target_id, archive)
+    finally: os.remove(archive)
+    work_dir, _, _, req_path, _ = resolve_paths(target_id)
+    if "|" in target_id: req_path = os.path.join(work_dir, "requirements.txt")
+    if os.path.exists(req_path): await ensure_python_deps(req_path, work_dir)
+    if os.path.exists(os.path.join(work_dir, "package.json")): await ensure_node_deps(work_dir)
+    await prepare_app(target_id)
+    return (await supervisor.start(target_id)).to_dict()
+
+async def run_deploy(target_id, meta, archive):
+    job = deploys[target_id]
+    try: job.update(state="done", app=await agent_deploy(target_id, meta, archive))
     except Exception as e:
-        logger.error(f"Failed to restart: {e}")
+        logger.error(f"[{target_id}] deploy failed: {e}")
+        job.update(state="failed", error=str(e))
+
+async def serve_agent():
+    if not (CONTROLLER_URL and AGENT_TOKEN): raise SystemExit("Agent mode needs CONTROLLER_URL and AGENT_TOKEN")
+    server = http_server()
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, lambda *_: setattr(server, "should_exit", True))
+    loop = asyncio.get_running_loop()
+    build_queue.bind(loop)
+    supervisor.bind(loop)
+    sampler.start()
+    health_checker.start(loop)
+    idle_manager.start(loop)
+    loop.create_task(supervisor.recover())
+    loop.create_task(agent_heartbeat_loop())
+    print(f"Agent {AGENT_NAME} is up, reporting to {CONTROLLER_URL}")
+    try: await server.serve()
+    finally:
+        await supervisor.shutdown()
+        print("Agent stopped.")
+
+# --- RESOURCE LIMITS ---
+# cgroup v2 when CGROUP_PARENT is writable (cpu.weight, memory.max, pids.max), otherwise
+# best-effort rlimits + nice in the child. RLIMIT_NOFILE is always applied. The pids limit
+# needs cgroups: RLIMIT_NPROC counts every process of the UID (and root ignores it).
+LIMIT_PRESETS = {"mem_mb": [None, 128, 256, 512, 1024], "cpu": [100, 50, 25, 200], "pids": [None, 32, 64, 256]}
+cgroups_ok = None
+
+def app_limits(target_id):
+    limits = dict(DEFAULT_LIMITS)
+    limits.update((registry.get(target_id) or {}).get("limits", {}))
+    return limits
+
+def parse_limits(args):
+    limits = {}
+    for arg in args:
+        if "=" not in arg: raise ValueError(f"Bad limit `{arg}`")
+        k, v = arg.split("=", 1)
+        k = {"mem": "mem_mb", "memory": "mem_mb", "cpu": "cpu", "pids": "pids", "nofile": "nofile", "files": "nofile"}.get(k.lower())
+        if not k: raise ValueError(f"Unknown limit `{arg}`")
+        if k == "pids" and not cgroups_available(): raise ValueError("pids limits need cgroup v2 on this host")
+        v = v.lower().rstrip("m")
+        limits[k] = None if v in ("", "0", "none", "max") else int(v)
+    if limits.get("cpu") is not None and not 1 <= limits["cpu"] <= 10000: raise ValueError("cpu weight must be 1-10000")
+    return limits
+
+def fmt_limits(limits):
+    pids = f" | PIDs: {limits['pids'] or '∞'}" if cgroups_available() else ""
+    return f"Memory: {limits['mem_mb'] or '∞'} MB | CPU weight: {limits['cpu'] or 100}{pids} | Files: {limits['nofile'] or '∞'}"
+
+def fmt_applied(live):
+    return "Applied live." if live else "Applied on next restart."
+
+def cgroups_available():
+    global cgroups_ok
+    if cgroups_ok is None:
+        try:
+            if not os.path.exists(os.path.join(os.path.dirname(CGROUP_PARENT), "cgroup.controllers")): raise OSError("no cgroup v2 hierarchy")
+            os.makedirs(CGROUP_PARENT, exist_ok=True)
+            with open(os.path.join(CGROUP_PARENT, "cgroup.subtree_control"), "w") as f: f.write("+cpu +memory +pids")
+            cgroups_ok = True
+        except OSError as e:
+            logger.info(f"cgroup v2 unavailable ({e}); falling back to rlimits")
+            cgroups_ok = False
+    return cgroups_ok
+
+def cgroup_path(target_id):
+    return os.path.join(CGROUP_PARENT, re.sub(r"[^A-Za-z0-9_.-]", "_", target_id))
+
+def apply_cgroup_limits(target_id, limits):
+    if not cgroups_available(): return None
+    path = cgroup_path(target_id)
+    try:
+        os.makedirs(path, exist_ok=True)
+        for name, value in (("cpu.weight", limits["cpu"] or 100), ("memory.max", limits["mem_mb"] and limits["mem_mb"] * 1024 * 1024),
+                            ("pids.max", limits["pids"])):
+            with open(os.path.join(path, name), "w") as f: f.write(str(value or "max"))
+        return path
+    except OSError as e:
+        logger.warning(f"cgroup setup failed for {target_id}: {e}")
+        return None
+
+def remove_cgroup(target_id):
+    if cgroups_ok:
+        try: os.rmdir(cgroup_path(target_id))
+        except OSError: pass
+
+def limits_preexec(limits, cgroup, rlimit_as=True):
+    def apply():
+        if cgroup:
+            with open(os.path.join(cgroup, "cgroup.procs"), "w") as f: f.write("0")
+        else:
+            weight = limits["cpu"] or 100
+            if weight < 100: os.nice(min(19, round(math.log2(100 / weight) * 5)))
+            if limits["mem_mb"] and rlimit_as:
+                mem = limits["mem_mb"] * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_AS, (mem, mem))
+        if limits["nofile"]:
+            hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+            soft = limits["nofile"] if hard == resource.RLIM_INFINITY else min(limits["nofile"], hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, soft))
+    return apply
+
+def read_cgroup_file(path, name):
+    try:
+        with open(os.path.join(path, name)) as f: return f.read()
+    except OSError: return None
+
+def process_tree(pid):
+    try:
+        root = psutil.Process(pid)
+        return [root] + root.children(recursive=True)
+    except psutil.Error: return []
+
+def app_usage(target_id):
+    # Cumulative CPU seconds across restarts plus current memory/pids/fds, for an app on this node.
+    app = supervisor.apps.get(target_id)
+    usage = {"cpu_s": 0.0, "mem_mb": 0.0, "mem_peak_mb": None, "pids": 0, "fds": 0, "source": "psutil"}
+    procs = process_tree(app.pid) if app and app.pid else []
+    for p in procs:
+        try:
+            with p.oneshot():
+                t = p.cpu_times()
+                usage["cpu_s"] += t.user + t.system
+                usage["mem_mb"] += p.memory_info().rss / 2**20
+                usage["fds"] += p.num_fds()
+            usage["pids"] += 1
+        except psutil.Error: pass
+    if app:
+        if procs: app.cpu_last = usage["cpu_s"]
+        usage["cpu_s"] = app.cpu_base + app.cpu_last
+    path = cgroup_path(target_id)
+    if cgroups_ok and os.path.isdir(path):
+        stat = read_cgroup_file(path, "cpu.stat") or ""
+        m = re.search(r"usage_usec (\d+)", stat)
+        if m: usage["cpu_s"] = int(m.group(1)) / 1e6
+        for key, name in (("mem_mb", "memory.current"), ("mem_peak_mb", "memory.peak")):
+            v = read_cgroup_file(path, name)
+            if v and v.strip().isdigit(): usage[key] = int(v) / 2**20
+        v = read_cgroup_file(path, "pids.current")
+        if v and v.strip().isdigit(): usage["pids"] = int(v)
+        usage["source"] = "cgroup"
+    usage["cpu_s"], usage["mem_mb"] = round(usage["cpu_s"], 2), round(usage["mem_mb"], 1)
+    if usage["mem_peak_mb"] is not None: usage["mem_peak_mb"] = round(usage["mem_peak_mb"], 1)
+    return usage
+
+def set_app_limits(target_id, **changes):
+    limits = dict((registry.get(target_id) or {}).get("limits", {}))
+    limits.update(changes)
+    registry.update(target_id, limits=limits)
+    # cgroup limits can be changed live; rlimits (and nofile) need a restart. Returns whether
+    # the change already applies to the running app.
+    live = cgroups_ok and os.path.isdir(cgroup_path(target_id)) and "nofile" not in changes
+    return bool(live and apply_cgroup_limits(target_id, app_limits(target_id)))
+
+# --- SCALE TO ZERO ---
+# Opt-in per app (registry meta "idle"). Every IDLE_CHECK_INTERVAL the process tree's CPU
+# time and I/O characters (socket traffic included) are compared with the last check; an
+# app below IDLE_CPU_PCT / IDLE_IO_BPS with no log output for `after` seconds is suspended.
+# It wakes on a /status hit, at a scheduled time of day, or on a manual Run.
+def idle_config(target_id):
+    return (registry.get(target_id) or {}).get("idle")
+
+def parse_idle(args):
+    mode = args[0].lower()
+    if mode not in ("freeze", "stop"): raise ValueError("Mode must be `freeze` or `stop`")
+    cfg = {"mode": mode, "after": 900.0, "wake": []}
+    for arg in args[1:]:
+        if arg.lower().startswith("wake="):
+            cfg["wake"] = [t for t in arg.split("=", 1)[1].split(",") if t]
+            for t in cfg["wake"]: time.strptime(t, "%H:%M")
+        else: cfg["after"] = float(arg) * 60
+    return cfg
+
+def fmt_idle(cfg):
+    return f"{cfg['mode']} after {fmt_duration(cfg['after'])}" + (f", wake at {', '.join(cfg['wake'])}" if cfg["wake"] else "")
+
+def app_rss(app):
+    total = 0
+    for p in process_tree(app.pid) if app.pid else []:
+        try: total += p.memory_info().rss
+        except psutil.Error: pass
+    return total
+
+def app_activity(app):
+    cpu = chars = 0
+    for p in process_tree(app.pid) if app.pid else []:
+        try:
+            with p.oneshot():
+                t = p.cpu_times()
+                cpu += t.user + t.system
+                io = p.io_counters()
+                chars += getattr(io, "read_chars", io.read_bytes) + getattr(io, "write_chars", io.write_bytes)
+        except (psutil.Error, AttributeError): pass
+    return cpu, chars
+
+def freeze_group(app, frozen=True):
+    path = os.path.join(cgroup_path(app.target_id), "cgroup.freeze")
+    if cgroups_ok and os.path.exists(path):
+        with open(path, "w") as f: f.write("1" if frozen else "0")
+        return "cgroup"
+    try: os.killpg(app.pid, signal.SIGSTOP if frozen else signal.SIGCONT)
+    except ProcessLookupError: pass
+    return "signal"
+
+def reclaim_memory(app):
+    # Ask the kernel to push a frozen cgroup's pages out (needs memory.reclaim and swap).
+    try:
+        with open(os.path.join(cgroup_path(app.target_id), "memory.reclaim"), "w") as f: f.write(str(app_rss(app)))
+    except OSError: pass
+
+def schedule_due(times, since, now):
+    for t in times:
+        h, m = map(int, t.split(":"))
+        for day in (now - 86400, now):
+            lt = time.localtime(day)
+            ts = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, h, m, 0, 0, 0, -1))
+            if since < ts <= now: return True
+    return False
+
+class IdleManager:
+    def __init__(self, interval=IDLE_CHECK_INTERVAL):
+        self.interval = interval
+        self.last_tick = time.time()
+
+    def start(self, loop):
+        loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try: await self.tick()
+            except Exception as e: logger.error(f"Idle check failed: {e}")
+
+    async def tick(self):
+        now, since = time.time(), self.last_tick
+        self.last_tick = now
+        for tid, app in list(supervisor.apps.items()):
+            cfg = idle_config(tid)
+            if not cfg: continue
+            if app.state in ("frozen", "idle"):
+                if schedule_due(cfg.get("wake", []), since, now): await supervisor.wake(tid, "schedule")
+                continue
+            if app.state != "running": continue
+            cpu, chars = await asyncio.to_thread(app_activity, app)
+            mark = app.activity
+            if not mark or mark["pid"] != app.pid:
+                app.activity = {"pid": app.pid, "ts": now, "cpu": cpu, "io": chars, "active": now}
+                continue
+            dt = max(now - mark["ts"], 1e-3)
+            busy = ((cpu - mark["cpu"]) / dt * 100 > IDLE_CPU_PCT or (chars - mark["io"]) / dt > IDLE_IO_BPS
+                    or (app.last_output or 0) > mark["ts"])
+            mark.update(ts=now, cpu=cpu, io=chars)
+            if busy: mark["active"] = now
+            elif now - mark["active"] >= cfg["after"]: await supervisor.suspend(tid, cfg["mode"])
+
+idle_manager = IdleManager()
+
+def idle_report():
+    apps = {tid: {"state": a.state, "suspension": a.suspension, "wakes": a.wakes} for tid, a in list(supervisor.apps.items())
+            if idle_config(tid) or a.suspension or a.wakes["count"]}
+    suspended = [a["suspension"] for a in apps.values() if a["suspension"]]
+    return {"apps": apps, "suspended": len(suspended), "resident_mb": round(sum(s["rss_mb"] for s in suspended), 1),
+            "freed_mb": round(sum(s["rss_before_mb"] - s["rss_mb"] for s in suspended), 1)}
+
+# --- STATS SAMPLER ---
+# One fixed-size ring buffer per app (and one for the host) holding an hour of samples,
+# written by a single background thread every SAMPLE_INTERVAL seconds.
+STATS_WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+APP_METRICS = ("cpu", "rss_mb", "threads", "fds", "read_bps", "write_bps")
+HOST_METRICS = ("cpu", "mem_pct", "load1", "load5", "load15")
+
+def percentile(values, q):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+class Sampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.capacity = int(max(STATS_WINDOWS.values()) / interval) + 1
+        self.host = deque(maxlen=self.capacity)
+        self.apps = {}
+        self.procs = {}
+        self.last_io = {}
+        self.started = False
+
+    def start(self):
+        if self.started: return
+        self.started = True
+        psutil.cpu_percent()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try: self.sample()
+            except Exception as e: logger.error(f"Sampler failed: {e}")
+            time.sleep(self.interval)
+
+    def _proc(self, pid):
+        # Reuse Process objects so cpu_percent() measures since the previous sample.
+        p = self.procs.get(pid)
+        if p is None:
+            p = self.procs[pid] = psutil.Process(pid)
+            p.cpu_percent()
+        return p
+
+    def sample(self):
+        now, seen = time.time(), set()
+        load = os.getloadavg()
+        self.host.append((now, {"cpu": psutil.cpu_percent(), "mem_pct": psutil.virtual_memory().percent,
+                                "load1": load[0], "load5": load[1], "load15": load[2]}))
+        for tid, app in list(supervisor.apps.items()):
+            if not app.pid: continue
+            values = {"cpu": 0.0, "rss_mb": 0.0, "threads": 0, "fds": 0}
+            read = write = 0
+            for p in process_tree(app.pid):
+                try:
+                    p = self._proc(p.pid)
+                    seen.add(p.pid)
+                    with p.oneshot():
+                        values["cpu"] += p.cpu_percent()
+                        values["rss_mb"] += p.memory_info().rss / 2**20
+                        values["threads"] += p.num_threads()
+                        values["fds"] += p.num_fds()
+                        try:
+                            io = p.io_counters()
+                            read, write = read + io.read_bytes, write + io.write_bytes
+                        except (psutil.AccessDenied, AttributeError): pass
+                except psutil.Error: pass
+            last = self.last_io.get(tid)
+            dt = now - last[0] if last else 0
+            values["read_bps"] = max(0, (read - last[1]) / dt) if dt else 0
+            values["write_bps"] = max(0, (write - last[2]) / dt) if dt else 0
+            self.last_io[tid] = (now, read, write)
+            values["cpu"], values["rss_mb"] = round(values["cpu"], 1), round(values["rss_mb"], 1)
+            self.apps.setdefault(tid, deque(maxlen=self.capacity)).append((now, values))
+        for pid in set(self.procs) - seen: del self.procs[pid]
+        for tid in set(self.apps) - set(supervisor.apps):
+            self.apps.pop(tid, None)
+            self.last_io.pop(tid, None)
+
+    def _summarize(self, buf, metrics):
+        samples = list(buf)
+        if not samples: return {}
+        now = time.time()
+        out = {"ts": samples[-1][0], "current": samples[-1][1]}
+        for name, seconds in STATS_WINDOWS.items():
+            window = [v for ts, v in samples if ts >= now - seconds]
+            out[name] = {m: {"p50": percentile([v[m] for v in window], 50), "p95": percentile([v[m] for v in window], 95)} for m in metrics}
+        return out
+
+    def app_summary(self, target_id):
+        return self._summarize(self.apps.get(target_id, ()), APP_METRICS)
 
-def run_flask():
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
+    def summary(self, targets=None):
+        targets = list(self.apps) if targets is None else [t for t in targets if t in self.apps]
+        return {"host": self._summarize(self.host, HOST_METRICS), "apps": {t: self.app_summary(t) for t in targets}}
+
+sampler = Sampler()
+
+# --- GIT UPDATES ---
+# Redeploys fetch into the existing shallow checkout, reinstall only when a manifest
+# changed and restart only the targets whose directory was touched.
+DEP_MANIFESTS = ("requirements.txt", "package.json", "package-lock.json")
+repo_locks = {}
+
+async def run_git(repo_path, *args):
+    proc = await asyncio.create_subprocess_exec("git", "-C", repo_path, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    out, err = await proc.communicate()
+    if proc.returncode: raise RuntimeError(f"git {args[0]} failed: {err.decode(errors='replace').strip()[-300:]}")
+    return out.decode(errors="replace").strip()
+
+async def repo_origin(repo_path):
+    if not os.path.isdir(os.path.join(repo_path, ".git")): return None
+    try: return await run_git(repo_path, "remote", "get-url", "origin")
+    except RuntimeError: return None
+
+def repo_targets(repo_name):
+    return [tid for tid in list(registry.ownership) if "|" in tid and tid.split("|")[0] == repo_name]
+
+def target_touched(target_id, changed):
+    script_dir = os.path.dirname(target_id.split("|", 1)[1])
+    return any(not script_dir or f.startswith(script_dir + "/") for f in changed)
+
+async def git_update(repo_name, progress=None):
+    repo_path = os.path.join(UPLOAD_DIR, repo_name)
+    async with repo_locks.setdefault(repo_name, asyncio.Lock()):
+        old = await run_git(repo_path, "rev-parse", "HEAD")
+        await build_queue.run("fetch", repo_name, [("Fetching", ["git", "-C", repo_path, "fetch", "--progress", "--depth", "1", "origin"], None)], progress=progress)
+        new = await run_git(repo_path, "rev-parse", "FETCH_HEAD")
+        result = {"old": old[:7], "new": new[:7], "changed": [], "deps": [], "restarted": []}
+        if old == new: return result
+        changed = (await run_git(repo_path, "diff", "--name-only", old, new)).splitlines()
+        await run_git(repo_path, "reset", "--hard", new)
+        result["changed"] = changed
+        if "requirements.txt" in changed and os.path.exists(os.path.join(repo_path, "requirements.txt")):
+            result["deps"].append(f"Python: {await ensure_python_deps(os.path.join(repo_path, 'requirements.txt'), repo_path, progress)}")
+        if {"package.json", "package-lock.json"} & set(changed) and os.path.exists(os.path.join(repo_path, "package.json")):
+            result["deps"].append(f"Node: {await ensure_node_deps(repo_path, progress)}")
+        for tid in repo_targets(repo_name):
+            app = supervisor.get(tid)
+            if app and app.desired and (result["deps"] or target_touched(tid, changed)):
+                await prepare_app(tid, progress)
+                await supervisor.start(tid)
+                result["restarted"].append(tid)
+        return result
+
+def fmt_update_result(repo_name, result):
+    if not result["changed"]: return f"✅ `{repo_name}` is up to date ({result['new']})."
+    text = f"🔄 `{repo_name}` {result['old']} → {result['new']}: {len(result['changed'])} file(s) changed"
+    if result["deps"]: text += f"\n📦 Deps: {', '.join(result['deps'])}"
+    text += f"\n🔁 Restarted: {', '.join(f'`{t}`' for t in result['restarted']) or 'none'}"
+    return text
+
+async def git_poll_loop(application):
+    # Periodic remote polling for repos with at least one target opted into auto-update.
+    while True:
+        await asyncio.sleep(GIT_POLL_INTERVAL)
+        repos = {}
+        for tid, meta in list(registry.ownership.items()):
+            if "|" in tid and meta.get("autoupdate"): repos.setdefault(tid.split("|")[0], meta.get("owner"))
+        for repo_name, owner in repos.items():
+            try:
+                result = await git_update(repo_name)
+                if result["changed"]: await outbox.send(application.bot, owner, fmt_update_result(repo_name, result), parse_mode="Markdown")
+            except Exception as e:
+                logger.error(f"Auto-update of {repo_name} failed: {e}")
+
+# --- BULK OPERATIONS ---
+# One action over a selected set of apps, run in parallel under a concurrency cap, or in
+# rolling batches that must become healthy before the next batch starts. Used by
+# /bulk and POST /api/bulk (a job polled at GET /api/bulk/<id>); both get one aggregated report.
+BULK_ACTIONS = ("start", "stop", "restart", "redeploy", "delete")
+BULK_JOBS_KEEP = 50
+bulk_jobs = {}  # id -> job; the API polls these instead of holding a request open
+bulk_job_ids = itertools.count(1)
+
+def select_targets(scope=None, owner=None, repo=None, glob=None, crashed=False, every=False, targets=None):
+    # Criteria are ANDed. scope: the caller's uid (only their apps unless admin); None = all apps.
+    if owner is None and not (repo or glob or crashed or every or targets):
+        raise ValueError("No selector: use all, crashed, owner, repo, glob or targets")
+    with registry.lock: owners = {tid: meta.get("owner") for tid, meta in registry.ownership.items()}
+    pool = sorted(owners)
+    if scope is not None and scope != ADMIN_ID: pool = [t for t in pool if owners[t] == scope]
+    if targets: pool = [t for t in pool if t in set(targets)]
+    if owner is not None: pool = [t for t in pool if owners[t] == int(owner)]
+    if repo: pool = [t for t in pool if t in repo_targets(repo)]
+    if glob: pool = [t for t in pool if fnmatch.fnmatchcase(t, glob)]
+    if crashed: pool = [t for t in pool if supervisor.get(t) and supervisor.get(t).state in ("crashed", "backoff")]
+    return pool
+
+async def bulk_action(action, target_id):
+    if action == "start":
+        if supervisor.is_running(target_id): return "already running"
+        await supervisor.start(target_id, reason="bulk")
+    elif action in ("restart", "redeploy"):
+        if action == "redeploy":
+            # Re-resolve dependencies and force the build stage before restarting.
+            work_dir, _, _, req_path, _ = resolve_paths(target_id)
+            if os.path.exists(req_path): await ensure_python_deps(req_path, work_dir)
+            if os.path.exists(os.path.join(work_dir, "package.json")): await ensure_node_deps(work_dir)
+            registry.update(target_id, build=None)
+            await prepare_app(target_id)
+        await supervisor.start(target_id, reason="bulk")
+    elif action == "stop": await supervisor.stop(target_id)
+    elif action == "delete":
+        await supervisor.remove(target_id)
+        await asyncio.to_thread(purge_target_files, target_id)
+        delete_ownership(target_id)
+        return "deleted"
+    app = supervisor.get(target_id)
+    state = app.state if app else "stopped"
+    if action != "stop" and state not in ("running", "starting"): raise RuntimeError(f"{state} after {action}")
+    return state
+
+async def bulk_run(action, targets, concurrency=BULK_CONCURRENCY, rolling=False, batch=1, progress=None):
+    t0, results, halted = time.time(), {}, []
+    sem = asyncio.Semaphore(max(1, concurrency))
+    async def one(tid):
+        async with sem:
+            start = time.perf_counter()
+            try: results[tid] = {"ok": True, "detail": await bulk_action(action, tid)}
+            except Exception as e: results[tid] = {"ok": False, "detail": str(e)}
+            results[tid]["seconds"] = round(time.perf_counter() - start, 2)
+            metrics.inc("bothost_bulk_actions_total", action=action, result="ok" if results[tid]["ok"] else "failed")
+            if progress: await progress(len(results), len(targets))
+    if not rolling: await asyncio.gather(*(one(t) for t in targets))
+    else:
+        for i in range(0, len(targets), max(1, batch)):
+            group = targets[i:i + max(1, batch)]
+            await asyncio.gather(*(one(t) for t in group))
+            if action not in ("start", "restart", "redeploy"): continue
+            deadline = time.time() + BULK_ROLLING_TIMEOUT
+            while time.time() < deadline and not all(is_healthy(t) for t in group if results[t]["ok"]):
+                await asyncio.sleep(0.5)
+            for t in group:
+                if results[t]["ok"] and not is_healthy(t): results[t] = dict(results[t], ok=False, detail=f"not healthy within {BULK_ROLLING_TIMEOUT:.0f}s")
+            if not all(results[t]["ok"] for t in group):
+                halted = targets[i + len(group):]
+                break
+    ok = sum(1 for r in results.values() if r["ok"])
+    return {"action": action, "selected": len(targets), "ok": ok, "failed": len(results) - ok, "halted": halted,
+            "rolling": rolling, "concurrency": concurrency, "took_s": round(time.time() - t0, 2), "results": results}
+
+def start_bulk_job(action, targets, concurrency, rolling, batch):
+    # Runs bulk_run on the supervisor loop; the returned job dict fills in as it progresses.
+    job = {"id": next(bulk_job_ids), "action": action, "state": "running", "selected": len(targets), "done": 0,
+           "created": time.time(), "report": None, "error": None}
+    bulk_jobs[job["id"]] = job
+    for old in sorted(bulk_jobs)[:-BULK_JOBS_KEEP]: bulk_jobs.pop(old, None)
+    async def progress(done, total): job["done"] = done
+    async def run():
+        try: job["report"] = await bulk_run(action, targets, concurrency, rolling, batch, progress)
+        except Exception as e: job["error"] = str(e)
+        job["state"] = "failed" if job["error"] else "done"
+    supervisor.submit(run())
+    return job
+
+def fmt_bulk_report(report):
+    # HTML: failure details are raw exception text.
+    text = (f"📦 Bulk {report['action']}: {report['ok']}/{report['selected']} ok in {report['took_s']}s"
+            + (" (rolling)" if report["rolling"] else f" (concurrency {report['concurrency']})"))
+    failed = [(t, r["detail"]) for t, r in report["results"].items() if not r["ok"]]
+    for tid, detail in failed[:20]: text += f"\n❌ <code>{html.escape(tid)}</code>: {html.escape(detail[:120])}"
+    if len(failed) > 20: text += f"\n… and {len(failed) - 20} more"
+    if report["halted"]: text += f"\n⏸️ Halted before {len(report['halted'])} app(s): " + ", ".join(f"<code>{html.escape(t)}</code>" for t in report["halted"][:10])
+    return text
+
+# --- REPO SCANNER ---
+# Finds runnable files without descending into vendored/VCS dirs, ranks likely entry
+# points first and caches the result per commit.
+RUNNABLE_EXTS = ('.py', '.js', '.sh')
+PRUNE_DIRS = {".git", "node_modules", "__pycache__", "venv", ".venv", "env", "site-packages", "dist", "build", ".tox",
+              ".mypy_cache", ".pytest_cache", ".next", "vendor", "bower_components", ".idea", ".vscode", ".cache"}
+ENTRY_NAMES = {"main.py": 60, "bot.py": 60, "app.py": 50, "run.py": 50, "__main__.py": 45, "server.py": 40, "start.sh": 40,
+               "index.js": 55, "main.js": 50, "bot.js": 50, "server.js": 45, "app.js": 45, "run.sh": 35}
+CMD_FILE_RE = re.compile(r"([\w./-]+\.(?:py|js|sh))\b")
+scan_cache = {}
+
+def declared_entry_points(repo_path):
+    # Files named by Procfile commands and package.json main/scripts.
+    found = {}
+    procfile = os.path.join(repo_path, "Procfile")
+    if os.path.exists(procfile):
+        with open(procfile, errors="replace") as f:
+            for line in f:
+                for m in CMD_FILE_RE.findall(line.split(":", 1)[-1]): found[os.path.normpath(m)] = 100
+    pkg = read_json(os.path.join(repo_path, "package.json"), {})
+    if isinstance(pkg, dict):
+        if isinstance(pkg.get("main"), str): found.setdefault(os.path.normpath(pkg["main"]), 90)
+        for name, cmd in (pkg.get("scripts") or {}).items():
+            if isinstance(cmd, str):
+                for m in CMD_FILE_RE.findall(cmd): found[os.path.normpath(m)] = max(found.get(os.path.normpath(m), 0), 95 if name == "start" else 70)
+    return found
+
+def score_entry(rel, declared, repo_path):
+    name, depth = os.path.basename(rel), rel.count(os.sep)
+    score = declared.get(rel, 0) + ENTRY_NAMES.get(name, 0) - 5 * depth
+    if name.startswith("test_") or name.endswith(("_test.py", ".test.js", ".spec.js")) or "tests" in rel.split(os.sep): score -= 40
+    if name == "setup.py" or name.startswith(("conftest", ".")): score -= 30
+    if name.endswith(".py") and score < 100:
+        try:
+            with open(os.path.join(repo_path, rel), errors="replace") as f:
+                if "__main__" in f.read(32768): score += 20
+        except OSError: pass
+    return score
+
+def scan_repo(repo_path):
+    declared = declared_entry_points(repo_path)
+    files = []
+    for root, dirs, fs in os.walk(repo_path):
+        dirs[:] = sorted(d for d in dirs if d not in PRUNE_DIRS and not os.path.exists(os.path.join(root, d, "pyvenv.cfg")))
+        for f in fs:
+            if f.endswith(RUNNABLE_EXTS): files.append(os.path.relpath(os.path.join(root, f), repo_path))
+    scored = sorted(((score_entry(f, declared, repo_path), f) for f in files), key=lambda x: (-x[0], x[1]))
+    return [{"file": f, "score": sc} for sc, f in scored]
+
+async def scan_repo_cached(repo_path):
+    try: commit = await run_git(repo_path, "rev-parse", "HEAD")
+    except RuntimeError: commit = str(os.path.getmtime(repo_path))
+    cached = scan_cache.get(repo_path)
+    if cached and cached[0] == commit: return cached[1]
+    files = await asyncio.to_thread(scan_repo, repo_path)
+    scan_cache[repo_path] = (commit, files)
+    return files
+
+def file_selection_page(files, page):
+    pages = max(1, math.ceil(len(files) / SCAN_PAGE_SIZE))
+    page = max(0, min(page, pages - 1))
+    keyboard = []
+    for i in range(page * SCAN_PAGE_SIZE, min(len(files), (page + 1) * SCAN_PAGE_SIZE)):
+        star = "⭐ " if files[i]["score"] >= 50 else ""
+        keyboard.append([InlineKeyboardButton(f"{star}{files[i]['file']}", callback_data=f"selidx_{i}")])
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"selpg_{page - 1}"))
+    if page < pages - 1: nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"selpg_{page + 1}"))
+    if nav: keyboard.append(nav)
+    return f"👇 **Select:** ({len(files)} files, page {page + 1}/{pages})", InlineKeyboardMarkup(keyboard)
 
 # --- UTILS & DATA ---
 def get_allowed_users():
-    if not os.path.exists(USERS_FILE): return []
-    try:
-        with open(USERS_FILE, 'r') as f: return json.load(f)
-    except: return []
+    return sorted(registry.users)
 
 def save_allowed_user(uid):
-    users = get_allowed_users()
-    if uid not in users:
-        users.append(uid)
-        with open(USERS_FILE, 'w') as f: json.dump(users, f)
-        return True
-    return False
+    return registry.add_user(uid)
 
 def remove_allowed_user(uid):
-    users = get_allowed_users()
-    if uid in users:
-        users.remove(uid)
-        with open(USERS_FILE, 'w') as f: json.dump(users, f)
-        return True
-    return False
+    return registry.remove_user(uid)
 
 def load_ownership():
-    if not os.path.exists(OWNERSHIP_FILE): return {}
-    try:
-        with open(OWNERSHIP_FILE, 'r') as f: return json.load(f)
-    except: return {}
+    return dict(registry.ownership)
 
 def save_ownership(target_id, user_id, type_):
-    data = {}
-    if os.path.exists(OWNERSHIP_FILE):
-        with open(OWNERSHIP_FILE, 'r') as f: data = json.load(f)
-    data[target_id] = {"owner": user_id, "type": type_}
-    with open(OWNERSHIP_FILE, 'w') as f: json.dump(data, f)
+    registry.set_owner(target_id, user_id, type_)
 
 def delete_ownership(target_id):
-    if not os.path.exists(OWNERSHIP_FILE): return
-    with open(OWNERSHIP_FILE, 'r') as f: data = json.load(f)
-    if target_id in data: del data[target_id]
-    with open(OWNERSHIP_FILE, 'w') as f: json.dump(data, f)
+    registry.delete(target_id)
 
 def get_owner(target_id):
-    data = load_ownership()
-    return data.get(target_id, {}).get("owner")
+    return registry.owner(target_id)
 
 def resolve_paths(target_id):
     if "|" in target_id:
@@ -257,35 +3450,34 @@ def resolve_paths(target_id):
         full_script_path = os.path.join(work_dir, target_id)
     return work_dir, script_path, env_path, req_path, full_script_path
 
-async def install_dependencies(work_dir, update):
+async def install_dependencies(work_dir, update, msg=None):
     # This is for Git Repos (Generic Requirements.txt)
-    msg = None
+    req_path, pkg_path = os.path.join(work_dir, "requirements.txt"), os.path.join(work_dir, "package.json")
+    if not os.path.exists(req_path) and not os.path.exists(pkg_path): return
+    if not msg: msg = await outbox.reply(update.message, "⏳ Installing Deps...")
+    start = time.perf_counter()
     try:
-        if os.path.exists(os.path.join(work_dir, "requirements.txt")):
-            if not msg: msg = await update.message.reply_text("⏳ Installing Python Deps...")
-            proc = await asyncio.create_subprocess_exec("pip", "install", "-r", "requirements.txt", cwd=work_dir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            await proc.communicate()
-        
-        if os.path.exists(os.path.join(work_dir, "package.json")):
-            if not msg: msg = await update.message.reply_text("⏳ Installing Node Deps...")
-            else: await msg.edit_text("⏳ Installing Node Deps...")
-            proc = await asyncio.create_subprocess_exec("npm", "install", cwd=work_dir, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            await proc.communicate()
-            
-        if msg: await msg.edit_text("✅ Dependencies Installed!")
+        done = []
+        if os.path.exists(req_path): done.append(f"Python: {await ensure_python_deps(req_path, work_dir, message_progress(msg))}")
+        if os.path.exists(pkg_path): done.append(f"Node: {await ensure_node_deps(work_dir, message_progress(msg))}")
+        metrics.observe("bothost_install_seconds", time.perf_counter() - start, result="ok")
+        await outbox.edit(msg, f"✅ Dependencies Installed! ({', '.join(done)})")
     except Exception as e:
-        if msg: await msg.edit_text(f"❌ Error: {e}")
+        metrics.observe("bothost_install_seconds", time.perf_counter() - start, result="failed")
+        await outbox.edit(msg, f"❌ Error: {e}")
 
 # --- DECORATORS ---
 def restricted(func):
+    @functools.wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        if update.effective_user.id != ADMIN_ID and update.effective_user.id not in get_allowed_users():
+        if update.effective_user.id != ADMIN_ID and not registry.is_allowed(update.effective_user.id):
             await update.message.reply_text("⛔ Access Denied.")
             return
         return await func(update, context, *args, **kwargs)
     return wrapped
 
 def super_admin_only(func):
+    @functools.wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         if update.effective_user.id != ADMIN_ID:
             await update.message.reply_text("⛔ Super Admin Only.")
@@ -326,9 +3518,14 @@ async def receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     fname = update.message.document.file_name
     uid = update.effective_user.id
     if not fname.endswith(('.py', '.js', '.sh')): return await update.message.reply_text("❌ Invalid type.")
+    try: await asyncio.to_thread(check_quota, uid, update.message.document.file_size or 0)
+    except QuotaExceeded as e:
+        await update.message.reply_text(f"❌ {e}", reply_markup=main_menu_keyboard())
+        return ConversationHandler.END
     
     path = os.path.join(UPLOAD_DIR, fname)
     await file.download_to_drive(path)
+    invalidate_usage(path)
     save_ownership(fname, uid, "file")
     context.user_data.update({'type': 'file', 'target_id': fname, 'work_dir': UPLOAD_DIR})
     await update.message.reply_text(f"✅ Saved.", reply_markup=extras_keyboard())
@@ -373,22 +3570,21 @@ async def receive_extra_files(update: Update, context: ContextTypes.DEFAULT_TYPE
         path = os.path.join(UPLOAD_DIR, f"{target_id}_req.txt")
     
     if path:
+        try: await asyncio.to_thread(check_quota, update.effective_user.id, update.message.document.file_size or 0)
+        except QuotaExceeded as e: return await update.message.reply_text(f"❌ {e}") or WAIT_EXTRAS
         await file.download_to_drive(path)
-        msg = await update.message.reply_text("⏳ **Installing Dependencies...**")
+        invalidate_usage(path)
+        msg = await outbox.reply(update.message, "⏳ **Installing Dependencies...**")
         try:
             # Explicitly run install on the specific file path
-            if fname.endswith(".txt"):
-                proc = await asyncio.create_subprocess_exec("pip", "install", "-r", path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-                await proc.communicate()
-            elif fname == "package.json":
-                proc = await asyncio.create_subprocess_exec("npm", "install", cwd=UPLOAD_DIR, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-                await proc.communicate()
-            await msg.edit_text("✅ **Installed!**")
+            if fname.endswith(".txt"): result = await ensure_python_deps(path, UPLOAD_DIR, message_progress(msg))
+            else: result = await ensure_node_deps(UPLOAD_DIR, message_progress(msg))
+            await outbox.edit(msg, f"✅ **Installed!** ({result})")
         except Exception as e:
-            await msg.edit_text(f"❌ Error: {e}")
+            await outbox.edit(msg, f"❌ Error: {e}")
         
     context.user_data['wait'] = None
-    await update.message.reply_text("Next?", reply_markup=extras_keyboard())
+    await outbox.reply(update.message, "Next?", reply_markup=extras_keyboard())
     return WAIT_EXTRAS
 
 # --- GIT HANDLERS ---
@@ -402,15 +3598,34 @@ async def receive_git_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if url == "🔙 Cancel": return await cancel(update, context)
     repo_name = url.split("/")[-1].replace(".git", "")
     repo_path = os.path.join(UPLOAD_DIR, repo_name)
-    if os.path.exists(repo_path): shutil.rmtree(repo_path)
+    msg = await outbox.reply(update.message, "⏳ Cloning...")
     try:
-        subprocess.check_call(["git", "clone", url, repo_path])
-        await install_dependencies(repo_path, update)
+        await asyncio.to_thread(check_quota, update.effective_user.id)
+        updated = False
+        if await repo_origin(repo_path) == url:
+            try:
+                result = await git_update(repo_name, progress=message_progress(msg))
+                await outbox.edit(msg, fmt_update_result(repo_name, result), parse_mode="Markdown")
+                updated = True
+            except Exception as e:
+                logger.warning(f"Incremental update of {repo_name} failed, re-cloning: {e}")
+        if not updated:
+            if os.path.exists(repo_path): shutil.rmtree(repo_path)
+            invalidate_usage(repo_path)
+            try:
+                await build_queue.run("clone", repo_name, [git_clone_step(url, repo_path)], progress=message_progress(msg))
+                await asyncio.to_thread(check_quota, update.effective_user.id, 0, [repo_path])
+            except Exception:
+                shutil.rmtree(repo_path, ignore_errors=True)
+                invalidate_usage(repo_path)
+                raise
+            await outbox.edit(msg, "✅ Cloned!")
+            await install_dependencies(repo_path, update)
         context.user_data.update({'repo_path': repo_path, 'repo_name': repo_name, 'target_id': f"{repo_name}|PLACEHOLDER", 'type': 'repo', 'work_dir': repo_path})
-        await update.message.reply_text("⚙️ **Setup**", reply_markup=git_extras_keyboard())
+        await outbox.reply(update.message, "⚙️ **Setup**", reply_markup=git_extras_keyboard())
         return WAIT_GIT_EXTRAS
     except Exception as e:
-        await update.message.reply_text(f"❌ Error: {e}")
+        await outbox.edit(msg, f"❌ Error: {e}")
         return ConversationHandler.END
 
 async def receive_git_extras(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -424,19 +3639,26 @@ async def receive_git_extras(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def show_file_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     repo_path = context.user_data['repo_path']
-    files = []
-    for root, _, fs in os.walk(repo_path):
-        for f in fs:
-            if f.endswith(('.py', '.js', '.sh')): files.append(os.path.relpath(os.path.join(root, f), repo_path))
+    files = await scan_repo_cached(repo_path)
     if not files: return await update.message.reply_text("❌ No executable files.")
-    keyboard = [[InlineKeyboardButton(f, callback_data=f"sel_py_{f}")] for f in files[:15]]
-    await update.message.reply_text("👇 **Select:**", reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data['scan'] = files
+    text, markup = file_selection_page(files, 0)
+    await update.message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
     return WAIT_SELECT_FILE
 
 async def select_git_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    filename = query.data.split("sel_py_")[1]
+    files = context.user_data.get('scan', [])
+    if query.data.startswith("selpg_"):
+        text, markup = file_selection_page(files, int(query.data.split("selpg_")[1]))
+        await query.edit_message_text(text, reply_markup=markup, parse_mode="Markdown")
+        return WAIT_SELECT_FILE
+    if query.data.startswith("selidx_"):
+        idx = int(query.data.split("selidx_")[1])
+        if idx >= len(files): return WAIT_SELECT_FILE
+        filename = files[idx]["file"]
+    else: filename = query.data.split("sel_py_")[1]
     repo_name = context.user_data['repo_name']
     unique_id = f"{repo_name}|{filename}"
     save_ownership(unique_id, update.effective_user.id, "repo")
@@ -445,25 +3667,30 @@ async def select_git_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await execute_logic(query, context)
 
 async def execute_logic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg_func = update.message.reply_text if update.message else update.callback_query.message.reply_text
+    message = update.message if update.message else update.callback_query.message
     target_id = context.user_data.get('target_id', context.user_data.get('fallback_id'))
-    restart_process_background(target_id)
+    msg = None
+    async def progress(text):
+        # The progress message only appears once prepare_app has a build step to report.
+        nonlocal msg
+        if msg: outbox.edit(msg, text, parse_mode="Markdown")
+        else: msg = await outbox.reply(message, text, parse_mode="Markdown")
+    if await prepare_app(target_id, progress) and msg: outbox.edit(msg, f"🧱 {fmt_build(registry.get(target_id)['build'])}")
+    await supervisor.start(target_id)
     url = f"{BASE_URL}/status?script={target_id}"
-    await msg_func(f"🚀 **Launched!**\n🔗 `{url}`", parse_mode="Markdown", reply_markup=main_menu_keyboard())
+    await outbox.reply(message, f"🚀 **Launched!**\n🔗 `{url}`", parse_mode="Markdown", reply_markup=main_menu_keyboard())
     return ConversationHandler.END
 
 # --- MANAGE HANDLER ---
 @restricted
 async def list_hosted(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not os.path.exists(OWNERSHIP_FILE): return await update.message.reply_text("📂 Empty.")
-    with open(OWNERSHIP_FILE) as f: ownership = json.load(f)
+    if not registry.ownership: return await update.message.reply_text("📂 Empty.")
     
     keyboard = []
-    for tid, meta in ownership.items():
-        if uid == ADMIN_ID or uid == meta.get("owner"):
-            status = "🟢" if tid in running_processes and running_processes[tid]['process'].poll() is None else "🔴"
-            keyboard.append([InlineKeyboardButton(f"{status} {tid}", callback_data=f"man_{tid}")])
+    for tid in registry.targets_for(uid):
+        status = "🟢" if supervisor.is_running(tid) else "🔴"
+        keyboard.append([InlineKeyboardButton(f"{status} {tid}", callback_data=f"man_{tid}")])
     if not keyboard: return await update.message.reply_text("📂 No apps.")
     await update.message.reply_text("📂 **Select App:**", reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -478,10 +3705,30 @@ async def manage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         owner = get_owner(tid)
         if uid != ADMIN_ID and uid != owner: return await query.message.reply_text("⛔ Not yours.")
         work_dir, script_path, env_path, req_path, _ = resolve_paths(tid)
-        is_running = tid in running_processes and running_processes[tid]['process'].poll() is None
+        proc = supervisor.get(tid)
+        is_running = supervisor.is_running(tid)
         status = "🟢 Running" if is_running else "🔴 Stopped"
+        if proc and proc.state not in ("running", "stopped"): status = f"🟠 {proc.state.capitalize()}"
         
         text = f"⚙️ **App:** `{tid}`\nStatus: {status}"
+        if proc:
+            if is_running: text += f"\nUptime: {fmt_duration(proc.uptime())} (pid {proc.pid})"
+            if proc.restarts: text += f"\nRestarts: {proc.restarts}"
+            if proc.exit_code is not None: text += f"\nLast exit: {proc.exit_code}"
+            if proc.health and health_config(tid):
+                h = proc.health
+                text += f"\nHealth: {h['status']}" + (f" ({h['last_error']})" if h["last_error"] else "")
+                if h["last_failure"] and h["status"] != "unhealthy": text += f"\nLast health failure: {fmt_duration(time.time() - h['last_failure']['at'])} ago"
+        text += f"\nRestart policy: {restart_policy(tid)}"
+        if cluster.enabled(): text += f"\nNode: {cluster.node_of(tid) or 'local'}"
+        if idle_config(tid): text += f"\nIdle policy: {fmt_idle(idle_config(tid))}"
+        if proc and proc.suspension:
+            sus = proc.suspension
+            text += f"\n💤 Suspended {fmt_duration(time.time() - sus['since'])} ({sus['mode']}), RSS {sus['rss_before_mb']} → {sus['rss_mb']} MB"
+        if proc and proc.wakes["count"]: text += f"\nWakes: {proc.wakes['count']}, last {proc.wakes['last_ms']} ms ({proc.wakes['last_trigger']})"
+        if proc and proc.first_log is not None: text += f"\nCold start: first log line {proc.first_log * 1000:.0f} ms after launch"
+        if (registry.get(tid) or {}).get("build"): text += f"\nBuild: {fmt_build(registry.get(tid)['build'])}"
+        text += f"\nDisk: {await asyncio.to_thread(app_disk_usage, tid) / 2**20:.1f} MB"
         btns = []
         
         row1 = []
@@ -489,7 +3736,7 @@ async def manage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             row1.append(InlineKeyboardButton("🛑 Stop", callback_data=f"stop_{tid}"))
             row1.append(InlineKeyboardButton("🔗 URL", callback_data=f"url_{tid}"))
         else:
-            row1.append(InlineKeyboardButton("🚀 Run", callback_data=f"rerun_{tid}"))
+            row1.append(InlineKeyboardButton("☀️ Wake" if proc and proc.suspension else "🚀 Run", callback_data=f"rerun_{tid}"))
         btns.append(row1)
         
         editable_files = []
@@ -505,45 +3752,135 @@ async def manage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_btns = []
         for f in editable_files:
             label = "✏️ Main Code" if f == script_path else f"✏️ {f}"
-            url = f"{BASE_URL}/editor?id={tid}&file={f}&uid={uid}"
+            url = f"{BASE_URL}/editor?{urllib.parse.urlencode({'id': tid, 'file': f})}&{signed_query(uid)}"
             file_btns.append(InlineKeyboardButton(label, web_app=WebAppInfo(url=url)))
         
         for i in range(0, len(file_btns), 2):
             btns.append(file_btns[i:i+2])
 
-        btns.append([InlineKeyboardButton("📜 Logs", callback_data=f"log_{tid}"), InlineKeyboardButton("🗑️ Delete", callback_data=f"del_{tid}")])
+        if "|" in tid:
+            auto = "on" if (registry.get(tid) or {}).get("autoupdate") else "off"
+            btns.append([InlineKeyboardButton("🔄 Update", callback_data=f"upd_{tid}"), InlineKeyboardButton(f"🔁 Auto-update: {auto}", callback_data=f"auto_{tid}")])
+
+        btns.append([InlineKeyboardButton("📜 Logs", callback_data=f"log_{tid}"), InlineKeyboardButton("📏 Limits", callback_data=f"lim_{tid}")])
+        btns.append([InlineKeyboardButton("♻️ Policy", callback_data=f"pol_{tid}"), InlineKeyboardButton(f"⚡ Reload: {reload_mode(tid)}", callback_data=f"rld_{tid}"),
+                     InlineKeyboardButton("🗑️ Delete", callback_data=f"del_{tid}")])
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode="Markdown")
 
     elif data.startswith("stop_"):
         tid = data.split("stop_")[1]
-        if tid in running_processes:
-            os.killpg(os.getpgid(running_processes[tid]['process'].pid), signal.SIGTERM)
+        if supervisor.get(tid):
+            await supervisor.stop(tid)
             await query.edit_message_text(f"🛑 Stopped `{tid}`")
+
+    elif data.startswith(("lim_", "limmem_", "limcpu_", "limpid_")):
+        prefix, tid = data.split("_", 1)
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        key = {"limmem": "mem_mb", "limcpu": "cpu", "limpid": "pids"}.get(prefix)
+        live = None
+        if key:
+            presets = LIMIT_PRESETS[key]
+            current = app_limits(tid)[key]
+            live = set_app_limits(tid, **{key: presets[(presets.index(current) + 1) % len(presets)] if current in presets else presets[0]})
+        if cluster.node_of(tid):
+            try: u = await cluster.usage(tid)
+            except RuntimeError as e: return await query.message.reply_text(f"❌ {e}")
+        else: u = app_usage(tid)
+        text = (f"📏 **Limits:** `{tid}`\n{fmt_limits(app_limits(tid))}\n\n"
+                f"📈 **Usage** ({u['source']}): CPU {u['cpu_s']}s total | RAM {u['mem_mb']} MB"
+                + (f" (peak {u['mem_peak_mb']} MB)" if u['mem_peak_mb'] is not None else "")
+                + f" | PIDs {u['pids']} | FDs {u['fds']}\n\n"
+                f"Exact values: `/limits {tid} mem=512 cpu=50" + (" pids=64" if cgroups_available() else "") + " nofile=1024`"
+                + (f"\n{fmt_applied(live)}" if live is not None else ""))
+        btns = [[InlineKeyboardButton("🧠 Memory", callback_data=f"limmem_{tid}"), InlineKeyboardButton("⚡ CPU", callback_data=f"limcpu_{tid}")],
+                [InlineKeyboardButton("🔙 Back", callback_data=f"man_{tid}")]]
+        if cgroups_available(): btns[0].append(InlineKeyboardButton("🔢 PIDs", callback_data=f"limpid_{tid}"))
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode="Markdown")
+
+    elif data.startswith("upd_"):
+        tid = data.split("upd_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        repo_name = tid.split("|")[0]
+        msg = await outbox.reply(query.message, f"⏳ Updating `{repo_name}`...", parse_mode="Markdown")
+        try: await outbox.edit(msg, fmt_update_result(repo_name, await git_update(repo_name, progress=message_progress(msg))), parse_mode="Markdown")
+        except Exception as e: await outbox.edit(msg, f"❌ Update failed: {e}")
+
+    elif data.startswith("auto_"):
+        tid = data.split("auto_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        enabled = not (registry.get(tid) or {}).get("autoupdate")
+        registry.update(tid, autoupdate=enabled)
+        note = "" if GIT_POLL_INTERVAL else " (polling is disabled on this host: set GIT_POLL_INTERVAL)"
+        await query.message.reply_text(f"🔁 Auto-update for `{tid}`: {'on' if enabled else 'off'}{note}", parse_mode="Markdown")
+
+    elif data.startswith("rld_"):
+        tid = data.split("rld_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        new = "cold" if reload_mode(tid) == "swap" else "swap"
+        registry.update(tid, reload=new)
+        note = ("\nEdits start the new version next to the old one and switch over once it is ready"
+                " (alive " + f"{RELOAD_READY_SECS:g}s, or `/ready {tid} <regex>` matched in its output)." if new == "swap" else "")
+        await query.message.reply_text(f"⚡ Reload mode for `{tid}`: {new}{note}", parse_mode="Markdown")
+
+    elif data.startswith("pol_"):
+        tid = data.split("pol_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        policies = ["on-failure", "always", "never"]
+        current = restart_policy(tid)
+        new = policies[(policies.index(current) + 1) % len(policies)] if current in policies else policies[0]
+        registry.update(tid, restart_policy=new)
+        await query.message.reply_text(f"♻️ Restart policy for `{tid}`: {new}", parse_mode="Markdown")
     
     elif data.startswith("rerun_"):
-        context.user_data['fallback_id'] = data.split("rerun_")[1]
+        tid = data.split("rerun_")[1]
+        app_proc = supervisor.get(tid)
+        if app_proc and app_proc.state in ("frozen", "idle"):
+            try: latency = await supervisor.wake(tid, "manual")
+            except RuntimeError as e: return await query.message.reply_text(f"❌ {e}")
+            text = f"☀️ `{tid}` woke up in {latency * 1000:.0f} ms" if latency is not None else f"☀️ `{tid}` is already awake"
+            return await query.edit_message_text(text, parse_mode="Markdown")
+        context.user_data['fallback_id'] = tid
         await query.delete_message()
         await execute_logic(update, context)
 
     elif data.startswith("del_"):
         tid = data.split("del_")[1]
-        if tid in running_processes:
-            try: os.killpg(os.getpgid(running_processes[tid]['process'].pid), signal.SIGTERM)
-            except: pass
-            del running_processes[tid]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        await supervisor.remove(tid)
+        await asyncio.to_thread(purge_target_files, tid)
         delete_ownership(tid)
-        work_dir, _, _, _, _ = resolve_paths(tid)
-        if "|" in tid: shutil.rmtree(work_dir, ignore_errors=True)
-        else: 
-             try: os.remove(os.path.join(UPLOAD_DIR, tid))
-             except: pass
         await query.edit_message_text(f"🗑️ Deleted `{tid}`")
 
     elif data.startswith("log_"):
         tid = data.split("log_")[1]
-        path = os.path.join(UPLOAD_DIR, f"{tid.replace('|','_')}.log")
-        if os.path.exists(path): await context.bot.send_document(chat_id=update.effective_chat.id, document=open(path, 'rb'))
-        else: await query.message.reply_text("❌ No logs.")
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        try: text = await read_log(tid)
+        except RuntimeError as e: return await query.message.reply_text(f"❌ {e}")
+        if text is None: return await query.message.reply_text("❌ No logs.")
+        text = text[-3800:] or "(empty)"
+        btns = [[InlineKeyboardButton("🔄 Refresh", callback_data=f"logr_{tid}"), InlineKeyboardButton("📄 Full Log", callback_data=f"logf_{tid}")]]
+        if PUBLIC_URL: btns.append([InlineKeyboardButton("📡 Live", url=f"{PUBLIC_URL}/logs?id={urllib.parse.quote(tid)}&follow=1&{signed_query(uid)}")])
+        await query.message.reply_text(f"📜 <b>{html.escape(tid)}</b> (last {LOG_TAIL_LINES} lines)\n<pre>{html.escape(text)}</pre>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(btns))
+
+    elif data.startswith("logr_"):
+        tid = data.split("logr_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        try: text = (await read_log(tid) or "")[-3800:] or "(empty)"
+        except RuntimeError as e: text = str(e)
+        try: await query.edit_message_text(f"📜 <b>{html.escape(tid)}</b> (last {LOG_TAIL_LINES} lines)\n<pre>{html.escape(text)}</pre>", parse_mode="HTML", reply_markup=query.message.reply_markup)
+        except Exception: pass
+
+    elif data.startswith("logf_"):
+        tid = data.split("logf_")[1]
+        if uid != ADMIN_ID and uid != get_owner(tid): return await query.message.reply_text("⛔ Not yours.")
+        path = log_path_for(tid)
+        if cluster.node_of(tid):
+            try: text = await read_log(tid, full=True)
+            except RuntimeError as e: return await query.message.reply_text(f"❌ {e}")
+            if not text: return await query.message.reply_text("❌ No logs.")
+            return await context.bot.send_document(chat_id=update.effective_chat.id, document=text.encode(), filename=os.path.basename(path))
+        if not os.path.exists(path): return await query.message.reply_text("❌ No logs.")
+        with open(path, 'rb') as f: await context.bot.send_document(chat_id=update.effective_chat.id, document=f, filename=os.path.basename(path))
 
     elif data.startswith("url_"):
         tid = data.split("url_")[1]
@@ -557,19 +3894,221 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if remove_allowed_user(int(context.args[0])): await update.message.reply_text("🗑️ Removed.")
 
+@restricted
+async def set_limits(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not context.args: return await update.message.reply_text("Usage: `/limits <app> mem=512 cpu=50 pids=64 nofile=1024`", parse_mode="Markdown")
+    tid = context.args[0]
+    if uid != ADMIN_ID and uid != get_owner(tid): return await update.message.reply_text("⛔ Not yours.")
+    try: changes = parse_limits(context.args[1:])
+    except ValueError as e: return await update.message.reply_text(f"❌ {e}", parse_mode="Markdown")
+    live = set_app_limits(tid, **changes) if changes else False
+    await update.message.reply_text(f"📏 `{tid}`\n{fmt_limits(app_limits(tid))}" + (f"\n{fmt_applied(live)}" if changes else ""), parse_mode="Markdown")
+
+@restricted
+async def set_ready_pattern(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not context.args: return await update.message.reply_text("Usage: `/ready <app> <regex>` (no regex to clear)", parse_mode="Markdown")
+    tid, pattern = context.args[0], " ".join(context.args[1:]) or None
+    if uid != ADMIN_ID and uid != get_owner(tid): return await update.message.reply_text("⛔ Not yours.")
+    try:
+        if pattern: re.compile(pattern)
+    except re.error as e: return await update.message.reply_text(f"❌ Bad regex: {e}")
+    registry.update(tid, ready_pattern=pattern)
+    await update.message.reply_text(f"✅ Ready pattern for `{tid}`: `{pattern or 'none'}`", parse_mode="Markdown")
+
+@restricted
+async def set_health_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not context.args: return await update.message.reply_text(
+        "Usage: `/health <app> http port=8080 path=/health` | `log pattern=<regex> within=120` | `heartbeat file=hb within=60` | `off`\n"
+        "Options: interval= timeout= threshold= grace= rss=<MB>", parse_mode="Markdown")
+    tid = context.args[0]
+    if uid != ADMIN_ID and uid != get_owner(tid): return await update.message.reply_text("⛔ Not yours.")
+    if len(context.args) > 1:
+        if context.args[1].lower() == "off": registry.update(tid, health=None)
+        else:
+            try: registry.update(tid, health=parse_health(context.args[1:]))
+            except (ValueError, re.error) as e: return await update.message.reply_text(f"❌ {e}", parse_mode="Markdown")
+    cfg, app = health_config(tid), supervisor.get(tid)
+    if not cfg: return await update.message.reply_text(f"🩺 `{tid}`: no health check (process liveness only).", parse_mode="Markdown")
+    text = f"🩺 `{tid}`: {fmt_health(cfg)}"
+    if app and app.health:
+        text += f"\nStatus: {app.health['status']}" + (f" ({app.health['last_error']})" if app.health["last_error"] else "")
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+@restricted
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid, args = update.effective_user.id, list(context.args)
+    if not args or args[0].lower() not in BULK_ACTIONS: return await update.message.reply_text(
+        "Usage: `/bulk <start|stop|restart|redeploy|delete> <all|crashed|repo=name|owner=id|glob> [concurrency=8] [rolling] [batch=2] [confirm]`\n"
+        "Selectors combine, e.g. `/bulk restart crashed repo=mybot`. `rolling` waits for each batch to be healthy.", parse_mode="Markdown")
+    action, sel, opts = args[0].lower(), {}, {"concurrency": BULK_CONCURRENCY, "batch": 1}
+    try:
+        for arg in args[1:]:
+            key, _, value = arg.partition("=")
+            key = key.lower()
+            if key in ("all", "crashed", "rolling", "confirm") and not value: opts[key] = True
+            elif key in ("concurrency", "batch"): opts[key] = int(value)
+            elif key == "owner" and value: sel["owner"] = int(value)
+            elif key in ("repo", "glob") and value: sel[key] = value
+            elif "=" in arg: raise ValueError(f"Unknown option {arg}; use glob= for a pattern containing '='")
+            else: sel["glob"] = arg
+        targets = select_targets(uid, every=opts.get("all", False), crashed=opts.get("crashed", False), **sel)
+    except ValueError as e: return await update.message.reply_text(f"❌ {e}")
+    if not targets: return await update.message.reply_text("📂 No apps match.")
+    if action == "delete" and not opts.get("confirm"):
+        return await update.message.reply_text(f"⚠️ This deletes {len(targets)} app(s): " + ", ".join(f"`{t}`" for t in targets[:20])
+                                               + "\nRepeat the command with `confirm` to proceed.", parse_mode="Markdown")
+    msg = await outbox.reply(update.message, f"⏳ {action} on {len(targets)} app(s)...")
+    async def progress(done, total):
+        outbox.edit(msg, f"⏳ {action}: {done}/{total}")
+    report = await bulk_run(action, targets, opts["concurrency"], opts.get("rolling", False), opts["batch"], progress)
+    await outbox.edit(msg, fmt_bulk_report(report), parse_mode="HTML")
+
+@restricted
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args: return await update.message.reply_text(
+        "Usage: `/search ERROR since 10m [until 1m] [app=bot*.py] [limit=20]`\nUse `/regex/` for a regular expression.", parse_mode="Markdown")
+    try: params = parse_search(context.args)
+    except (ValueError, re.error) as e: return await update.message.reply_text(f"❌ {e}", parse_mode="Markdown")
+    result = await asyncio.to_thread(search_logs, update.effective_user.id, **params)
+    hits = result["hits"]
+    text = (f"🔎 {len(hits)}{'+' if result['truncated'] else ''} hits for <code>{html.escape(params['query'])}</code> in {result['took_ms']} ms"
+            f" (read {result['blocks_scanned']}/{result['blocks_total']} blocks)")
+    if result.get("errors"): text += "\n⚠️ Not searched: " + ", ".join(result["errors"])
+    rows = [f"{time.strftime('%m-%d %H:%M:%S', time.localtime(h['ts']))} {h['target']}: {h['line']}" for h in hits]
+    body = "\n".join(rows)
+    if len(body) > 3500: body = body[:3500] + "\n…"
+    if body: text += f"\n<pre>{html.escape(body)}</pre>"
+    await update.message.reply_text(text, parse_mode="HTML")
+
+@restricted
+async def set_idle_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not context.args: return await update.message.reply_text(
+        "Usage: `/idle <app> freeze|stop <minutes> [wake=08:00,20:00]` | `/idle <app> off`\n"
+        "freeze keeps the process paused in memory (instant wake); stop exits it and relaunches on wake.", parse_mode="Markdown")
+    tid = context.args[0]
+    if uid != ADMIN_ID and uid != get_owner(tid): return await update.message.reply_text("⛔ Not yours.")
+    if len(context.args) > 1:
+        if context.args[1].lower() == "off":
+            registry.update(tid, idle=None)
+            if not cluster.node_of(tid): await supervisor.wake(tid, "manual")  # the agent wakes its own on /agent/idle
+        else:
+            try: registry.update(tid, idle=parse_idle(context.args[1:]))
+            except ValueError as e: return await update.message.reply_text(f"❌ {e}", parse_mode="Markdown")
+        # A remote app is suspended by its agent's idle manager, which reads the agent's registry.
+        if cluster.node_of(tid):
+            try: await cluster.call(tid, "/agent/idle", {"target": tid, "idle": idle_config(tid)})
+            except RuntimeError as e: return await update.message.reply_text(f"⚠️ Saved, but node `{cluster.node_of(tid)}` was not updated: {e}", parse_mode="Markdown")
+    cfg = idle_config(tid)
+    await update.message.reply_text(f"💤 `{tid}` idle policy: {fmt_idle(cfg) if cfg else 'off (always resident)'}", parse_mode="Markdown")
+
+@super_admin_only
+async def nodes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if NODE_ROLE != "controller" or not AGENT_TOKEN: return await update.message.reply_text("🖧 Single node (set AGENT_TOKEN and start agents with NODE_ROLE=agent).")
+    alive, lines = cluster.alive(), []
+    for name, load in sorted(cluster.loads().items()):
+        labels = f" [{', '.join(load['labels'])}]" if load["labels"] else ""
+        lines.append(f"🟢 `{name}`{labels}: CPU {load['cpu']}% | RAM {load['mem_pct']}% | {load['apps']} apps")
+    for name in sorted(set(cluster.agents) - set(alive)):
+        lines.append(f"🔴 `{name}`: last seen {fmt_duration(time.time() - cluster.agents[name]['last_seen'])} ago")
+    await update.message.reply_text("🖧 **Nodes**\n" + ("\n".join(lines) or "No agents registered."), parse_mode="Markdown")
+
+@restricted
+async def place_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if len(context.args) != 2: return await update.message.reply_text("Usage: `/place <app> <node|label|auto>`", parse_mode="Markdown")
+    tid, where = context.args
+    if uid != ADMIN_ID and uid != get_owner(tid): return await update.message.reply_text("⛔ Not yours.")
+    registry.update(tid, affinity=None if where == "auto" else where)
+    if supervisor.is_running(tid):
+        try: await supervisor.start(tid)
+        except Exception as e: return await update.message.reply_text(f"❌ {e}")
+    await update.message.reply_text(f"📍 `{tid}` affinity: `{where}`, node: `{cluster.node_of(tid) or 'local'}`", parse_mode="Markdown")
+
+@super_admin_only
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    arg = context.args[0] if context.args else "status"
+    if arg == "stop" or arg == "dump":
+        profiler.stop()
+        st = profiler.status()
+        top = "\n".join(f"{count:>6}  {frame}" for frame, count in profiler.top()) or "(no samples)"
+        await update.message.reply_text(f"🔬 <b>Profile</b>: {st['samples']} samples\n<pre>{html.escape(top)}</pre>", parse_mode="HTML")
+        if st["samples"]:
+            await context.bot.send_document(chat_id=update.effective_chat.id, document=profiler.folded().encode(), filename="profile.folded")
+        return
+    if arg.replace(".", "", 1).isdigit() or arg == "start":
+        seconds = float(arg) if arg != "start" else 60
+        if not profiler.start(seconds): return await update.message.reply_text("🔬 Profiler already running. `/profile stop` to finish.", parse_mode="Markdown")
+        return await update.message.reply_text(f"🔬 Profiling for up to {min(seconds, PROFILE_MAX_SECONDS):.0f}s. `/profile stop` for results.", parse_mode="Markdown")
+    st = profiler.status()
+    await update.message.reply_text(f"🔬 Profiler {'running' if st['running'] else 'idle'}, {st['samples']} samples.\nUsage: `/profile <seconds>` | `/profile stop`", parse_mode="Markdown")
+
+@super_admin_only
+async def gc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    run = context.args[:1] == ["run"]
+    removed = await asyncio.to_thread(collect_garbage, not run)
+    freed = sum(b for _, b in removed) / 2**20
+    lines = "\n".join(f"• {html.escape(p)} ({b / 2**20:.1f} MB)" for p, b in removed[:20]) or "Nothing to clean."
+    head = f"🧹 Removed {len(removed)} paths, {freed:.1f} MB freed" if run else f"🧹 {len(removed)} orphaned paths, {freed:.1f} MB (dry run, <code>/gc run</code> to delete)"
+    await update.message.reply_text(f"{head}\n{lines}", parse_mode="HTML")
+
 @restricted
 async def server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"📊 Running: {len(running_processes)}")
+    uid = update.effective_user.id
+    b = build_queue.stats()
+    states = ", ".join(f"{k}: {v}" for k, v in sorted(supervisor.states().items()))
+    stats = sampler.summary(registry.targets_for(uid))
+    text = f"📊 Running: {supervisor.count()}" + (f" ({states})" if states else "")
+    r = supervisor.recovery
+    if r and r["apps"]:
+        text += f"\n♻️ Startup recovery: {r['apps']} apps, " + (f"healthy after {r['healthy_after']}s" if r["healthy_after"] is not None else "in progress")
+    host = stats["host"].get("current")
+    if host:
+        text += f"\n🖥️ CPU {host['cpu']}% | RAM {host['mem_pct']}% | Load {host['load1']:.2f} {host['load5']:.2f} {host['load15']:.2f}"
+    if cluster.enabled():
+        alive = cluster.alive()
+        text += f"\n🖧 Nodes: {len(alive)}/{len(cluster.agents)} agents up, {sum(1 for r in list(cluster.remote.values()) if r.state == 'running')} remote apps running"
+    text += f"\n🏗️ Builds: {b['running']} running, {b['queued']} queued (limit {b['concurrency']})"
+    o = outbox.stats()
+    text += f"\n📨 Outbox: {o['queued']} queued, latency p50 {o['latency_ms']['p50']} ms / p95 {o['latency_ms']['p95']} ms, 429s: {o['flood_waits']}, coalesced: {o['coalesced']}"
+    idle = idle_report()
+    if idle["suspended"]: text += f"\n💤 Suspended: {idle['suspended']} apps, {idle['resident_mb']} MB resident, ~{idle['freed_mb']} MB freed"
+    store = await asyncio.to_thread(log_store.stats)
+    text += f"\n🔎 Log store: {store['lines']} lines, {store['size_mb']} MB in {store['segments']} segments" + (f", {store['dropped']} chunks dropped" if store['dropped'] else "")
+    total, mine = await asyncio.to_thread(lambda: (total_disk_usage(), user_disk_usage(uid)))
+    text += f"\n💾 Disk: {total / 2**20:.0f} MB" + (f" of {GLOBAL_QUOTA_MB} MB" if GLOBAL_QUOTA_MB else "")
+    text += f", yours {mine / 2**20:.1f} MB" + (f" of {USER_QUOTA_MB} MB" if USER_QUOTA_MB and uid != ADMIN_ID else "")
+    if gc_state["last_run"]: text += f"\n🧹 Last GC: {len(gc_state['removed'])} removed, {gc_state['freed'] / 2**20:.1f} MB freed"
+    for j in b['recent'][:5]: text += f"\n• #{j['id']} {j['kind']} `{j['target']}` {j['state']} (wait {j['wait_s']}s, run {j['run_s']}s)"
+    apps = sorted(stats["apps"].items(), key=lambda kv: kv[1]["5m"]["cpu"]["p95"] or 0, reverse=True)
+    if apps: text += "\n\n🔥 **Top apps** (CPU% now / p95 5m, RSS):"
+    for tid, a in apps[:10]:
+        cur = a["current"]
+        text += f"\n• `{tid}` {cur['cpu']}% / {a['5m']['cpu']['p95']}%, {cur['rss_mb']} MB"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+async def on_startup(application):
+    build_queue.bind(asyncio.get_running_loop())
+    supervisor.bind(asyncio.get_running_loop(), application.bot)
+    sampler.start()
+    health_checker.start(asyncio.get_running_loop())
+    idle_manager.start(asyncio.get_running_loop())
+    asyncio.get_running_loop().create_task(supervisor.recover(application))
+    if GIT_POLL_INTERVAL > 0: asyncio.get_running_loop().create_task(git_poll_loop(application))
+    if GC_INTERVAL > 0: asyncio.get_running_loop().create_task(gc_loop())
+
+async def on_shutdown(application):
+    await supervisor.shutdown()
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🆘 **Help**\nContact: @platoonleaderr", parse_mode="Markdown")
 
-if __name__ == '__main__':
-    t = threading.Thread(target=run_flask)
-    t.daemon = True
-    t.start()
-    
-    app_bot = ApplicationBuilder().token(TOKEN).build()
+def build_application():
+    app_bot = (ApplicationBuilder().token(TOKEN).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL)
+               .concurrent_updates(UPDATE_CONCURRENCY).build())
     
     conv_file = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^📤 Upload File$"), upload_start)],
@@ -592,6 +4131,16 @@ if __name__ == '__main__':
     
     app_bot.add_handler(CommandHandler('add', add_user))
     app_bot.add_handler(CommandHandler('remove', remove_user))
+    app_bot.add_handler(CommandHandler('limits', set_limits))
+    app_bot.add_handler(CommandHandler('ready', set_ready_pattern))
+    app_bot.add_handler(CommandHandler('health', set_health_check))
+    app_bot.add_handler(CommandHandler('idle', set_idle_policy))
+    app_bot.add_handler(CommandHandler('search', search_command))
+    app_bot.add_handler(CommandHandler('bulk', bulk_command))
+    app_bot.add_handler(CommandHandler('nodes', nodes_command))
+    app_bot.add_handler(CommandHandler('place', place_command))
+    app_bot.add_handler(CommandHandler('profile', profile_command))
+    app_bot.add_handler(CommandHandler('gc', gc_command))
     app_bot.add_handler(conv_file)
     app_bot.add_handler(conv_git)
     app_bot.add_handler(MessageHandler(filters.Regex("^📂 My Hosted Apps$"), list_hosted))
@@ -599,6 +4148,9 @@ if __name__ == '__main__':
     app_bot.add_handler(MessageHandler(filters.Regex("^🆘 Help$"), help_command))
     app_bot.add_handler(CallbackQueryHandler(manage_callback))
     app_bot.add_handler(CommandHandler('start', start))
+    for handlers in app_bot.handlers.values(): instrument_handlers(handlers)
+    return app_bot
 
-    print("Bot is up and running!")
-    app_bot.run_polling()
+if __name__ == '__main__':
+    if NODE_ROLE == "agent": asyncio.run(serve_agent())
+    else: asyncio.run(serve(build_application()))